@@ -19,14 +19,18 @@ i.e. The expected output is a CSV file.
 """
 import csv
 from io import TextIOWrapper
+import json
 import re
 import os
+import pkgutil
 import decimal
 import logging
 from datetime import datetime
+import collections
 import concurrent.futures
+import threading
 from urllib import parse
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Tuple
 from common import file_utils, image_utils, sheets_utils
 from forex_python.converter import CurrencyCodes
 from app.context import Context
@@ -58,18 +62,46 @@ AD_TYPE = 'Ad type'
 AD_DESCRIPTION_ORIG = 'Description Line 1#Original'
 AD_DESCRIPTION = 'Description Line 1'
 IMAGE = 'Image'
+ADGROUP_STATUS = 'Ad Group Status'
 
 # Default campaign names to use
 PDSA_PRODUCT_CAMPAIGN_NAME = 'PDSA Products'
 PDSA_CATEGORY_CAMPAIGN_NAME = 'PDSA Categories'
 AD_DESCRIPTION_MAX_LENGTH = 90
 AD_DESCRIPTION_MIN_LENGTH = 35
+# Patterns of separators for splitting titles and descriptions into sentences
+SENTENCE_SEPARATORS = '[.!?|\n]'
+SENTENCE_SEPARATORS_FULL = '[.!?|\n,;]'
+# Number of labels (ad groups) to download images for ahead of processing
+IMAGE_DOWNLOAD_LOOKAHEAD = 50
+# File name of index of image urls to their content hashes (for content-addressed images)
+IMAGE_MANIFEST_FILE_NAME = '.image-manifest.json'
+# File name of fingerprints of ad groups generated by the previous run (for delta mode)
+ADGROUP_FINGERPRINTS_FILE_NAME = '.adgroup-fingerprints.json'
+# Number of products fetched at once in streaming mode
+PRODUCTS_PAGE_SIZE = 10000
+# Symbols removed from adcustomizer values and a pattern of repeated spaces
+ADCUSTOMIZER_REMOVED_CHARS = str.maketrans('', '', '-|')
+ADCUSTOMIZER_RE_SPACES = re.compile(' +')
+
+# Product fields used for generating ad groups (the rest aren't kept in memory)
+ProductInfo = collections.namedtuple('ProductInfo', [
+    'offer_id', 'title', 'description', 'custom_description', 'image_link',
+    'additional_image_links'
+])
 
 
 class GoogleAdsEditorMgr:
   """Component that incapsulates logic for creating CSV with campaign data for Google Ads Editor"""
 
-  def __init__(self, context: Context):
+  def __init__(self, context: Context, delta: bool = False):
+    """Initialise new instance of GoogleAdsEditorMgr.
+
+    Args:
+      context: execution context
+      delta: True for a file with changes only (with a status column to
+             remove ad groups, see `add_removed_adgroup`)
+    """
     self._context = context
     self._headers = [
         CAMP_NAME, CAMP_BUDGET, DSA_WEBSITE, DSA_LANG, DSA_TARGETING_SOURCE,
@@ -77,17 +109,45 @@ class GoogleAdsEditorMgr:
         ADGROUP_TYPE, TARGET_CONDITION, TARGET_VALUE, AD_TYPE,
         AD_DESCRIPTION_ORIG, AD_DESCRIPTION, IMAGE
     ]
-    self._rows = []
+    if delta:
+      self._headers.append(ADGROUP_STATUS)
+    self._column_indexes = {
+        header: i for i, header in enumerate(self._headers)
+    }
+    # rows are kept compact (see __create_row) till they're written
+    self._rows: List[Tuple] = []
+    self._csv_file = None
+    self._tmp_csv_path = None
+    self._writer = None
     self._orig_descriptions = {}
-    self._re_splitter = re.compile('[.!?|\n]')
-    self._re_splitter_full = re.compile('[.!?|\n,;]')
-
-  def __create_row(self):
-    ''' Creates an object that represents an empty row of the csv file '''
-    row = {}
-    for header in self._headers:
-      row[header] = ''
-    return row
+    # ad descriptions of products selected beforehand (by labels), see `get_ad_descriptions`
+    self._ad_descriptions: Dict[str, str] = {}
+    self._re_splitter = re.compile(SENTENCE_SEPARATORS)
+    self._re_splitter_full = re.compile(SENTENCE_SEPARATORS_FULL)
+
+  def __create_row(self, values: Dict[str, str]) -> Tuple:
+    ''' Creates a compact object that represents a row of the csv file:
+    a flat tuple of column indexes and values of non-empty cells only '''
+    row = []
+    for header, value in values.items():
+      if value is not None and value != '':
+        row.append(self._column_indexes[header])
+        row.append(value)
+    return tuple(row)
+
+  def __expand_row(self, row: Tuple) -> List[str]:
+    ''' Returns all cells values of a compact row (in the order of headers) '''
+    values = [''] * len(self._headers)
+    for i in range(0, len(row), 2):
+      values[row[i]] = row[i + 1]
+    return values
+
+  def __add_row(self, values: Dict[str, str]):
+    row = self.__create_row(values)
+    if self._writer:
+      self._writer.writerow(self.__expand_row(row))
+    else:
+      self._rows.append(row)
 
   def __split_to_sentences(self, descrption: str, all_separators: bool):
     ''' Break a paragraph into sentences and return a list '''
@@ -101,23 +161,10 @@ class GoogleAdsEditorMgr:
     ''' This method tries to generate an ad description using ad customizers template.
         The limit for description is 90 characters.
     '''
-    # Try to use adcustomizers
-    if self._context.target.ad_description_template:
-      # NOTE: inside template we have macros like {field},
-      # they should be translated to adcustomizer syntax  {=AD_CUSTOMIZER_FEED.field}
-      def replacer(match: re.Match):
-        return '{=' + self._context.target.adcustomizer_feed_name + '.' + match.group(
-            1) + '}'
-
-      # TODO: an expanded ad description (after evaluating adcustomizers) can exceed the ad description maximum length
-      description = self._context.target.ad_description_template
-      # support for product_description - static description from configuration
-      description = description.replace(
-          '{product_description}', self._context.target.product_description)
-      description = re.sub('\{([^}]+)\}', replacer, description)
-      if description != self._context.target.ad_description_template:
-        return description
-      return ''
+    # Try to use adcustomizers (the template is compiled once, see `ConfigTarget.get_ad_description_template`)
+    template = self._context.target.get_ad_description_template()
+    if template:
+      return template.render()
 
   def __get_ad_description(self, product):
     ''' The limit for description is 90 characters, which can be easily exceeded.
@@ -161,6 +208,34 @@ class GoogleAdsEditorMgr:
         return sentence
     return ''
 
+  def get_ad_descriptions(self, products: List[ProductInfo]) -> List[str]:
+    """Select ad descriptions for many products at once.
+
+    The result is the same as of selecting a description for each product
+    (see `__get_ad_description`), but with pyarrow installed all products
+    are processed by vectorised string kernels.
+    """
+    target = self._context.target
+    if target.product_description and not target.product_description_as_fallback_only and len(
+        target.product_description) <= AD_DESCRIPTION_MAX_LENGTH:
+      return [target.product_description] * len(products)
+    try:
+      import pyarrow
+    except ImportError:
+      return [self.__get_ad_description(product) for product in products]
+    fallback = None
+    if target.product_description and target.product_description_as_fallback_only and len(
+        target.product_description) <= AD_DESCRIPTION_MAX_LENGTH:
+      fallback = target.product_description
+    return _select_ad_descriptions_arrow(
+        [product.title for product in products],
+        [product.description for product in products],
+        [product.custom_description for product in products], fallback)
+
+  def set_ad_descriptions(self, ad_descriptions: Dict[str, str]):
+    """Set ad descriptions selected beforehand (see `get_ad_descriptions`) by labels"""
+    self._ad_descriptions = ad_descriptions
+
   def __get_category_description(self, label):
     desc = None
     if self._context.target.category_ad_descriptions:
@@ -179,7 +254,6 @@ class GoogleAdsEditorMgr:
     self._orig_descriptions = orig_desc
 
   def add_campaign(self, name):
-    campaign = self.__create_row()
     campaign_details = {
         CAMP_NAME: name,
         DSA_WEBSITE: self._context.target.dsa_website,
@@ -187,8 +261,7 @@ class GoogleAdsEditorMgr:
         DSA_TARGETING_SOURCE: 'Page feed',
         DSA_PAGE_FEEDS: self._context.target.page_feed_name
     }
-    campaign.update(campaign_details)
-    self._rows.append(campaign)
+    self.__add_row(campaign_details)
 
   def add_adgroup(self, campaign_name: str, adgroup_name: str,
                   is_product_level: bool, product, label: str,
@@ -201,7 +274,6 @@ class GoogleAdsEditorMgr:
       ad_description_from_template = self.__get_ad_description_from_template(
           product)
       if ad_description_from_template:
-        adgroup = self.__create_row()
         adgroup_details = {
             CAMP_NAME: campaign_name,
             ADGROUP_NAME: adgroup_name,
@@ -214,14 +286,16 @@ class GoogleAdsEditorMgr:
             AD_DESCRIPTION_ORIG: orig_ad_description,
             AD_DESCRIPTION: ad_description_from_template.strip()
         }
-        adgroup.update(adgroup_details)
-        self._rows.append(adgroup)
+        self.__add_row(adgroup_details)
 
     # Add the ad group row (with default description)
-    adgroup = self.__create_row()
     # TODO: currently __get_category_description raises ValueError if a mapping (label-category) is missing in config
-    ad_description = self.__get_ad_description(
-        product) if is_product_level else self.__get_category_description(label)
+    if not is_product_level:
+      ad_description = self.__get_category_description(label)
+    elif label in self._ad_descriptions:
+      ad_description = self._ad_descriptions[label]
+    else:
+      ad_description = self.__get_ad_description(product)
     adgroup_details = {
         CAMP_NAME: campaign_name,
         ADGROUP_NAME: adgroup_name,
@@ -234,19 +308,16 @@ class GoogleAdsEditorMgr:
         AD_DESCRIPTION_ORIG: orig_ad_description,
         AD_DESCRIPTION: ad_description.strip()
     }
-    adgroup.update(adgroup_details)
-    self._rows.append(adgroup)
+    self.__add_row(adgroup_details)
 
     # Add the Dynamic targeting row
-    dynamic_target = self.__create_row()
     dynamic_target_details = {
         CAMP_NAME: campaign_name,
         ADGROUP_NAME: adgroup_name,
         TARGET_CONDITION: 'CUSTOM_LABEL',
         TARGET_VALUE: label,
     }
-    dynamic_target.update(dynamic_target_details)
-    self._rows.append(dynamic_target)
+    self.__add_row(dynamic_target_details)
 
     # Add the image extension row(s)
     if images:
@@ -254,22 +325,100 @@ class GoogleAdsEditorMgr:
         self.add_image_ext(campaign_name, adgroup_name, local_image_path)
 
   def add_image_ext(self, campaign_name: str, adgroup_name: str, img_path: str):
-    image = self.__create_row()
     image_details = {
         CAMP_NAME: campaign_name,
         ADGROUP_NAME: adgroup_name,
         IMAGE: img_path
     }
-    image.update(image_details)
-    self._rows.append(image)
+    self.__add_row(image_details)
 
-  def generate_csv(self, output_csv_path: str):
+  def add_removed_adgroup(self, campaign_name: str, adgroup_name: str):
+    adgroup_details = {
+        CAMP_NAME: campaign_name,
+        ADGROUP_NAME: adgroup_name,
+        ADGROUP_STATUS: 'Removed'
+    }
+    self.__add_row(adgroup_details)
+
+  def start_csv(self, output_csv_path: str):
+    """Start writing rows into a CSV file as soon as they're added
+    (instead of keeping them in memory till `generate_csv`).
+
+    Rows are written into a temporary file which replaces the output file
+    in `generate_csv`, so the previous file is kept if generation fails
+    (see `close`).
+    """
     self._context.ensure_folders()
+    self._tmp_csv_path = output_csv_path + '.tmp'
     # NOTE: Google Ads Editor doesn't understand UTF-8!
-    with open(output_csv_path, 'w', encoding='UTF-16') as csv_file:
-      writer = csv.DictWriter(csv_file, fieldnames=self._headers)
-      writer.writeheader()
-      writer.writerows(self._rows)
+    self._csv_file = open(self._tmp_csv_path, 'w', encoding='UTF-16')
+    self._writer = csv.writer(self._csv_file)
+    self._writer.writerow(self._headers)
+
+  def generate_csv(self, output_csv_path: str):
+    if not self._writer:
+      self.start_csv(output_csv_path)
+      self._writer.writerows(self.__expand_row(row) for row in self._rows)
+    # all rows have been written (see `start_csv`)
+    self._csv_file.close()
+    os.replace(self._tmp_csv_path, output_csv_path)
+    self._writer = self._csv_file = self._tmp_csv_path = None
+
+  def close(self):
+    """Close and remove a CSV file that wasn't completed by `generate_csv`"""
+    if self._csv_file:
+      self._csv_file.close()
+      os.remove(self._tmp_csv_path)
+      self._writer = self._csv_file = self._tmp_csv_path = None
+
+
+def _select_ad_descriptions_arrow(titles: List[str], descriptions: List[str],
+                                  custom_descriptions: List[str],
+                                  fallback: str = None) -> List[str]:
+  """Select ad descriptions of products with pyarrow compute kernels
+  in the same order of fallbacks as `GoogleAdsEditorMgr.__get_ad_description`
+  (except for a static product description that is used for all products)"""
+  import pyarrow as pa
+  import pyarrow.compute as pc
+
+  titles = pa.array(titles, pa.string())
+  descriptions = pa.array(descriptions, pa.string())
+  custom_descriptions = pa.array(custom_descriptions, pa.string())
+  count = len(titles)
+
+  def fits(values, min_length: int = 1):
+    lengths = pc.utf8_length(values)
+    return pc.fill_null(
+        pc.and_(pc.greater_equal(lengths, min_length),
+                pc.less_equal(lengths, AD_DESCRIPTION_MAX_LENGTH)), False)
+
+  def first_sentence(values, separators: str):
+    # the first sentence of a suitable length for each value (or null)
+    sentences = pc.split_pattern_regex(values, separators)
+    table = pa.table({
+        'index': pc.list_parent_indices(sentences),
+        'sentence': pc.list_flatten(sentences)
+    })
+    table = table.filter(fits(table['sentence'], AD_DESCRIPTION_MIN_LENGTH))
+    firsts = table.group_by('index', use_threads=False).aggregate([
+        ('sentence', 'first')
+    ])
+    positions = pc.index_in(pa.array(range(count), pa.int64()),
+                            value_set=firsts['index'].cast(pa.int64()))
+    return pc.take(firsts['sentence_first'], positions)
+
+  candidates = [
+      pc.if_else(fits(custom_descriptions), custom_descriptions, None),
+      pc.if_else(fits(descriptions), descriptions, None),
+      pc.if_else(fits(titles), titles, None)
+  ]
+  if fallback is not None:
+    candidates.append(pa.array([fallback] * count, pa.string()))
+  for separators in (SENTENCE_SEPARATORS, SENTENCE_SEPARATORS_FULL):
+    candidates.append(first_sentence(titles, separators))
+    candidates.append(first_sentence(descriptions, separators))
+  result = pc.coalesce(*candidates, pa.scalar('', pa.string()))
+  return result.to_pylist()
 
 
 def _get_ads_attribute_type(field, parent_field=None) -> str:
@@ -290,6 +439,42 @@ def _get_product_adgroup_name(product) -> str:
   return 'Ad group ' + product.offer_id
 
 
+def _get_product_info(product) -> ProductInfo:
+  return ProductInfo(*(getattr(product, field) for field in ProductInfo._fields))
+
+
+# Currency symbols (without letters and digits) by ISO codes
+_currency_symbols: Dict[str, str] = None
+
+
+def _clean_currency_symbol(symbol: str) -> str:
+  return None if symbol is None else re.sub('[A-Za-z0-9]', '', symbol)
+
+
+def _get_currency_symbol(currency: str) -> str:
+  """Return a symbol of a currency by its ISO code (without letters and digits,
+  so it can be empty) or None for an unknown currency"""
+  global _currency_symbols
+  if _currency_symbols is None:
+    try:
+      # NOTE: the table is built once (on first use) from forex_python's data
+      # file instead of scanning the whole data for every lookup
+      data = json.loads(
+          pkgutil.get_data('forex_python', 'raw_data/currencies.json'))
+      _currency_symbols = {
+          item['cc']: _clean_currency_symbol(item['symbol']) for item in data
+      }
+    except (OSError, TypeError, ValueError, KeyError) as e:
+      # the data file isn't a public API of forex_python,
+      # so symbols are looked up (and cached) via CurrencyCodes instead
+      logging.warning(f'Failed to load currency symbols: {e}')
+      _currency_symbols = {}
+  if currency not in _currency_symbols:
+    _currency_symbols[currency] = _clean_currency_symbol(
+        CurrencyCodes().get_symbol(currency))
+  return _currency_symbols[currency]
+
+
 def _get_subfield_name(field, subfield):
   """Create a field name for adcustomizer from a nested field (field of RECORD)"""
   # NOTE: Google Ads doesn't support "." in field names
@@ -298,11 +483,21 @@ def _get_subfield_name(field, subfield):
 
 class AdCustomizerGenerator:
 
-  def __init__(self, products) -> None:
+  def __init__(self, products, writer=None) -> None:
+    """Initialise new instance of AdCustomizerGenerator.
+
+    Args:
+      products: products (only their schema is used)
+      writer: a csv writer to write rows into as soon as products are added,
+              otherwise rows are kept in memory (see `get_values`)
+    """
+    self._writer = writer
     self._adcustomizer_values = []
     self._adcustomizer_columns = []
     self._attr_types_by_name = {}
-    self._schema = products.schema
+    # the schema is compiled into a list of column indexes and
+    # functions to serialize their values (one per adcustomizer column)
+    self._accessors: List[Tuple[int, Callable[[Any], str]]] = []
     self._adcustomizer_ignore_columns = [
         'data_date', 'latest_date', 'product_id', 'merchant_id', 'offer_id',
         'link', 'image_link', 'additional_image_links',
@@ -311,7 +506,7 @@ class AdCustomizerGenerator:
     ]
     # initialize columns:
     # ignoring repeated fields(array) and expanding records, also ignoring unsupported types
-    for field in products.schema:
+    for index, field in enumerate(products.schema):
       if field.mode == 'REPEATED' or field.name in self._adcustomizer_ignore_columns:
         continue
       elif field.field_type == 'RECORD':
@@ -323,26 +518,48 @@ class AdCustomizerGenerator:
           field_name = _get_subfield_name(field, subfield)
           self._attr_types_by_name[field_name] = attr_type
           self._adcustomizer_columns.append(field_name + ' (' + attr_type + ')')
+          self._accessors.append(
+              (index, self._get_subfield_serializer(field_name, subfield)))
       else:
         attr_type = _get_ads_attribute_type(field)
         if not attr_type:
           continue
         self._attr_types_by_name[field.name] = attr_type
         self._adcustomizer_columns.append(field.name + ' (' + attr_type + ')')
+        self._accessors.append((index, self._get_serializer(field)))
     self._adcustomizer_columns.append('Target campaign')
     self._adcustomizer_columns.append('Target ad group')
+    if self._writer:
+      self._writer.writerow(self._adcustomizer_columns)
 
-  def _serialize_value(self, bq_value, field_schema):
-    if bq_value is None:
-      return ''
-    if field_schema.field_type in ['INTEGER', 'NUMERIC']:
-      if type(bq_value) is decimal.Decimal:
+  def _get_serializer(self, field_schema) -> Callable[[Any], str]:
+    """Return a function to serialize values of a field"""
+    is_number = field_schema.field_type in ['INTEGER', 'NUMERIC']
+
+    def serialize(bq_value) -> str:
+      if bq_value is None:
+        return ''
+      if is_number and type(bq_value) is decimal.Decimal:
         # There's a bug in Ad Customizers that doesn't allow float values
         # TODO: remove the casting to int
         return str(int(bq_value))
-    bq_value = re.sub('[-|]', '', str(bq_value))
-    # NOTE: Google Ads requires fields to be 80 symbols or less (otherwise there will be an error: AD_PLACEHOLDER_STRING_TOO_LONG)
-    return re.sub(' +', ' ', bq_value)[:80]
+      bq_value = str(bq_value).translate(ADCUSTOMIZER_REMOVED_CHARS)
+      # NOTE: Google Ads requires fields to be 80 symbols or less (otherwise there will be an error: AD_PLACEHOLDER_STRING_TOO_LONG)
+      return ADCUSTOMIZER_RE_SPACES.sub(' ', bq_value)[:80]
+
+    return serialize
+
+  def _get_subfield_serializer(self, field_name: str,
+                               subfield) -> Callable[[Any], str]:
+    """Return a function to serialize values of a field of RECORD from the record"""
+    serialize = self._get_serializer(subfield)
+    if 'price' in field_name and subfield.field_type == 'NUMERIC':
+      return lambda record: '' if record is None else serialize(
+          self._get_price_with_currency(record))
+    key = subfield.name
+    # NOTE: we expect records to be values of collections.Mapping
+    return lambda record: '' if record is None else serialize(
+        record.get(key, ''))
 
   def _get_price_with_currency(self, price_field, use_symbol=False):
     value = price_field.get('value')
@@ -350,45 +567,100 @@ class AdCustomizerGenerator:
     if value is None or currency is None:
       return ''
     if use_symbol:
-      currency_codes = CurrencyCodes()
-      symbol = currency_codes.get_symbol(currency)
-      symbol = (re.sub('[A-Za-z0-9]', '', symbol))
+      symbol = _get_currency_symbol(currency)
+      if symbol is None:
+        # unknown currency
+        return str(value) + ' ' + currency
       return symbol + str(value)
     # There's a bug in Ad Customizers that doesn't allow float values
     # TODO: remove the casting to int
     return str(int(value)) + ' ' + currency
 
   def add_product(self, prod, target_campaign: str, target_adgroup: str):
-    row_values = []
-    for i in range(len(prod)):
-      field_schema = self._schema[i]
-      if field_schema.mode == 'REPEATED' or field_schema.name in self._adcustomizer_ignore_columns:
-        continue
-      field_value = prod[i]
-      if field_schema.field_type == 'RECORD':
-        for subfield in field_schema.fields:
-          field_name = _get_subfield_name(field_schema, subfield)
-          if field_name in self._attr_types_by_name:
-            # NOTE: we expect field_value to be a value of collections.Mapping
-            if field_value is None:
-              row_values.append('')
-            elif 'price' in field_name and subfield.field_type == 'NUMERIC':
-              price_str = self._get_price_with_currency(field_value)
-              row_values.append(self._serialize_value(price_str, subfield))
-            else:
-              row_values.append(
-                  self._serialize_value(field_value.get(subfield.name, ''),
-                                        subfield))
-      elif field_schema.name in self._attr_types_by_name:
-        row_values.append(self._serialize_value(field_value, field_schema))
+    row_values = [serialize(prod[index]) for index, serialize in self._accessors]
     # finally add standard columns 'Target campaign' and 'Target ad group'
     row_values.append(target_campaign)
     row_values.append(target_adgroup)
-    self._adcustomizer_values.append(row_values)
+    if self._writer:
+      self._writer.writerow(row_values)
+    else:
+      self._adcustomizer_values.append(row_values)
 
   def get_values(self) -> List[List[Any]]:
     return [self._adcustomizer_columns] + self._adcustomizer_values
 
+  def get_fields(self) -> List[str]:
+    """Return names of adcustomizer fields (without types)"""
+    return list(self._attr_types_by_name)
+
+
+class AdGroupFingerprints:
+  """A persistent store of fingerprints of ad groups generated by a previous run.
+
+  A fingerprint is a hash of all inputs of an ad group's rows (see
+  `CampaignMgr._get_adgroup_fingerprint`). The store also keeps relative paths
+  of ad groups' images, so unchanged ad groups can be generated again
+  without processing their images.
+  The store is kept as a json file, either local or on GCS (gs://).
+  """
+
+  def __init__(self, path: str, storage_client=None):
+    self.path = path
+    self._storage_client = storage_client
+    # entries of the previous run and of the current one (by labels)
+    self._entries: Dict[str, Dict[str, Any]] = {}
+    self._current: Dict[str, Dict[str, Any]] = {}
+
+  def load(self):
+    try:
+      if self.path.startswith('gs://'):
+        content = file_utils.get_file_from_gcs(self.path, self._storage_client)
+      else:
+        with open(self.path, 'r') as f:
+          content = f.read()
+      self._entries = json.loads(content)
+      logging.info(f'Loaded ad group fingerprints {self.path} '
+                   f'({len(self._entries)} ad groups)')
+    except FileNotFoundError:
+      self._entries = {}
+      logging.info(f'Ad group fingerprints {self.path} were not found, '
+                   'all ad groups will be generated')
+    return self
+
+  def save(self):
+    """Save fingerprints of the current run (replacing the previous ones)"""
+    content = json.dumps(self._current)
+    if self.path.startswith('gs://'):
+      file_utils.save_file_to_gcs(self.path, content, self._storage_client)
+    else:
+      with open(self.path, 'w') as f:
+        f.write(content)
+    logging.debug(f'Saved ad group fingerprints {self.path}')
+
+  def get_images(self, label: str, fingerprint: str) -> List[str]:
+    """Return images of an ad group if it's unchanged since the previous run,
+    otherwise None"""
+    entry = self._entries.get(label)
+    if not entry or entry['fingerprint'] != fingerprint:
+      return None
+    return entry['images']
+
+  def set(self, label: str, campaign_name: str, adgroup_name: str,
+          fingerprint: str, images: List[str]):
+    self._current[label] = {
+        'campaign': campaign_name,
+        'adgroup': adgroup_name,
+        'fingerprint': fingerprint,
+        'images': images
+    }
+
+  def get_removed(self) -> List[Tuple[str, str]]:
+    """Return campaign and ad group names of ad groups of the previous run
+    that weren't generated by the current one"""
+    return [(entry['campaign'], entry['adgroup'])
+            for label, entry in self._entries.items()
+            if label not in self._current]
+
 
 class CampaignMgr:
   """ Responsible for creating the campaign and ad group structure that targets
@@ -398,35 +670,63 @@ class CampaignMgr:
   def __init__(self, context: Context, products):
     self._context = context
     self._credentials = context.credentials
-    self._products_by_label = {}
+    # a map of labels to the first product with it (only fields needed for ad groups)
+    self._products_by_label: Dict[str, ProductInfo] = {}
     self._create_product_campaign = self._create_category_campaign = False
-    self._adcustomizer_gen = AdCustomizerGenerator(products)
-
-    for prod in products:
-      custom_labels = prod['pdsa_custom_labels'].split(';')
-      product_level_adgroup = False
-      for label in custom_labels:
-        label = label.strip()
-        if is_product_label(label):
-          self._create_product_campaign = True
-          product_level_adgroup = True
-        else:
-          self._create_category_campaign = True
-
-        # Only add the product if this custom label wasn't added before
-        # i.e. for category labels, take the first product info
-        if label not in self._products_by_label:
-          self._products_by_label[label] = prod
-
-      # TODO: it's OK for MVP, but in the future we should avoid read all data into the memory.
-      # read out all columns for adcustomizer feed
-      if product_level_adgroup:
-        self._adcustomizer_gen.add_product(
-            prod, context.target.product_campaign_name or
-            PDSA_PRODUCT_CAMPAIGN_NAME, _get_product_adgroup_name(prod))
+    # one http session for all image downloads to reuse connections to hosts
+    self._http_session = file_utils.create_http_session(
+        context.download_pool_size)
+    # manifest of processed images (if enabled)
+    self._image_manifest: image_utils.ImageManifest = None
+    # images transformed in memory (by output names), see `_schedule_transform`
+    self._lock = threading.Lock()
+    self._transformed: Dict[str, concurrent.futures.Future] = {}
+    # in streaming mode adcustomizers are written into CSV while reading products
+    self._adcustomizer_csv_path = None
+    adcustomizer_file = None
+    if context.streaming:
+      context.ensure_folders()
+      self._adcustomizer_csv_path = os.path.join(
+          context.output_folder, context.target.adcustomizer_output_file)
+      adcustomizer_file = open(self._adcustomizer_csv_path, 'w')
+    self._adcustomizer_gen = AdCustomizerGenerator(
+        products,
+        csv.writer(adcustomizer_file, quoting=csv.QUOTE_MINIMAL)
+        if adcustomizer_file else None)
+
+    try:
+      for prod in products:
+        custom_labels = prod['pdsa_custom_labels'].split(';')
+        product_level_adgroup = False
+        product_info = None
+        for label in custom_labels:
+          label = label.strip()
+          if is_product_label(label):
+            self._create_product_campaign = True
+            product_level_adgroup = True
+          else:
+            self._create_category_campaign = True
+
+          # Only add the product if this custom label wasn't added before
+          # i.e. for category labels, take the first product info
+          if label not in self._products_by_label:
+            product_info = product_info or _get_product_info(prod)
+            self._products_by_label[label] = product_info
+
+        # read out all columns for adcustomizer feed
+        # (in streaming mode they're written right away, otherwise kept in memory)
+        if product_level_adgroup:
+          self._adcustomizer_gen.add_product(
+              prod, context.target.product_campaign_name or
+              PDSA_PRODUCT_CAMPAIGN_NAME, _get_product_adgroup_name(prod))
+    finally:
+      if adcustomizer_file:
+        adcustomizer_file.close()
 
   def generate_adcustomizers(self, generate_csv: bool) -> str:
     logging.info('Starting generating adcustomizer feed')
+    if self._adcustomizer_csv_path:
+      return self._update_adcustomizers_from_csv(generate_csv)
     values = self._adcustomizer_gen.get_values()
     # generate CSV (for creating)
     output_csv_path = None
@@ -448,125 +748,365 @@ class CampaignMgr:
     logging.info('Generated adcustomizers feed in Google Spreadsheet ' + url)
     return output_csv_path
 
+  def _update_adcustomizers_from_csv(self, generate_csv: bool) -> str:
+    """Update adcustomizers spreadsheet from the CSV written in streaming mode"""
+    output_csv_path = self._adcustomizer_csv_path
+    sheets_client = sheets_utils.GoogleSpreadsheetUtils(self._credentials)
+    with open(output_csv_path, 'r') as csv_file:
+      sheets_client.update_values_by_batches(
+          self._context.target.adcustomizer_spreadsheetid, "A1:AZ",
+          csv.reader(csv_file))
+    url = f'https://docs.google.com/spreadsheets/d/{self._context.target.adcustomizer_spreadsheetid}'
+    logging.info('Generated adcustomizers feed in Google Spreadsheet ' + url)
+    if not generate_csv:
+      os.remove(output_csv_path)
+      return None
+    logging.info(f'Generated adcustomizers data in {output_csv_path} file')
+    return output_csv_path
+
   def generate_csv(self) -> str:
     """Generate a CSV for Google Ads Editor with DSA campaign data"""
     if not self._products_by_label:
       return
-    old_rss = get_rss()
     total, used, free = get_disk_usage(DiskUsageUnits.MB)
 
     logging.info(f'Starting generating campaign data (/tmp: total={total}, used={used})')
     output_csv_path = os.path.join(self._context.output_folder,
                                    self._context.target.campaign_output_file)
     gae = GoogleAdsEditorMgr(self._context)
+    # in delta mode only ad groups changed since the previous run
+    # are written into a separate file (the full file is optional)
+    delta_gae = None
+    fingerprints: AdGroupFingerprints = None
+    write_full = True
+    if self._context.campaign_delta:
+      delta_gae = GoogleAdsEditorMgr(self._context, delta=True)
+      delta_csv_path = os.path.join(
+          self._context.output_folder,
+          file_utils.generate_filename(output_csv_path, suffix='-delta'))
+      fingerprints = AdGroupFingerprints(
+          self._get_state_path(ADGROUP_FINGERPRINTS_FILE_NAME),
+          self._context.storage_client).load()
+      write_full = self._context.campaign_delta_full
+    outputs = [(gae, output_csv_path)] if write_full else []
+    if delta_gae:
+      outputs.append((delta_gae, delta_csv_path))
 
     # Before generating the new file, get ad descriptions from the old csv if
     # it exists (If the ad description changes, the old one will be needed)
+    orig_desc = self._get_original_descriptions(output_csv_path,
+                                                gae.get_headers())
+    for editor, _ in outputs:
+      editor.set_original_description(orig_desc)
+
+    try:
+      if self._context.streaming:
+        # NOTE: rows are written into temporary files which replace
+        # the previous files only when all rows have been written
+        for editor, csv_path in outputs:
+          editor.start_csv(csv_path)
+      self._generate_campaign_data(gae if write_full else None, delta_gae,
+                                   fingerprints)
+      logging.debug('Writing campaign data CSV')
+      for editor, csv_path in outputs:
+        editor.generate_csv(csv_path)
+    finally:
+      # remove files of an incomplete generation (if any)
+      for editor, _ in outputs:
+        editor.close()
+
+    for _, csv_path in outputs:
+      logging.info(f'Campaign data CSV created in {csv_path}')
+      if self._context.gcs_bucket:
+        gcs_path = file_utils.upload_file_to_gcs(
+            csv_path,
+            self._context.gs_base_path,
+            storage_client=self._context.storage_client)
+        logging.debug(f'Campaign data CSV uploaded to GCS ({gcs_path})')
+    if fingerprints:
+      # NOTE: fingerprints are saved only when all files have been delivered,
+      # otherwise changes of the current run would be skipped by the next one
+      fingerprints.save()
+    # in delta mode only changes are to be imported into Ads Editor
+    return outputs[-1][1]
+
+  def _get_original_descriptions(self, output_csv_path: str,
+                                 headers: List[str]) -> Dict[Tuple, str]:
+    """Return ad descriptions (by campaign and ad group names) from a CSV
+    generated by the previous run (if any)"""
     csv_file = self._get_previous_data(output_csv_path)
-    if not csv_file is None:
-      with csv_file:
-        try:
-          reader = csv.DictReader(csv_file, gae.get_headers())
-          orig_desc = {
-              tuple((row[CAMP_NAME], row[ADGROUP_NAME])): row[AD_DESCRIPTION]
-              for row in reader
-              if row[AD_DESCRIPTION] != ''
-          }
-          gae.set_original_description(orig_desc)
-        except UnicodeError as e:
-          logging.info(
-              f'Failed to read CSV with previous data because of encoding mismatch: {e}'
-          )
-          # ignore encoding mismatch
+    if csv_file is None:
+      return {}
+    with csv_file:
+      try:
+        reader = csv.DictReader(csv_file, headers)
+        return {
+            tuple((row[CAMP_NAME], row[ADGROUP_NAME])): row[AD_DESCRIPTION]
+            for row in reader
+            if row[AD_DESCRIPTION] != ''
+        }
+      except UnicodeError as e:
+        # ignore encoding mismatch
+        logging.info(
+            f'Failed to read CSV with previous data because of encoding mismatch: {e}'
+        )
+        return {}
 
-    # If the campaign doesn't exist, create an empty one with default settings
+  def _get_campaign_names(self) -> Tuple[str, str]:
+    """Return names of product and category campaigns"""
     product_campaign_name = self._context.target.product_campaign_name
     if not product_campaign_name:
       product_campaign_name = PDSA_PRODUCT_CAMPAIGN_NAME
-    if self._create_product_campaign:
-      gae.add_campaign(product_campaign_name)
-
     category_campaign_name = self._context.target.category_campaign_name
     if not category_campaign_name:
       category_campaign_name = PDSA_CATEGORY_CAMPAIGN_NAME
-    if self._create_category_campaign:
-      gae.add_campaign(category_campaign_name)
+    return product_campaign_name, category_campaign_name
 
+  def _get_max_image_dimension(self) -> int:
     max_image_dimension = self._context.target.max_image_dimension
     if max_image_dimension is None:
-      max_image_dimension = 0
-    else:
-      max_image_dimension = int(max_image_dimension)
+      return 0
+    return int(max_image_dimension)
+
+  def _get_gcs_files_metadata(self) -> Dict[str, datetime]:
+    """Return a map from file name to datetime of last-modified timestamp
+    of all images on GCS (to optimize downloading)"""
+    if not self._context.images_on_gcs or self._context.images_dry_run:
+      return {}
+    gcs_files_metadata1 = file_utils.get_blobs_metadata(
+        self._context.gs_download_path, self._context.storage_client)
+    gcs_files_metadata2 = file_utils.get_blobs_metadata(
+        self._context.gs_images_path, self._context.storage_client)
+    return {
+        **gcs_files_metadata1,
+        **gcs_files_metadata2
+    }  # In 3.9 it can be changed to z=x|y
+
+  def _remove_unused_gcs_files(self, gcs_files_metadata: Dict[str, datetime]):
+    """Remove files on GCS that weren't used by products"""
+    if not self._context.images_on_gcs or self._context.images_dry_run:
+      return
+    file_utils.gcs_delete_folder_files(
+        lambda blob: gcs_files_metadata.get(os.path.basename(blob.name)) !=
+        True, self._context.gs_download_path, self._context.storage_client)
+    file_utils.gcs_delete_folder_files(
+        lambda blob: gcs_files_metadata.get(os.path.basename(blob.name)) !=
+        True, self._context.gs_images_path, self._context.storage_client)
+
+  def _generate_campaign_data(self, gae: GoogleAdsEditorMgr,
+                              delta_gae: GoogleAdsEditorMgr,
+                              fingerprints: AdGroupFingerprints):
+    """Add campaigns and ad groups of all products into the full editor
+    (`gae`) and/or the delta one (`delta_gae`, only changed ad groups)"""
+    editors = [editor for editor in (gae, delta_gae) if editor]
+    # If the campaign doesn't exist, create an empty one with default settings
+    product_campaign_name, category_campaign_name = self._get_campaign_names()
+    for editor in editors:
+      if self._create_product_campaign:
+        editor.add_campaign(product_campaign_name)
+      if self._create_category_campaign:
+        editor.add_campaign(category_campaign_name)
+
+    max_image_dimension = self._get_max_image_dimension()
     logging.info(
         f'[CampaignMgr] Using max_image_dimension: {max_image_dimension}')
     if self._context.images_dry_run:
       logging.warning(
           f'[CampaignMgr] using images_dry_run mode (images won\'t be downloaded and processed)'
       )
-    gcs_files_metadata = {
-    }  # a map from file name to datetime of last-modified timestamp
-    if self._context.images_on_gcs and not self._context.images_dry_run:
-      # fetch all blobs for images on GCS to optimize downloading
-      gcs_files_metadata1 = file_utils.get_blobs_metadata(
-          self._context.gs_download_path, self._context.storage_client)
-      gcs_files_metadata2 = file_utils.get_blobs_metadata(
-          self._context.gs_images_path, self._context.storage_client)
-      gcs_files_metadata = {
-          **gcs_files_metadata1,
-          **gcs_files_metadata2
-      }  # In 3.9 it can be changed to z=x|y
+    gcs_files_metadata = self._get_gcs_files_metadata()
+    # descriptions of all products are selected at once (it's much faster with pyarrow)
+    product_labels = [
+        label for label in self._products_by_label if is_product_label(label)
+    ]
+    ad_descriptions = dict(
+        zip(
+            product_labels, editors[0].get_ad_descriptions(
+                [self._products_by_label[label] for label in product_labels])))
+    for editor in editors:
+      editor.set_ad_descriptions(ad_descriptions)
     self._context.target.init_image_filter()
-
-    i = 0
-    for label in self._products_by_label:
-      i += 1
-      is_product_level = is_product_label(label)
-      campaign_name = product_campaign_name if is_product_level else category_campaign_name
-      product = self._products_by_label[label]
-      # If it's category level, use the label without 'PDSA_CATEGORY_'
-      adgroup_name = _get_product_adgroup_name(
-          product) if is_product_level else 'Ad group ' + label
-      # NOTE: adgroup name is important as we use it in adcustomizers as well
-      images = self._get_images(product, max_image_dimension,
-                                gcs_files_metadata)
-      gae.add_adgroup(campaign_name, adgroup_name, is_product_level, product,
-                      label, images)
-
-      max_rss = get_rss()
-      logging.info(f'{i:3d} - {label}, images: {len(images)}, mem: {max_rss:,}')
-      if max_rss > old_rss:
-        logging.info(
-            f'RSS increased to {max_rss:,} from {old_rss:,} after processing {images}'
-        )
-        old_rss = max_rss
-      if i % 100 == 0:
-        total, used, free = get_disk_usage(DiskUsageUnits.MB)
-        logging.info(
-            f'Temp partition usage: total={total}, used={used})'
-        )
-
-    if self._context.images_on_gcs and not self._context.images_dry_run:
-      # remove files on GCS that weren't used by products
-      file_utils.gcs_delete_folder_files(
-          lambda blob: gcs_files_metadata.get(os.path.basename(blob.name)) !=
-          True, self._context.gs_download_path, self._context.storage_client)
-      file_utils.gcs_delete_folder_files(
-          lambda blob: gcs_files_metadata.get(os.path.basename(blob.name)) !=
-          True, self._context.gs_images_path, self._context.storage_client)
-
-    logging.debug('Writing campaign data CSV')
-    gae.generate_csv(output_csv_path)
-    logging.info(f'Campaign data CSV created in {output_csv_path}')
-    if self._context.gcs_bucket:
-      gcs_path = file_utils.upload_file_to_gcs(
-          output_csv_path,
-          self._context.gs_base_path,
-          storage_client=self._context.storage_client)
-      logging.debug(f'Campaign data CSV uploaded to GCS ({gcs_path})')
-    return output_csv_path
+    if self._context.images_manifest or self._context.images_content_addressed:
+      # the manifest allows to skip images processed by previous runs,
+      # and to name images by hashes of their content
+      # (so the same image is processed and stored once for all products)
+      self._image_manifest = image_utils.ImageManifest(
+          self._get_state_path(IMAGE_MANIFEST_FILE_NAME),
+          self._context.storage_client).load()
+
+    delta_changed = self._generate_adgroups(
+        gae, delta_gae, fingerprints,
+        (product_campaign_name, category_campaign_name), max_image_dimension,
+        gcs_files_metadata)
+
+    if self._image_manifest:
+      # images that weren't used by products are removed as their files
+      self._image_manifest.save(prune=not self._context.images_dry_run)
+    if delta_gae:
+      removed = fingerprints.get_removed()
+      for campaign_name, adgroup_name in removed:
+        delta_gae.add_removed_adgroup(campaign_name, adgroup_name)
+      logging.info(f'[CampaignMgr] delta of campaign data: {delta_changed} '
+                   f'ad groups changed or added, {len(removed)} removed')
+
+    self._remove_unused_gcs_files(gcs_files_metadata)
+
+  def _generate_adgroups(self, gae: GoogleAdsEditorMgr,
+                         delta_gae: GoogleAdsEditorMgr,
+                         fingerprints: AdGroupFingerprints,
+                         campaign_names: Tuple[str, str],
+                         max_image_dimension: int,
+                         gcs_files_metadata: Dict[str, datetime]) -> int:
+    """Add ad groups (with images) of all product labels,
+    returns a number of changed ad groups (in delta mode)"""
+    old_rss = get_rss()
+    # Images of all products are downloaded on one pool of threads and
+    # resized on a pool of processes as soon as they are downloaded,
+    # we schedule images for next products (up to IMAGE_DOWNLOAD_LOOKAHEAD)
+    # while uploading images of the current one,
+    # ad groups are still added in the order of labels
+    labels = iter(self._products_by_label)
+    scheduled = collections.deque()
+    delta_changed = 0
+    lookahead = IMAGE_DOWNLOAD_LOOKAHEAD
+    if self._context.images_async_download:
+      # keep enough downloads scheduled to fill all requests in flight
+      lookahead = max(lookahead, self._context.async_download_limit)
+      logging.info('[CampaignMgr] using async mode for downloading images')
+    # images are uploaded to GCS in background,
+    # all uploads complete before unused files are removed from GCS
+    with self._create_download_scheduler() as scheduler, \
+         self._create_resize_pool() as resize_pool, \
+         self._create_uploader() as uploader:
+
+      def schedule_next():
+        label = next(labels, None)
+        if label is None:
+          return
+        scheduled.append(
+            self._schedule_adgroup(label, fingerprints, campaign_names,
+                                   max_image_dimension, gcs_files_metadata,
+                                   scheduler, resize_pool, uploader))
+
+      for _ in range(lookahead):
+        schedule_next()
+      i = 0
+      while scheduled:
+        (label, product, campaign_name, adgroup_name, fingerprint, changed,
+         images) = scheduled.popleft()
+        schedule_next()
+        i += 1
+        is_product_level = is_product_label(label)
+        # NOTE: adgroup name is important as we use it in adcustomizers as well
+        if changed:
+          images = self._process_images(
+              [future.result() for future in images], gcs_files_metadata,
+              uploader)
+        if gae:
+          gae.add_adgroup(campaign_name, adgroup_name, is_product_level,
+                          product, label, images)
+        if delta_gae:
+          if changed:
+            delta_gae.add_adgroup(campaign_name, adgroup_name,
+                                  is_product_level, product, label, images)
+            delta_changed += 1
+          fingerprints.set(label, campaign_name, adgroup_name, fingerprint,
+                           images)
+
+        max_rss = get_rss()
+        logging.info(f'{i:3d} - {label}, images: {len(images)}, mem: {max_rss:,}')
+        if max_rss > old_rss:
+          logging.info(
+              f'RSS increased to {max_rss:,} from {old_rss:,} after processing {images}'
+          )
+          old_rss = max_rss
+        if i % 100 == 0:
+          total, used, free = get_disk_usage(DiskUsageUnits.MB)
+          logging.info(
+              f'Temp partition usage: total={total}, used={used})'
+          )
+    return delta_changed
+
+  def _schedule_adgroup(self, label: str, fingerprints: AdGroupFingerprints,
+                        campaign_names: Tuple[str, str],
+                        max_image_dimension: int,
+                        gcs_files_metadata: Dict[str, datetime],
+                        scheduler: file_utils.DownloadScheduler,
+                        resize_pool: image_utils.ResizePool,
+                        uploader: file_utils.GcsUploader) -> Tuple:
+    """Schedule downloading of images of an ad group for a label
+    (unless the ad group hasn't changed since the previous run)"""
+    product = self._products_by_label[label]
+    is_product_level = is_product_label(label)
+    product_campaign_name, category_campaign_name = campaign_names
+    campaign_name = product_campaign_name if is_product_level else category_campaign_name
+    # If it's category level, use the label without 'PDSA_CATEGORY_'
+    adgroup_name = _get_product_adgroup_name(
+        product) if is_product_level else 'Ad group ' + label
+    fingerprint = images = None
+    if fingerprints:
+      fingerprint = self._get_adgroup_fingerprint(label, campaign_name,
+                                                  adgroup_name, product,
+                                                  max_image_dimension)
+      images = self._get_unchanged_images(fingerprints, label, fingerprint,
+                                          product, gcs_files_metadata)
+    changed = images is None
+    if changed:
+      images = self._schedule_images(product, scheduler, resize_pool,
+                                     max_image_dimension, gcs_files_metadata,
+                                     uploader)
+    return (label, product, campaign_name, adgroup_name, fingerprint, changed,
+            images)
+
+  def _get_state_path(self, file_name: str) -> str:
+    """Return a path of a file with state kept between runs (on GCS if images are)"""
+    if self._context.images_on_gcs:
+      return self._context.gs_base_path + file_name
+    return os.path.join(self._context.output_folder, file_name)
+
+  def _get_adgroup_fingerprint(self, label: str, campaign_name: str,
+                               adgroup_name: str, product: ProductInfo,
+                               max_image_dimension: int) -> str:
+    """Return a hash of all inputs of an ad group's rows (see `GoogleAdsEditorMgr.add_adgroup`),
+    i.e. the label, description inputs and urls of images"""
+    target = self._context.target
+    inputs = [
+        label, campaign_name, adgroup_name, product.title, product.description,
+        product.custom_description, target.ad_description_template,
+        target.adcustomizer_feed_name, target.product_description,
+        target.product_description_as_fallback_only,
+        target.category_ad_descriptions.get(label)
+        if target.category_ad_descriptions else None,
+        list(self._get_image_urls(product).values()), max_image_dimension,
+        self._context.images_content_addressed, self._context.image_folder
+    ]
+    return file_utils.get_content_hash(json.dumps(inputs).encode('utf-8'))
+
+  def _get_unchanged_images(self, fingerprints: AdGroupFingerprints,
+                            label: str, fingerprint: str, product: ProductInfo,
+                            files_metadata: Dict[str, datetime]) -> List[str]:
+    """Return images of an ad group if it's unchanged since the previous run
+    (and its images still exist), otherwise None"""
+    images = fingerprints.get_images(label, fingerprint)
+    if images is None or not self._outputs_exist(
+        [os.path.basename(path) for path in images], files_metadata):
+      return None
+    # NOTE: mark files as used (see `_process_images`) as well as their manifest entries
+    for local_path, uri in self._get_image_urls(product).items():
+      files_metadata[os.path.basename(local_path)] = True
+      if self._image_manifest:
+        self._image_manifest.get(uri)
+    for path in images:
+      files_metadata[os.path.basename(path)] = True
+    return images
 
   def _generate_filepath_for_image_url(self, uri, folder, product_id):
     parsed_uri = parse.urlparse(uri)
+    if self._context.images_content_addressed:
+      # the same url is downloaded once for all products
+      file_name = file_utils.get_content_hash(
+          uri.encode('utf-8')) + os.path.splitext(parsed_uri.path)[1]
+      return os.path.join(folder, file_name)
     file_name = os.path.basename(parsed_uri.path)
     local_path = os.path.join(folder, f'{product_id}_{file_name}')
     return local_path
@@ -588,12 +1128,10 @@ class CampaignMgr:
         result.append(url)
     return result
 
-  def _get_images(self, product, max_image_dimension: int,
-                  files_metadata: Dict[str, datetime]) -> List[str]:
-    """Download all product images, resize them and return a list of local relative paths"""
+  def _get_image_urls(self, product) -> Dict[str, str]:
+    """Return a map of local file paths to urls of product images (after filtering)"""
     download_folder = os.path.join(self._context.output_folder,
                                    self._context.image_folder + '-download')
-    image_rel_paths = []
     product_images = []
     if product.image_link:
       product_images.append(product.image_link)
@@ -603,89 +1141,333 @@ class CampaignMgr:
     product_images = list(dict.fromkeys(product_images))
     if self._context.target.image_filter_re:
       product_images = self._filter_images(self._context.target.image_filter_re, product_images)
+    # limit max number of images
+    if self._context.target.max_image_count and self._context.target.max_image_count > 0:
+      product_images = product_images[:self._context.target.max_image_count]
+    logging.debug(product_images)
     # generate a map of urls to local file names
-    product_images_to_urls = {
+    return {
         self._generate_filepath_for_image_url(uri, download_folder,
                                               product.offer_id): uri
         for uri in product_images
     }
-    # limit max number of images
-    if self._context.target.max_image_count and self._context.target.max_image_count > 0:
-      product_images = product_images[:self._context.target.max_image_count]
-    logging.debug(product_images)
 
+  def _create_download_scheduler(self) -> file_utils.DownloadScheduler:
+    if self._context.images_async_download:
+      return file_utils.AsyncDownloadScheduler(
+          self._context.async_download_limit,
+          self._context.download_pool_size)
+    return file_utils.DownloadScheduler(self._http_session,
+                                        self._context.download_workers,
+                                        self._context.download_pool_size)
+
+  def _create_uploader(self) -> file_utils.GcsUploader:
+    return file_utils.GcsUploader(self._context.storage_client,
+                                  self._context.upload_workers)
+
+  def _create_resize_pool(self) -> image_utils.ResizePool:
+    if self._context.images_dry_run:
+      return image_utils.ResizePool(0)
+    return image_utils.ResizePool(self._context.resize_workers)
+
+  def _get_output_names(self, image_name: str) -> List[str]:
+    return [
+        file_utils.generate_filename(image_name, suffix='_sq'),
+        file_utils.generate_filename(image_name, suffix='_ls')
+    ]
+
+  def _outputs_exist(self, outputs: List[str],
+                     files_metadata: Dict[str, datetime]) -> bool:
+    if self._context.images_on_gcs:
+      return all(files_metadata.get(name) for name in outputs)
+    output_folder = os.path.join(self._context.output_folder,
+                                 self._context.image_folder)
+    return all(
+        os.path.exists(os.path.join(output_folder, name)) for name in outputs)
+
+  def _is_processed(self,
+                    uri: str,
+                    image_name: str,
+                    max_image_dimension: int,
+                    files_metadata: Dict[str, datetime],
+                    content_hash: str = None) -> bool:
+    """Check via the manifest that resized images for an image are up-to-date"""
+    outputs = self._get_output_names(image_name)
+    return self._image_manifest.is_processed(
+        uri, image_utils.get_transform_params(max_image_dimension), outputs,
+        content_hash) and self._outputs_exist(outputs, files_metadata)
+
+  def _need_resize(self, image_name: str, status: int,
+                   files_metadata: Dict[str, datetime]) -> bool:
+    # NOTE: status is either 200 (file was downloaded) or 304 (cache hit),
+    # in the latter case we don't have a local copy, so we can't resize and
+    # update to gcs, so we assume that there're proper files on gcs already
+    # But to be sure we're checking it via files_metadata dictionary - it should contain both "_sq" and "_ls" files;
+    # If any of them is missing then optimization (of skipping downloading) disabled.
+    if self._context.images_dry_run:
+      return False
+    if self._context.images_on_gcs and status == 304:
+      return not all(
+          files_metadata.get(name)
+          for name in self._get_output_names(image_name))
+    return True
+
+  def _get_image_name(self, uri: str, local_image_path: str,
+                      content_hash: str) -> str:
+    """Return a file name to generate names of resized images from"""
+    if not self._context.images_content_addressed:
+      return os.path.basename(local_image_path)
+    return self._image_manifest.get_image_name(uri, content_hash)
+
+  def _get_content_hash(self, local_image_path: str, status: int) -> str:
+    if not self._image_manifest or self._context.images_dry_run:
+      return None
+    if status == 200 or os.path.exists(local_image_path):
+      return file_utils.get_file_hash(local_image_path)
+    return None
+
+  def _schedule_resize(
+      self, uri: str, download: concurrent.futures.Future,
+      validators: Dict[str, str], resize_pool: image_utils.ResizePool,
+      max_image_dimension: int,
+      files_metadata: Dict[str, datetime]) -> concurrent.futures.Future:
+    """Schedule resizing of an image as soon as it's downloaded, returns a future
+    with a tuple of local file path, http status and square/landscape images paths"""
+    output_folder = os.path.join(self._context.output_folder,
+                                 self._context.image_folder)
+    result = concurrent.futures.Future()
+
+    def on_resized(local_image_path: str, status: int, content_hash: str,
+                   skipped: bool, resized: concurrent.futures.Future):
+      try:
+        image_paths = resized.result()
+        if self._image_manifest and content_hash and not skipped:
+          self._image_manifest.set_processed(
+              uri, content_hash,
+              image_utils.get_transform_params(max_image_dimension),
+              [os.path.basename(path) for path in image_paths], validators)
+        result.set_result((local_image_path, status, image_paths))
+      except BaseException as e:
+        result.set_exception(e)
+
+    def on_downloaded(download: concurrent.futures.Future):
+      try:
+        local_image_path, status = download.result()
+        content_hash = self._get_content_hash(local_image_path, status)
+        image_name = self._get_image_name(uri, local_image_path, content_hash)
+        if self._image_manifest:
+          # resized images are up-to-date if the image wasn't modified
+          # or its content is the same (then there's nothing to upload either)
+          skip = self._context.images_dry_run or self._is_processed(
+              uri, image_name, max_image_dimension, files_metadata,
+              content_hash)
+          if skip and status == 200:
+            status = 304
+        else:
+          skip = not self._need_resize(image_name, status, files_metadata)
+        resized = resize_pool.submit(local_image_path,
+                                     output_folder,
+                                     max_image_dimension,
+                                     dry_run=skip,
+                                     output_name=image_name)
+        resized.add_done_callback(lambda f: on_resized(
+            local_image_path, status, content_hash, skip, f))
+      except BaseException as e:
+        result.set_exception(e)
+
+    download.add_done_callback(on_downloaded)
+    return result
+
+  def _images_in_memory(self) -> bool:
+    return self._context.images_in_memory and self._context.images_on_gcs and \
+        not self._context.images_dry_run
+
+  def _schedule_transform(
+      self, uri: str, local_image_path: str,
+      scheduler: file_utils.DownloadScheduler, last_modified: datetime,
+      validators: Dict[str, str], resize_pool: image_utils.ResizePool,
+      uploader: file_utils.GcsUploader, max_image_dimension: int,
+      files_metadata: Dict[str, datetime]) -> concurrent.futures.Future:
+    """Schedule downloading of an image into memory, its transformation and uploading
+    of results to GCS, returns a future with the same tuple as `_schedule_resize`
+    (local file path is used only for naming, no local files are created)"""
+    output_folder = os.path.join(self._context.output_folder,
+                                 self._context.image_folder)
+    result = concurrent.futures.Future()
+
+    def on_uploaded(status: int, uploaded: concurrent.futures.Future):
+      try:
+        result.set_result((local_image_path, status, uploaded.result()))
+      except BaseException as e:
+        result.set_exception(e)
+
+    def on_transformed(image_name: str, content_hash: str,
+                       image_paths: List[str],
+                       uploaded: concurrent.futures.Future,
+                       transformed: concurrent.futures.Future):
+      try:
+        for content, image_path in zip(transformed.result(), image_paths):
+          # NOTE: the uploader limits number of pending uploads (and their contents in memory)
+          uploader.submit_content(content, os.path.basename(image_path),
+                                  self._context.gs_images_path)
+        if self._image_manifest and content_hash:
+          self._image_manifest.set_processed(
+              uri, content_hash,
+              image_utils.get_transform_params(max_image_dimension),
+              [os.path.basename(path) for path in image_paths], validators)
+        uploaded.set_result(image_paths)
+      except BaseException as e:
+        uploaded.set_exception(e)
+
+    def on_downloaded(download: concurrent.futures.Future):
+      try:
+        content, status = download.result()
+        content_hash = None
+        if content and self._image_manifest:
+          content_hash = file_utils.get_content_hash(content)
+        image_name = self._get_image_name(uri, local_image_path, content_hash)
+        image_paths = [
+            os.path.join(output_folder, name)
+            for name in self._get_output_names(image_name)
+        ]
+        if self._image_manifest:
+          skip = self._is_processed(uri, image_name, max_image_dimension,
+                                    files_metadata, content_hash)
+        else:
+          skip = not self._need_resize(image_name, status, files_metadata)
+        if skip:
+          result.set_result(
+              (local_image_path, 304 if status == 200 else status, image_paths))
+          return
+        if content is None:
+          # the image wasn't modified but its resized images are missing,
+          # so it's downloaded unconditionally (otherwise it'd be 304 again)
+          scheduler.fetch(uri, lastModified=None,
+                          validators=None).add_done_callback(on_downloaded)
+          return
+        with self._lock:
+          uploaded = self._transformed.get(image_name)
+          transform = not uploaded
+          if transform:
+            uploaded = concurrent.futures.Future()
+            self._transformed[image_name] = uploaded
+        if transform:
+          if status == 200:
+            uploader.submit_content(content,
+                                    os.path.basename(local_image_path),
+                                    self._context.gs_download_path)
+          resize_pool.submit_transform(
+              content, max_image_dimension,
+              name=image_name).add_done_callback(lambda f: on_transformed(
+                  image_name, content_hash, image_paths, uploaded, f))
+        uploaded.add_done_callback(lambda f: on_uploaded(status, f))
+      except BaseException as e:
+        result.set_exception(e)
+
+    scheduler.fetch(
+        uri,
+        # NOTE: see _schedule_images regarding files processed earlier
+        dry_run=last_modified == True,
+        lastModified=last_modified,
+        validators=validators).add_done_callback(on_downloaded)
+    return result
+
+  def _schedule_images(
+      self,
+      product,
+      scheduler: file_utils.DownloadScheduler,
+      resize_pool: image_utils.ResizePool,
+      max_image_dimension: int,
+      files_metadata: Dict[str, datetime],
+      uploader: file_utils.GcsUploader = None
+  ) -> List[concurrent.futures.Future]:
+    """Schedule downloading and resizing of all product images, returns a list of futures
+    with tuples of local file path, http status and square/landscape images paths"""
+    product_images_to_urls = self._get_image_urls(product)
+    in_memory = self._images_in_memory()
+    if product_images_to_urls and not in_memory:
+      os.makedirs(os.path.dirname(next(iter(product_images_to_urls))),
+                  exist_ok=True)
     dry_run = self._context.images_dry_run
+    futures = []
+    for local_path, uri in product_images_to_urls.items():
+      last_modified = files_metadata.get(os.path.basename(local_path))
+      validators = None
+      if self._image_manifest and last_modified != True:
+        # requests are conditional on ETag/Last-Modified received from the server
+        # but only if resized images are up-to-date, otherwise the image has to be downloaded
+        last_modified = None
+        validators = {}
+        image_name = self._get_image_name(uri, local_path, None)
+        if self._is_processed(uri, image_name, max_image_dimension,
+                              files_metadata):
+          entry = self._image_manifest.get(uri)
+          validators['etag'] = entry.get('etag')
+          validators['last_modified'] = entry.get('last_modified')
+      if in_memory:
+        futures.append(
+            self._schedule_transform(uri, local_path, scheduler, last_modified,
+                                     validators, resize_pool, uploader,
+                                     max_image_dimension, files_metadata))
+        continue
+      download = scheduler.submit(
+          uri,
+          local_path,
+          # NOTE: we use files_metadata as output as well replacing datetime with True for processed files
+          # so a file can be encountered a second time, in such a case we'll ignore it
+          dry_run=dry_run or last_modified == True,
+          lastModified=last_modified,
+          validators=validators)
+      futures.append(
+          self._schedule_resize(uri, download, validators, resize_pool,
+                                max_image_dimension, files_metadata))
+    return futures
+
+  def _get_images(self, product, max_image_dimension: int,
+                  files_metadata: Dict[str, datetime]) -> List[str]:
+    """Download all product images, resize them and return a list of local relative paths"""
     ts_start = datetime.now()
-    # now product_images is a list of product images' urls, let's download them
-    os.makedirs(download_folder, exist_ok=True)
-    if len(product_images_to_urls) == 0:
-      return image_rel_paths
-    if len(product_images_to_urls) == 1:
-      # no need for parallelization if only one image
-      item = list(product_images_to_urls.items())[0]
-      product_images = [
-          file_utils.download_file(item[1],
-                                   item[0],
-                                   dry_run=dry_run or files_metadata.get(
-                                       os.path.basename(item[0])) == True,
-                                   lastModified=files_metadata.get(
-                                       os.path.basename(item[0])))
+    with self._create_download_scheduler() as scheduler, \
+         image_utils.ResizePool(0) as resize_pool, \
+         self._create_uploader() as uploader:
+      images = [
+          future.result() for future in self._schedule_images(
+              product, scheduler, resize_pool, max_image_dimension,
+              files_metadata, uploader)
       ]
-    else:
-      # download all images in parallel
-      with concurrent.futures.ThreadPoolExecutor() as exector:
-        product_images = exector.map(
-            lambda item: file_utils.download_file(
-                item[1],
-                item[0],
-                # NOTE: we use files_metadata as output as well replacing datetime with True for processed files
-                # so a file can be encountered a second time, in such a case we'll ignore it
-                dry_run=dry_run or files_metadata.get(os.path.basename(item[0])) == True,
-                lastModified=files_metadata.get(os.path.basename(item[0]))),
-            product_images_to_urls.items())
-
-    elapsed = datetime.now() - ts_start
-    logging.debug(f'Images downloaded, elapsed {elapsed}')
-    output_folder = os.path.join(self._context.output_folder,
-                                 self._context.image_folder)
-    # now product_images is a list (iterable) of product images' local file paths
-    # for each image we'll create two: square and landscape
-    for local_image_path, status in product_images:
-      # NOTE: status is either 200 (file was downloaded) or 304 (cache hit),
-      # in the latter case we don't have a local copy, so we can't resize and
-      # update to gcs, so we assume that there're proper files on gcs already
-      # But to be sure we're checking it via files_metadata dictionary - it should contain both "_sq" and "_ls" files;
-      # If any of them is missing then optimization (of skipping downloading) disabled.
-      dry_run_ = dry_run or self._context.images_on_gcs and status == 304
-      if not dry_run and self._context.images_on_gcs and status == 304:
-        if not files_metadata.get(file_utils.generate_filename(local_image_path, suffix='_sq')) or \
-           not files_metadata.get(file_utils.generate_filename(local_image_path, suffix='_ls')):
-          dry_run_ = False
-      two_image_file_paths = image_utils.resize(local_image_path,
-                                                output_folder,
-                                                max_image_dimension,
-                                                dry_run=dry_run_)
-      if self._context.images_on_gcs:
-        if status == 200:
-          # we have three image files (original in -download, and two sq_/ls_ in images), upload them to GCS
-          file_utils.upload_file_to_gcs(
-              local_image_path,
-              self._context.gs_download_path,
-              storage_client=self._context.storage_client)
-          file_utils.upload_file_to_gcs(
-              two_image_file_paths[0],
-              self._context.gs_images_path,
-              storage_client=self._context.storage_client)
-          file_utils.upload_file_to_gcs(
-              two_image_file_paths[1],
-              self._context.gs_images_path,
-              storage_client=self._context.storage_client)
-        if os.path.exists(local_image_path):
-          os.remove(local_image_path)
-        if os.path.exists(two_image_file_paths[0]):
-          os.remove(two_image_file_paths[0])
-        if os.path.exists(two_image_file_paths[1]):
-          os.remove(two_image_file_paths[1])
+      elapsed = datetime.now() - ts_start
+      logging.debug(f'Images downloaded and resized, elapsed {elapsed}')
+      return self._process_images(images, files_metadata, uploader)
+
+  def _process_images(self, images: List[Tuple[str, int, List[str]]],
+                      files_metadata: Dict[str, datetime],
+                      uploader: file_utils.GcsUploader) -> List[str]:
+    """Schedule uploading of resized product images (if needed) and return a list of local relative paths"""
+    image_rel_paths = []
+    # images is a list of product images' local file paths (with http statuses)
+    # and two images for each of them: square and landscape
+    for local_image_path, status, two_image_file_paths in images:
+      # the same image can be shared by several labels (e.g. a product and a category),
+      # or by several urls (for content-addressed images),
+      # if it has already been processed during this run we only need its paths
+      def processed(file_path: str) -> bool:
+        return files_metadata.get(os.path.basename(file_path)) == True
+
+      if self._context.images_on_gcs and not self._images_in_memory():
+        # we have three image files (original in -download, and two sq_/ls_ in images)
+        for file_path, gcs_path in ((local_image_path,
+                                     self._context.gs_download_path),
+                                    (two_image_file_paths[0],
+                                     self._context.gs_images_path),
+                                    (two_image_file_paths[1],
+                                     self._context.gs_images_path)):
+          if processed(file_path):
+            # the file has been uploaded (or is being uploaded) and removed by the uploader
+            continue
+          if status == 200:
+            uploader.submit(file_path, gcs_path, remove=True)
+          elif os.path.exists(file_path):
+            os.remove(file_path)
 
       # NOTE: mark files as used, it'll be used later to remove unneeded files on GCS
       files_metadata[os.path.basename(local_image_path)] = True
@@ -17,7 +17,7 @@ from dataclasses import dataclass
 from google.auth import credentials
 from google.cloud import storage
 from app.data_gateway import DataGateway
-from common import config_utils, bigquery_utils
+from common import config_utils, bigquery_utils, file_utils
 
 
 @dataclass
@@ -31,6 +31,36 @@ class ContextOptions:
   """If True then images won't be downloaded and resized/padded (but image extensions still will be created)"""
   images_on_gcs: bool = False
   """True to keep images (downloaded and resized/padded) on GCS"""
+  download_pool_size: int = file_utils.HTTP_POOL_SIZE
+  """Number of keep-alive connections (and simultaneous downloads) per host for downloading images"""
+  download_workers: int = file_utils.DOWNLOAD_WORKERS
+  """Total number of threads for downloading images"""
+  images_async_download: bool = False
+  """True to download images asynchronously (with httpx) keeping many requests in flight"""
+  async_download_limit: int = file_utils.ASYNC_DOWNLOAD_LIMIT
+  """Number of simultaneous requests for downloading images in async mode"""
+  resize_workers: int = None
+  """Number of processes for resizing images (by default number of CPUs), 0 to resize in the main process"""
+  upload_workers: int = file_utils.GCS_UPLOAD_WORKERS
+  """Number of threads for uploading images to GCS"""
+  images_content_addressed: bool = False
+  """True to name images by hashes of their content (so images shared by many products are processed and stored once)"""
+  images_in_memory: bool = False
+  """True to process images in memory and upload them to GCS without local temporary files (only with images on GCS)"""
+  images_manifest: bool = False
+  """True to keep a manifest of processed images to skip unchanged images on next runs (always used for content-addressed images)"""
+  streaming: bool = False
+  """True to generate campaign data and adcustomizers incrementally without keeping all products in memory"""
+  query_cache: bool = False
+  """True to cache results of queries till data in BigQuery changes"""
+  query_cache_folder: str = None
+  """A folder to keep cached results of queries on disk (requires pyarrow)"""
+  bq_storage_api: bool = False
+  """True to fetch products via BigQuery Storage Read API (as Arrow record batches) instead of paging rows via REST API"""
+  campaign_delta: bool = False
+  """True to generate campaign data only for ad groups changed, added or removed since the previous run (in a separate file)"""
+  campaign_delta_full: bool = False
+  """True to also generate the full campaign data file in delta mode (unchanged ad groups are generated without processing their images)"""
 
 
 class Context:
@@ -45,11 +75,27 @@ class Context:
     self.image_folder = options.image_folder or 'images'
     if target:
       self.output_folder = os.path.join(self.output_folder, target.name)
-    self.data_gateway = DataGateway(config, credentials)
+    self.data_gateway = DataGateway(config,
+                                    credentials,
+                                    cache=options.query_cache,
+                                    cache_folder=options.query_cache_folder)
     self.storage_client = storage.Client(project=config.project_id,
                                          credentials=credentials)
+    self.streaming = options.streaming
     self.images_dry_run = options.images_dry_run
     self.images_on_gcs = True
+    self.download_pool_size = options.download_pool_size
+    self.download_workers = options.download_workers
+    self.images_async_download = options.images_async_download
+    self.async_download_limit = options.async_download_limit
+    self.resize_workers = options.resize_workers
+    self.upload_workers = options.upload_workers
+    self.images_content_addressed = options.images_content_addressed
+    self.images_manifest = options.images_manifest
+    self.images_in_memory = options.images_in_memory
+    self.bq_storage_api = options.bq_storage_api
+    self.campaign_delta = options.campaign_delta
+    self.campaign_delta_full = options.campaign_delta_full
     self.gcs_bucket = (config.project_id + '-pdsa') if config.project_id else None
     self.gs_base_path = f'gs://{self.gcs_bucket}/'
     if target:
@@ -12,23 +12,101 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, List
+from typing import Dict, List, Tuple
+from datetime import datetime
+import json
+import re
+import threading
 from google.auth import credentials
 from google.cloud import bigquery
-from common import config_utils, bigquery_utils
+from common import config_utils, bigquery_utils, file_utils
 import logging
 
+# Text fields of products to search in (see `DataGateway.load_products`)
+PRODUCTS_SEARCH_FIELDS = [
+    'offer_id', 'title', 'description', 'pdsa_custom_labels'
+]
+PRODUCTS_COLUMN_RE = re.compile('^[A-Za-z_][A-Za-z0-9_]*$')
+# Number of seconds a version of data (see `DataGateway._get_data_version`) is reused
+DATA_VERSION_TTL = 60
+
+# query result caches shared by all DataGateway instances (by cache folders)
+_query_caches: Dict[str, bigquery_utils.QueryResultCache] = {}
+# versions of data by targets with time they were fetched
+_data_versions: Dict[str, Tuple[str, datetime]] = {}
+_cache_lock = threading.Lock()
+
 
 class DataGateway:
   """Object for loading and udpating data in Database
   (which is BigQuery but it should be hidden from consumers)"""
 
-  def __init__(self, config: config_utils.Config,
-               credentials: credentials.Credentials) -> None:
+  def __init__(self,
+               config: config_utils.Config,
+               credentials: credentials.Credentials,
+               *,
+               cache: bool = False,
+               cache_folder: str = None) -> None:
+    """Initialise new instance of DataGateway.
+
+    Args:
+      config: configuration
+      credentials: credentials for BigQuery
+      cache: True to cache results of queries till data in BigQuery changes
+             (see `invalidate_cache`), the cache is shared by all instances
+      cache_folder: a folder to keep cached results on disk as well (requires pyarrow)
+    """
     self.bq_client = bigquery_utils.CloudBigQueryUtils(config.project_id,
                                                        credentials,
                                                        config.dataset_location)
     self.config = config
+    self._cache = None
+    if cache or cache_folder:
+      with _cache_lock:
+        self._cache = _query_caches.get(cache_folder or '')
+        if not self._cache:
+          self._cache = bigquery_utils.QueryResultCache(cache_folder)
+          _query_caches[cache_folder or ''] = self._cache
+
+  @staticmethod
+  def invalidate_cache(target: str = None):
+    """Remove cached results of queries (for all targets or for a target)"""
+    with _cache_lock:
+      caches = list(_query_caches.values())
+      if target:
+        _data_versions.pop(target, None)
+      else:
+        _data_versions.clear()
+    for cache in caches:
+      cache.clear(target)
+
+  def _get_data_version(self, target: str) -> str:
+    """Return a version of data of a target, it changes when a Data Transfer
+    adds a new partition of products or custom descriptions are updated"""
+    with _cache_lock:
+      prev_version, fetched = _data_versions.get(target, (None, None))
+    if prev_version and (datetime.now() -
+                         fetched).total_seconds() < DATA_VERSION_TTL:
+      return prev_version
+    # NOTE: tables' metadata is fetched without running queries
+    products_table = f'Products_{self.config.merchant_id}'
+    if self.config.materialize_products:
+      products_table = self._get_products_table(target)
+    version = ';'.join(
+        str(self.bq_client.get_table_modified(self.config.dataset_id, table))
+        for table in (products_table, f'Ads_Preview_Products_{target}'))
+    if prev_version and prev_version != version:
+      # results for the previous version won't be used anymore
+      DataGateway.invalidate_cache(target)
+    with _cache_lock:
+      _data_versions[target] = (version, datetime.now())
+    return version
+
+  def _get_products_table(self, target: str) -> str:
+    """Return a name of view or table with filtered products of a target"""
+    if self.config.materialize_products:
+      return f'Products_Snapshot_{target}'
+    return f'Products_Filtered_{target}'
 
   def _check_target(self, target: str):
     if not target:
@@ -41,13 +119,75 @@ class DataGateway:
   def execute_sql_script(self,
                          script_name: str,
                          target: str,
-                         params: Dict[str, str] = None):
+                         params: Dict[str, str] = None,
+                         sql_params: List[bigquery.ScalarQueryParameter] = None,
+                         page_size: int = None,
+                         storage_api: bool = False,
+                         use_cache: bool = True):
     self._check_target(target)
     if not params:
       params = {}
     params['target'] = target
-    return self.bq_client.execute_scripts(script_name, self.config.dataset_id,
-                                          params)
+    params['products_table'] = self._get_products_table(target)
+    # NOTE: results fetched by pages or via Storage API are too big for caching
+    cache_key = None
+    if self._cache and use_cache and not page_size and not storage_api:
+      cache_key = file_utils.get_content_hash(
+          json.dumps([
+              self._get_data_version(target), script_name, params,
+              [p.to_api_repr() for p in sql_params or []]
+          ],
+                     sort_keys=True).encode('utf-8'))
+      rows = self._cache.get(target, cache_key)
+      if rows is not None:
+        logging.debug(f'Using cached results of {script_name} (target: {target})')
+        return rows
+    rows = self.bq_client.execute_scripts(script_name,
+                                          self.config.dataset_id,
+                                          params,
+                                          sql_params,
+                                          page_size=page_size,
+                                          storage_api=storage_api)
+    if cache_key:
+      rows = self._cache.put(target, cache_key, rows)
+    return rows
+
+  def _get_products_filter(
+      self, *, in_stock_only: bool, long_description: bool,
+      category_only: bool, product_only: bool, search: str
+  ) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+    """Return a WHERE clause and its query parameters for product queries"""
+    conditions = []
+    sql_params = []
+    if in_stock_only:
+      conditions.append('p.in_stock = 1')
+    if long_description:
+      conditions.append(
+          'length(p.title) > 90 and length(p.description) > 90 and ad.ad_description1 is null'
+      )
+    if category_only:
+      conditions.append("pdsa_custom_labels not like 'product_%'")
+    elif product_only:
+      conditions.append("pdsa_custom_labels like 'product_%'")
+    if search:
+      # case-insensitive search of a substring in text fields
+      conditions.append('(' + ' OR '.join(
+          f'strpos(lower(p.{field}), @search) > 0'
+          for field in PRODUCTS_SEARCH_FIELDS) + ')')
+      sql_params.append(
+          bigquery.ScalarQueryParameter('search', 'STRING', search.lower()))
+    where_clause = ''
+    if conditions:
+      where_clause = 'WHERE ' + ' AND '.join(conditions)
+    return where_clause, sql_params
+
+  def _get_products_column(self, column: str) -> str:
+    """Return an SQL expression for a product column"""
+    if not PRODUCTS_COLUMN_RE.match(column):
+      raise ValueError(f'Invalid product column name: {column}')
+    if column == 'custom_description':
+      return 'ad.ad_description1'
+    return f'p.`{column}`'
 
   def load_products(self,
                     target: str,
@@ -56,37 +196,96 @@ class DataGateway:
                     long_description: bool = False,
                     category_only: bool = False,
                     product_only: bool = False,
-                    maxrows: int = 0):
+                    maxrows: int = 0,
+                    page_size: int = None,
+                    storage_api: bool = False,
+                    use_cache: bool = True,
+                    columns: List[str] = None,
+                    search: str = None,
+                    order_by: str = None,
+                    descending: bool = False,
+                    offset: int = 0):
+    """Load products of a target.
+
+    Args:
+      maxrows: maximum number of products to return (0 - all products),
+               with `offset` it allows to fetch products by pages
+      use_cache: False to always query products (for consumers iterating
+                 over all products, they shouldn't be kept in memory)
+      columns: names of columns to return (by default all columns)
+      search: a substring to search (case-insensitively) in text fields
+      order_by: a name of column to sort products by
+      descending: True to sort in descending order
+      offset: number of products to skip
+    """
     self._check_target(target)
-    where_clause = ''
-    if in_stock_only:
-      where_clause = 'WHERE p.in_stock = 1'
-    if long_description:
-      if where_clause:
-        where_clause += ' AND '
-      else:
-        where_clause = 'WHERE '
-      where_clause += 'length(p.title) > 90 and length(p.description) > 90 and ad.ad_description1 is null'
-    if category_only:
-      if where_clause:
-        where_clause += ' AND '
-      else:
-        where_clause = 'WHERE '
-      where_clause += "pdsa_custom_labels not like 'product_%'"
-    elif product_only:
-      if where_clause:
-        where_clause += ' AND '
-      else:
-        where_clause = 'WHERE '
-      where_clause += "pdsa_custom_labels like 'product_%'"
-    if maxrows > 0:
-      where_clause += '\nLIMIT ' + str(maxrows)
-    params = {"WHERE_CLAUSE": where_clause}
+    where_clause, sql_params = self._get_products_filter(
+        in_stock_only=in_stock_only,
+        long_description=long_description,
+        category_only=category_only,
+        product_only=product_only,
+        search=search)
+    if columns:
+      select_list = ', '.join(
+          self._get_products_column(column) +
+          (' as custom_description' if column == 'custom_description' else '')
+          for column in columns)
+    else:
+      select_list = 'ad.ad_description1 as custom_description, p.*'
+    order_by_list = []
+    if order_by:
+      order_by_list.append(
+          self._get_products_column(order_by) + (' DESC' if descending else ''))
+    if maxrows > 0 or offset > 0:
+      # without ordering BigQuery can return rows in any order, so pages
+      # should be ordered (by product id for products with equal values)
+      order_by_list.append('p.product_id')
+    if order_by_list:
+      where_clause += '\nORDER BY ' + ', '.join(order_by_list)
+    # NOTE: limits are passed as query parameters, so all pages have the same SQL
+    if maxrows > 0 or offset > 0:
+      # BigQuery doesn't support OFFSET without LIMIT
+      where_clause += '\nLIMIT @maxrows'
+      sql_params.append(
+          bigquery.ScalarQueryParameter('maxrows', 'INT64',
+                                        maxrows if maxrows > 0 else 2**63 - 1))
+    if offset > 0:
+      where_clause += '\nOFFSET @offset'
+      sql_params.append(
+          bigquery.ScalarQueryParameter('offset', 'INT64', offset))
+    params = {"COLUMNS": select_list, "WHERE_CLAUSE": where_clause}
     logging.debug(f'Fetching products for target {target}, where: {where_clause}')
-    products = self.execute_sql_script('get-products.sql', target, params)
+    products = self.execute_sql_script('get-products.sql',
+                                       target,
+                                       params,
+                                       sql_params,
+                                       page_size=page_size,
+                                       storage_api=storage_api,
+                                       use_cache=use_cache)
     logging.info(f'Fetched {products.total_rows} products (target: {target})')
     return products
 
+  def count_products(self,
+                     target: str,
+                     *,
+                     in_stock_only: bool = False,
+                     long_description: bool = False,
+                     category_only: bool = False,
+                     product_only: bool = False,
+                     search: str = None) -> int:
+    """Return number of products matching the same filters as in `load_products`"""
+    self._check_target(target)
+    where_clause, sql_params = self._get_products_filter(
+        in_stock_only=in_stock_only,
+        long_description=long_description,
+        category_only=category_only,
+        product_only=product_only,
+        search=search)
+    params = {"COLUMNS": 'count(*) as count', "WHERE_CLAUSE": where_clause}
+    result = self.execute_sql_script('get-products.sql', target, params,
+                                     sql_params)
+    return next(iter(result))[0]
+
   def load_labels(self,
                   target: str, *,
                   category_only: bool = False,
@@ -117,10 +316,49 @@ class DataGateway:
     data = self.execute_sql_script('get-page-feed.sql', target)
     return data
 
+  def refresh_products_snapshot(self, target: str, only_stale: bool = False):
+    """Recreate a table with filtered products of a target from the view
+    (used with `Config.materialize_products` after Data Transfer completions).
+
+    Args:
+      only_stale: True to recreate the table only if it doesn't exist
+                  or the view has been recreated after it
+    Returns:
+      True if the table has been recreated
+    """
+    self._check_target(target)
+    if only_stale:
+      snapshot_modified = self.bq_client.get_table_modified(
+          self.config.dataset_id, f'Products_Snapshot_{target}')
+      view_modified = self.bq_client.get_table_modified(
+          self.config.dataset_id, f'Products_Filtered_{target}')
+      if snapshot_modified and (not view_modified or
+                                snapshot_modified >= view_modified):
+        return False
+    logging.info(f'Refreshing products snapshot (target: {target})')
+    self.bq_client.execute_scripts('create-products-snapshot.sql',
+                                   self.config.dataset_id, {'target': target})
+    if self._cache:
+      DataGateway.invalidate_cache(target)
+    return True
+
   def update_product(self, target: str, product_id: str, data):
+    return self.update_products(target,
+                                [(product_id, data['custom_description'])])
+
+  def update_products(self, target: str, updates: List[Tuple[str, str]]):
+    """Update custom descriptions of many products with one query.
+    Args:
+      updates: a list of pairs of product id and its custom description
+               (an empty description removes the custom one)
+    """
     self._check_target(target)
+    # NOTE: MERGE fails if a product matches several rows, so the last update wins
+    updates = dict(updates)
+    if not updates:
+      return None
     sql = """MERGE `{project_id}.{dataset}.Ads_Preview_Products_{target}` T
-USING (select @product_id as product_id, @custom_description as custom_description) S
+USING (select product_id, custom_description from UNNEST(@updates)) S
 ON T.product_id = S.product_id
 WHEN MATCHED AND S.custom_description IS NULL OR Length(S.custom_description) = 0 THEN
   DELETE
@@ -130,10 +368,20 @@ WHEN NOT MATCHED THEN
   INSERT (product_id, ad_description1) VALUES (product_id, custom_description)
     """
     query_parameters = [
-        bigquery.ScalarQueryParameter("product_id", "STRING", product_id),
-        bigquery.ScalarQueryParameter("custom_description", "STRING",
-                                      data['custom_description']),
+        bigquery.ArrayQueryParameter('updates', 'STRUCT', [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter('product_id', 'STRING',
+                                              product_id),
+                bigquery.ScalarQueryParameter('custom_description', 'STRING',
+                                              custom_description))
+            for product_id, custom_description in updates.items()
+        ])
     ]
-    params = {'target': target, 'product_id': product_id}
-    return self.bq_client.execute_query(sql, self.config.dataset_id, params,
-                                        query_parameters)
+    params = {'target': target}
+    logging.info(f'Updating {len(updates)} products (target: {target})')
+    result = self.bq_client.execute_query(sql, self.config.dataset_id, params,
+                                          query_parameters)
+    if self._cache:
+      DataGateway.invalidate_cache(target)
+    return result
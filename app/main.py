@@ -23,6 +23,7 @@ from pprint import pprint
 from common import auth, config_utils, sheets_utils, file_utils
 from app.context import Context, ContextOptions
 from app import campaign_mgr
+from install import cloud_env_setup
 
 logging.basicConfig(
     format=
@@ -35,7 +36,18 @@ logging.getLogger('google.api_core').setLevel(logging.WARNING)
 def validate_config(context: Context):
 
   def _validate_target(target: config_utils.ConfigTarget, errors: List):
-    errors.extend(target.validate(generation=True))
+    adcustomizer_fields = None
+    if target.ad_description_template:
+      # fields used in the template should exist in adcustomizers
+      # (they're generated from the products schema)
+      products = context.data_gateway.load_products(target.name,
+                                                    maxrows=1,
+                                                    use_cache=False)
+      adcustomizer_fields = campaign_mgr.AdCustomizerGenerator(
+          products).get_fields()
+    errors.extend(
+        target.validate(generation=True,
+                        adcustomizer_fields=adcustomizer_fields))
     context.target = target
     category_labels = context.data_gateway.load_labels(target.name,
                                                        category_only=True)
@@ -115,6 +127,15 @@ def create_or_update_page_feed(generate_csv: bool, context: Context):
   return csv_file_name
 
 
+def _load_products(context: Context):
+  # in streaming mode products are fetched by pages while they're being processed
+  return context.data_gateway.load_products(
+      context.target.name,
+      page_size=campaign_mgr.PRODUCTS_PAGE_SIZE if context.streaming else None,
+      storage_api=context.bq_storage_api,
+      use_cache=False)
+
+
 def create_or_update_adcustomizers(generate_csv: bool, context: Context) -> str:
   """Generate ad customizers (in Google Spreadsheet and CSV file)
     Args:
@@ -124,7 +145,7 @@ def create_or_update_adcustomizers(generate_csv: bool, context: Context) -> str:
   """
   ts_start = datetime.now()
   logging.info(f'Starting generating adcustomizers')
-  products = context.data_gateway.load_products(context.target.name)
+  products = _load_products(context)
 
   mgr = campaign_mgr.CampaignMgr(context, products)
   csv_file_name = mgr.generate_adcustomizers(generate_csv)
@@ -134,6 +155,26 @@ def create_or_update_adcustomizers(generate_csv: bool, context: Context) -> str:
   return csv_file_name
 
 
+def update_products_data(context: Context,
+                         targets: List[config_utils.ConfigTarget],
+                         only_stale: bool = False):
+  """Switch views of products of targets to the latest partition of
+  GMC Data Transfer (and refresh products snapshots with
+  `Config.materialize_products`).
+
+  Args:
+    only_stale: True to update only views and snapshots left behind by
+                the latest Data Transfer (e.g. its completion was missed)
+  """
+  for target in targets:
+    updated = cloud_env_setup.update_views(context.data_gateway.bq_client,
+                                           context.config, target, only_stale)
+    if context.config.materialize_products:
+      # materialise new data once, all further queries will read the tables
+      context.data_gateway.refresh_products_snapshot(
+          target.name, only_stale=only_stale and not updated)
+
+
 def generate_campaign(context: Context) -> str:
   """Generate campaign data for Ads Editor.
     Returns:
@@ -142,7 +183,7 @@ def generate_campaign(context: Context) -> str:
   step_name = 'campaign creation'
   ts_start = datetime.now()
   logging.info(f'Starting "{step_name}" step')
-  products = context.data_gateway.load_products(context.target.name)
+  products = _load_products(context)
   output_path = None
   if products.total_rows:
     context.ensure_folders()
@@ -156,6 +197,9 @@ def generate_campaign(context: Context) -> str:
 def execute(config: config_utils.Config, target: config_utils.ConfigTarget,
             cred, opts: ContextOptions):
   context = Context(config, target, cred, opts)
+  # views are switched to new data on Data Transfer completions (by the server),
+  # but they can be left behind if no server handled the notification
+  update_products_data(context, [target], only_stale=True)
 
   validation = validate_config(context)
   if not validation['valid']:
@@ -207,6 +251,12 @@ def add_args(parser: argparse.ArgumentParser):
   parser.add_argument('--log-level',
                       dest='log_level',
                       help='Logging level: DEBUG, INFO, WARN, ERROR')
+  parser.add_argument(
+      '--streaming',
+      action="store_true",
+      help=
+      'If passed then campaign data and adcustomizers will be generated incrementally without keeping all products in memory'
+  )
   parser.add_argument(
       '--images-dry-run',
       action="store_true",
@@ -219,6 +269,76 @@ def add_args(parser: argparse.ArgumentParser):
       help=
       'If passed then images will be kept on GCS instead of locally'
   )
+  parser.add_argument(
+      '--images-in-memory',
+      action="store_true",
+      help=
+      'If passed then images will be processed in memory and uploaded to GCS without local temporary files'
+  )
+  parser.add_argument(
+      '--download-pool-size',
+      dest='download_pool_size',
+      type=int,
+      default=file_utils.HTTP_POOL_SIZE,
+      help='Number of simultaneous connections per host for downloading images')
+  parser.add_argument('--download-workers',
+                      dest='download_workers',
+                      type=int,
+                      default=file_utils.DOWNLOAD_WORKERS,
+                      help='Total number of threads for downloading images')
+  parser.add_argument(
+      '--images-async-download',
+      action="store_true",
+      help=
+      'If passed then images will be downloaded asynchronously (requires httpx)')
+  parser.add_argument(
+      '--resize-workers',
+      dest='resize_workers',
+      type=int,
+      help=
+      'Number of processes for resizing images (by default number of CPUs), 0 to resize in the main process'
+  )
+  parser.add_argument('--upload-workers',
+                      dest='upload_workers',
+                      type=int,
+                      default=file_utils.GCS_UPLOAD_WORKERS,
+                      help='Number of threads for uploading images to GCS')
+  parser.add_argument(
+      '--images-content-addressed',
+      action="store_true",
+      help=
+      'If passed then images will be named by hashes of their content, so images shared by many products are processed once'
+  )
+  parser.add_argument(
+      '--images-manifest',
+      action="store_true",
+      help=
+      'If passed then a manifest of processed images will be kept to skip downloading, resizing and uploading of unchanged images on next runs'
+  )
+  parser.add_argument(
+      '--query-cache-folder',
+      dest='query_cache_folder',
+      help=
+      'A folder to cache results of queries in (they are reused till data in BigQuery changes, requires pyarrow)'
+  )
+  parser.add_argument(
+      '--bq-storage-api',
+      action="store_true",
+      help=
+      'If passed then products will be fetched via BigQuery Storage Read API (requires google-cloud-bigquery-storage and pyarrow)'
+  )
+  parser.add_argument(
+      '--campaign-delta',
+      action="store_true",
+      help=
+      'If passed then campaign data will be generated only for ad groups changed, added or removed since the previous run'
+  )
+  parser.add_argument(
+      '--campaign-delta-full',
+      action="store_true",
+      help=
+      'If passed then the full campaign data file will be generated as well in delta mode'
+  )
 
 
 def main():
@@ -230,8 +350,21 @@ def main():
   cred: credentials.Credentials = auth.get_credentials(args)
   opts = ContextOptions(args.output_folder or 'output',
                         args.image_folder,
+                        streaming=args.streaming,
                         images_dry_run=args.images_dry_run,
-                        images_on_gcs=args.images_on_gcs)
+                        images_on_gcs=args.images_on_gcs,
+                        images_in_memory=args.images_in_memory,
+                        download_pool_size=args.download_pool_size,
+                        download_workers=args.download_workers,
+                        images_async_download=args.images_async_download,
+                        resize_workers=args.resize_workers,
+                        upload_workers=args.upload_workers,
+                        images_content_addressed=args.images_content_addressed,
+                        images_manifest=args.images_manifest,
+                        query_cache_folder=args.query_cache_folder,
+                        bq_storage_api=args.bq_storage_api,
+                        campaign_delta=args.campaign_delta,
+                        campaign_delta_full=args.campaign_delta_full)
   if args.target:
     target = next(filter(lambda t: t.name == args.target, config.targets), None)
     execute(config, target, cred, opts)
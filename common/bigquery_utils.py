@@ -16,19 +16,232 @@
 # python3
 """Cloud BigQuery module."""
 
+import collections
+import json
 import logging
 import os
 import re
+import shutil
+import string
+import threading
 from typing import Any, Dict, List, Union, Sequence
 from google.auth import credentials
 from google.cloud import bigquery
 from google.api_core import exceptions
 from google.cloud.bigquery.dataset import Dataset
+from google.cloud.bigquery.table import Row, RowIterator
 from common import file_utils
 
 # Set logging level.
 logging.getLogger('googleapiclient.discovery').setLevel(logging.WARNING)
 
+# Number of query results kept in memory by QueryResultCache
+QUERY_CACHE_SIZE = 16
+# Results with more rows aren't cached (they're kept in memory)
+QUERY_CACHE_MAX_ROWS = 5000
+# Folder with SQL scripts (relative to current dir)
+SQL_FOLDER = 'sql'
+
+
+class SqlTemplate:
+  """SQL script with {placeholders} parsed once (see `get_sql_template`).
+
+  Placeholders are meant for identifiers and SQL fragments (tables, columns,
+  conditions), values should be passed as query parameters (@name), so
+  the same SQL text is generated for different values and BigQuery can reuse
+  cached results.
+  """
+
+  def __init__(self, text: str, name: str = None):
+    self.name = name
+    self._formatter = string.Formatter()
+    # pairs of literal text and a placeholder (field name, conversion, spec)
+    self._parts = [(literal, (field_name, conversion, format_spec)
+                    if field_name is not None else None)
+                   for literal, field_name, format_spec, conversion in
+                   self._formatter.parse(text)]
+    self.fields = {
+        field[0] for _, field in self._parts if field is not None
+    }
+
+  def render(self, params: Dict[str, Any]) -> str:
+    """Return SQL text with placeholders replaced (as `str.format` does)"""
+    chunks = []
+    for literal, field in self._parts:
+      chunks.append(literal)
+      if field is not None:
+        field_name, conversion, format_spec = field
+        value, _ = self._formatter.get_field(field_name, (), params)
+        value = self._formatter.convert_field(value, conversion)
+        chunks.append(format(value, format_spec))
+    return ''.join(chunks)
+
+
+# SQL templates by file names (loaded once)
+_sql_templates: Dict[str, SqlTemplate] = {}
+_sql_templates_lock = threading.Lock()
+
+
+def get_sql_template(sql_file: str) -> SqlTemplate:
+  """Return a parsed SQL script from `SQL_FOLDER` (it's read only once)"""
+  template = _sql_templates.get(sql_file)
+  if template:
+    return template
+  with _sql_templates_lock:
+    template = _sql_templates.get(sql_file)
+    if not template:
+      sql_path = os.path.join(SQL_FOLDER, sql_file)
+      template = SqlTemplate(file_utils.get_file_content(sql_path), sql_file)
+      _sql_templates[sql_file] = template
+  return template
+
+
+def load_sql_templates():
+  """Load and parse all SQL scripts from `SQL_FOLDER` in advance"""
+  if not os.path.isdir(SQL_FOLDER):
+    return
+  for sql_file in sorted(os.listdir(SQL_FOLDER)):
+    if sql_file.endswith('.sql'):
+      get_sql_template(sql_file)
+
+
+class ArrowRowIterator:
+  """Query results fetched via BigQuery Storage Read API as Arrow record batches.
+
+  It can be used instead of RowIterator (it has `schema`, `total_rows` and
+  iterates over rows), rows are created from columns of each record batch
+  (converted at once), record batches can be used directly as well
+  (see `to_arrow_iterable`).
+  """
+
+  def __init__(self, row_iterator: RowIterator, bqstorage_client):
+    self.schema = row_iterator.schema
+    self.total_rows = row_iterator.total_rows
+    self._row_iterator = row_iterator
+    self._bqstorage_client = bqstorage_client
+    self._field_to_index = {
+        field.name: index for index, field in enumerate(self.schema)
+    }
+
+  def to_arrow_iterable(self):
+    """Return an iterator over results as pyarrow.RecordBatch objects"""
+    return self._row_iterator.to_arrow_iterable(
+        bqstorage_client=self._bqstorage_client)
+
+  def __iter__(self):
+    for batch in self.to_arrow_iterable():
+      columns = [column.to_pylist() for column in batch.columns]
+      for values in zip(*columns):
+        yield Row(values, self._field_to_index)
+
+
+class CachedRowIterator:
+  """Query results fetched into memory.
+
+  It can be used instead of RowIterator (it has `schema`, `total_rows` and
+  iterates over rows) but it can be iterated many times.
+  """
+
+  def __init__(self, schema: List[bigquery.SchemaField], rows: List[Row]):
+    self.schema = schema
+    self.total_rows = len(rows)
+    self._rows = rows
+
+  def __iter__(self):
+    return iter(self._rows)
+
+
+class QueryResultCache:
+  """A cache of query results (LRU in memory and optionally Parquet files on disk).
+
+  Results are cached by string keys in groups (e.g. targets) which can be
+  invalidated separately. The disk tier (if a folder is specified) allows
+  to reuse results between processes, it requires pyarrow.
+  """
+
+  def __init__(self,
+               folder: str = None,
+               maxsize: int = QUERY_CACHE_SIZE,
+               max_rows: int = QUERY_CACHE_MAX_ROWS):
+    self.folder = folder
+    self._maxsize = maxsize
+    self._max_rows = max_rows
+    self._lock = threading.Lock()
+    # results by groups and keys (in order of usage)
+    self._entries = collections.OrderedDict()
+
+  def _get_path(self, group: str, key: str) -> str:
+    return os.path.join(self.folder, group, key + '.parquet')
+
+  def get(self, group: str, key: str) -> CachedRowIterator:
+    """Return cached results or None"""
+    with self._lock:
+      rows = self._entries.get((group, key))
+      if rows is not None:
+        self._entries.move_to_end((group, key))
+        return rows
+    if not self.folder or not os.path.exists(self._get_path(group, key)):
+      return None
+    rows = self._read(self._get_path(group, key))
+    self._put_entry(group, key, rows)
+    return rows
+
+  def put(self, group: str, key: str, rows: RowIterator):
+    """Put results into the cache and return them (as CachedRowIterator),
+    results with too many rows aren't cached (and returned as they are)"""
+    if rows.total_rows is None or rows.total_rows > self._max_rows:
+      return rows
+    rows = CachedRowIterator(rows.schema, list(rows))
+    self._put_entry(group, key, rows)
+    if self.folder:
+      path = self._get_path(group, key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      self._write(path, rows)
+    return rows
+
+  def _put_entry(self, group: str, key: str, rows: CachedRowIterator):
+    with self._lock:
+      self._entries[(group, key)] = rows
+      self._entries.move_to_end((group, key))
+      while len(self._entries) > self._maxsize:
+        self._entries.popitem(last=False)
+
+  def clear(self, group: str = None):
+    """Remove all results (or results of a group)"""
+    with self._lock:
+      for entry_key in list(self._entries):
+        if group is None or entry_key[0] == group:
+          del self._entries[entry_key]
+    if self.folder:
+      path = os.path.join(self.folder, group) if group else self.folder
+      shutil.rmtree(path, ignore_errors=True)
+
+  def _write(self, path: str, rows: CachedRowIterator):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    names = [field.name for field in rows.schema]
+    columns = list(zip(*rows)) if rows.total_rows else [[] for _ in names]
+    table = pa.table(
+        {name: list(column) for name, column in zip(names, columns)})
+    # BigQuery schema is kept in metadata (to create rows with the same schema)
+    table = table.replace_schema_metadata({
+        'bigquery_schema':
+            json.dumps([field.to_api_repr() for field in rows.schema])
+    })
+    pq.write_table(table, path)
+
+  def _read(self, path: str) -> CachedRowIterator:
+    import pyarrow.parquet as pq
+    table = pq.read_table(path)
+    schema = [
+        bigquery.SchemaField.from_api_repr(field) for field in json.loads(
+            table.schema.metadata[b'bigquery_schema'])
+    ]
+    field_to_index = {field.name: index for index, field in enumerate(schema)}
+    columns = [column.to_pylist() for column in table.columns]
+    return CachedRowIterator(
+        schema, [Row(values, field_to_index) for values in zip(*columns)])
+
 
 class CloudBigQueryUtils(object):
   """This class provides methods to simplify BigQuery API usage."""
@@ -42,9 +255,24 @@ class CloudBigQueryUtils(object):
       credentials: google.auth credentials
     """
     self.project_id = project_id
+    self.credentials = credentials
     self.client = bigquery.Client(project=project_id,
                                   credentials=credentials,
                                   location=dataset_location)
+    self._bqstorage_client = None
+
+  def get_bqstorage_client(self):
+    """Return a client for BigQuery Storage Read API (created on first use)"""
+    if not self._bqstorage_client:
+      try:
+        from google.cloud import bigquery_storage
+      except ImportError as e:
+        raise ImportError(
+            'Reading via BigQuery Storage API requires google-cloud-bigquery-storage and pyarrow packages (pip install google-cloud-bigquery-storage pyarrow)'
+        ) from e
+      self._bqstorage_client = bigquery_storage.BigQueryReadClient(
+          credentials=self.credentials)
+    return self._bqstorage_client
 
   def create_dataset_if_not_exists(self, dataset_id: str,
                                    dataset_location: str) -> None:
@@ -77,6 +305,37 @@ class CloudBigQueryUtils(object):
       self.client.create_dataset(dataset)
       logging.info('Dataset %s created.', fully_qualified_dataset_id)
 
+  def get_table_modified(self, dataset_id: str, table_name: str):
+    """Return a timestamp of last modification of a table (None if it doesn't exist)"""
+    try:
+      return self.client.get_table(
+          f'{self.project_id}.{dataset_id}.{table_name}').modified
+    except exceptions.NotFound:
+      return None
+
+  def get_view_query(self, dataset_id: str, view_name: str):
+    """Return an SQL query of a view (None if it doesn't exist)"""
+    try:
+      return self.client.get_table(
+          f'{self.project_id}.{dataset_id}.{view_name}').view_query
+    except exceptions.NotFound:
+      return None
+
+  def get_latest_partition_date(self, dataset_id: str, table_name: str):
+    """Return a date of the latest non-empty partition of a table partitioned
+    by ingestion time (None if there are no partitions).
+    Only partitions' metadata is read, not the table itself.
+    """
+    # NOTE: special partitions (e.g. __NULL__) aren't parsed as dates
+    sql = """SELECT MAX(SAFE.PARSE_DATE('%Y%m%d', partition_id)) AS latest_date
+FROM `{dataset_fqn}.INFORMATION_SCHEMA.PARTITIONS`
+WHERE table_name = @table_name AND total_rows > 0
+"""
+    result = self.execute_query(
+        sql, dataset_id, {},
+        [bigquery.ScalarQueryParameter('table_name', 'STRING', table_name)])
+    return next(iter(result))[0]
+
   def get_dataset(self, dataset_id: str) -> Dataset:
     fully_qualified_dataset_id = f'{self.project_id}.{dataset_id}'
     try:
@@ -84,12 +343,12 @@ class CloudBigQueryUtils(object):
     except exceptions.NotFound:
       pass
 
-  def _configure_sql(self, sql_script: str, query_params: Dict[str,
-                                                               Any]) -> str:
+  def _configure_sql(self, sql_script: Union[str, SqlTemplate],
+                     query_params: Dict[str, Any]) -> str:
     """Configures parameters of SQL script with variables supplied.
 
     Args:
-      sql_script: SQL script.
+      sql_script: SQL script (text or parsed template).
       query_params: Configuration containing query parameter values.
 
     Returns:
@@ -97,15 +356,15 @@ class CloudBigQueryUtils(object):
     """
     params = {}
     for param_key, param_value in query_params.items():
-      # If given value is list of strings (ex. 'a,b,c'), create tuple of
-      # strings (ex. ('a', 'b', 'c')) to pass to SQL IN operator.
-      if isinstance(param_value, str) and ',' in param_value:
-        params[param_key] = tuple(param_value.split(','))
+      # If given value is a list (ex. ['a', 'b', 'c']), create tuple of
+      # values (ex. ('a', 'b', 'c')) to pass to SQL IN operator.
       if isinstance(param_value, list):
         params[param_key] = tuple(param_value)
       else:
         params[param_key] = param_value
 
+    if isinstance(sql_script, SqlTemplate):
+      return sql_script.render(params)
     return sql_script.format(**params)
 
   def _get_query_params(self, dataset_id: str, params: Dict[str, Any]):
@@ -121,23 +380,33 @@ class CloudBigQueryUtils(object):
                       sql_files: Union[Sequence[str], str],
                       dataset_id: str,
                       params: Dict[str, Any],
-                      sql_params: List[bigquery.ScalarQueryParameter] = None):
-    """Executes a SQL query script or a list of scripts."""
+                      sql_params: List[bigquery.ScalarQueryParameter] = None,
+                      page_size: int = None,
+                      storage_api: bool = False):
+    """Executes a SQL query script or a list of scripts.
+
+    Args:
+      page_size: number of rows fetched at once while iterating over results
+                 of the last script (by default it's chosen by BigQuery)
+      storage_api: True to fetch results of the last script via
+                   BigQuery Storage Read API (see `ArrowRowIterator`)
+    """
     if isinstance(sql_files, str):
       sql_files = [sql_files]
     query_params = self._get_query_params(dataset_id, params)
     for idx, sql_file in enumerate(sql_files):
       try:
-        sql_path = os.path.join('sql', sql_file)
-        sql_script = file_utils.get_file_content(sql_path)
-        query = self._configure_sql(sql_script, query_params)
+        query = self._configure_sql(get_sql_template(sql_file), query_params)
         job_config = None
         if sql_params:
           job_config = bigquery.QueryJobConfig(query_parameters=sql_params)
         query_job = self.client.query(query, job_config=job_config)
         if idx == len(sql_files) - 1:
           # TODO: theriotically we can combine several results together if needed
-          return query_job.result()
+          if storage_api:
+            return ArrowRowIterator(query_job.result(),
+                                    self.get_bqstorage_client())
+          return query_job.result(page_size=page_size)
         query_job.result()
       except Exception as e:
         logging.exception(
@@ -45,6 +45,40 @@ class ConfigItemBase(object):
         setattr(self, k, new_val)
 
 
+class AdDescriptionTemplate:
+  """Ad description template (see `ConfigTarget.ad_description_template`)
+  compiled into a description with adcustomizers.
+
+  Macros like {field} are translated to adcustomizer syntax
+  {=AD_CUSTOMIZER_FEED.field}, a macro {product_description} is replaced with
+  the static product description. The result doesn't depend on products,
+  so it's rendered once.
+  """
+
+  def __init__(self, template: str, product_description: str,
+               adcustomizer_feed_name: str):
+    self.template = template
+    self.product_description = product_description
+    self.adcustomizer_feed_name = adcustomizer_feed_name
+    description = template.replace('{product_description}',
+                                   product_description or '')
+    # names of adcustomizer fields used in the template
+    self.fields: List[str] = re.findall(r'\{([^}]+)\}', description)
+    description = re.sub(
+        r'\{([^}]+)\}',
+        lambda match: '{=' + adcustomizer_feed_name + '.' + match.group(1) + '}',
+        description)
+    # TODO: an expanded ad description (after evaluating adcustomizers) can exceed the ad description maximum length
+    self._description = description if description != template else ''
+
+  def render(self) -> str:
+    return self._description
+
+  def validate(self, adcustomizer_fields: List[str]) -> List[str]:
+    """Return fields used in the template that are missing in adcustomizers"""
+    return sorted(set(self.fields) - set(adcustomizer_fields))
+
+
 class ConfigTarget(ConfigItemBase):
   # target name (required)
   name: str = ''
@@ -96,7 +130,21 @@ class ConfigTarget(ConfigItemBase):
   """Additional condition to filter products from GMC (as SQL expression)"""
   gmc_sql_condition: str = ''
 
-  def validate(self, generation=False) -> List:
+  def __init__(self):
+    super().__init__()
+    # compiled ad_description_template (see `get_ad_description_template`)
+    self._ad_description_template: AdDescriptionTemplate = None
+
+  def validate(self,
+               generation=False,
+               adcustomizer_fields: List[str] = None) -> List:
+    """Validate the target's settings.
+
+    Args:
+      generation: True to validate settings required for generation
+      adcustomizer_fields: names of adcustomizer fields (to validate
+                           ad_description_template against them)
+    """
     errors = []
     if not self.name or re.match('[^A-Za-z0-9_\-]', self.name):
       errors.append({
@@ -129,6 +177,17 @@ class ConfigTarget(ConfigItemBase):
             'error':
                 'max_image_dimension should either empty or a non negative integer'
           })
+      template = self.get_ad_description_template()
+      if template and adcustomizer_fields is not None:
+        missing_fields = template.validate(adcustomizer_fields)
+        if missing_fields:
+          errors.append({
+              'field':
+                  'ad_description_template',
+              'error':
+                  'Ad description template uses fields missing in adcustomizers: '
+                  + ', '.join(missing_fields)
+          })
     return errors
 
   def init_image_filter(self):
@@ -148,6 +207,21 @@ class ConfigTarget(ConfigItemBase):
         negative = True
         self.image_filter_re.append((negative ,pattern))
 
+  def get_ad_description_template(self) -> AdDescriptionTemplate:
+    """Return compiled ad_description_template (or None if there's no template),
+    it's compiled once unless settings it depends on are changed"""
+    if not self.ad_description_template:
+      return None
+    compiled = self._ad_description_template
+    if (not compiled or compiled.template != self.ad_description_template or
+        compiled.product_description != self.product_description or
+        compiled.adcustomizer_feed_name != self.adcustomizer_feed_name):
+      compiled = AdDescriptionTemplate(self.ad_description_template,
+                                       self.product_description,
+                                       self.adcustomizer_feed_name)
+      self._ad_description_template = compiled
+    return compiled
+
 
 class Config(ConfigItemBase):
   # GCP project id
@@ -163,6 +237,9 @@ class Config(ConfigItemBase):
   dt_schedule: str = ''
   # pub/sub topic id for publishing message on GMC Data Transfer completions
   pubsub_topic_dt_finish: str = 'gmc-dt-finish'
+  # materialise filtered products of targets into tables (Products_Snapshot_{target})
+  # refreshed on Data Transfer completions, instead of querying views each time
+  materialize_products: bool = False
 
   def __init__(self):
     super().__init__()
@@ -212,6 +289,7 @@ class Config(ConfigItemBase):
         "merchant_id": self.merchant_id,
         "dt_schedule": self.dt_schedule,
         "pubsub_topic_dt_finish": self.pubsub_topic_dt_finish,
+        "materialize_products": self.materialize_products,
         "targets": []
     }
     for t in self.targets:
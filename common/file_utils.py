@@ -13,9 +13,16 @@
 # limitations under the License.
 from io import TextIOWrapper
 import os
-from typing import Any, List, Dict, Callable
+import hashlib
+import mimetypes
+import threading
+import asyncio
+import concurrent.futures
+from typing import Any, List, Dict, Callable, Tuple
 from grpc import Call
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import zipfile
 import zipstream
@@ -31,6 +38,19 @@ logging.getLogger('google.resumable_media._helpers').setLevel(logging.WARNING)
 
 CHROME_USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36'
 
+# Defaults for pooled http sessions used for downloading images
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Default number of threads for downloading files (in all hosts)
+DOWNLOAD_WORKERS = 32
+# Default number of simultaneous requests for downloading files in async mode
+ASYNC_DOWNLOAD_LIMIT = 200
+HTTP_TIMEOUT = 60
+# Default number of simultaneous uploads to GCS (matches the size of connection pool of storage.Client)
+GCS_UPLOAD_WORKERS = 10
+
 
 def generate_filename(path: str,
                       *,
@@ -59,14 +79,59 @@ def get_file_content(uri: str) -> str:
   raise FileNotFoundError(f'File {uri} wasn\'t found')
 
 
+def create_http_session(pool_size: int = HTTP_POOL_SIZE,
+                        max_retries: int = HTTP_MAX_RETRIES,
+                        backoff_factor: float = HTTP_BACKOFF_FACTOR
+                       ) -> requests.Session:
+  """Create a http session for downloading many files.
+
+  The session keeps connections alive in a pool per host (so downloading
+  thousands of images from the same CDN doesn't open a new TCP+TLS connection
+  for each of them) and retries failed requests with exponential backoff.
+  A session is safe to share between threads.
+
+  Args:
+    pool_size: maximum number of connections to keep per host (should be not
+               less than number of threads downloading simultaneously)
+    max_retries: maximum number of retries for connection errors and
+                 retriable http statuses (429, 5xx)
+    backoff_factor: backoff factor for retries, sleeps between retries will be
+                    {backoff factor} * (2 ** ({retry number} - 1)) seconds
+  """
+  retry = Retry(total=max_retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pool_size,
+                        pool_maxsize=pool_size,
+                        max_retries=retry)
+  session = requests.Session()
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  # Change the user agent because some websites don't like traffic from "non-browsers"
+  session.headers['User-Agent'] = CHROME_USER_AGENT
+  return session
+
+
 def download_file(uri: str,
                   local_path: str,
                   *,
                   folder: str = None,
                   dry_run: bool = False,
                   invalidate_cache: bool = False,
-                  lastModified: datetime) -> str:
-  """Download a remote file into a local folder."""
+                  lastModified: datetime,
+                  session: requests.Session = None,
+                  validators: Dict[str, str] = None) -> str:
+  """Download a remote file into a local folder.
+
+  Args:
+    session: a http session to reuse connections (see `create_http_session`),
+             if omitted a new connection will be opened
+    validators: a dict with 'etag' and 'last_modified' (http date) of a
+                previously downloaded copy to send a conditional request with,
+                it's updated with ETag/Last-Modified of a downloaded file
+  """
   if not local_path:
     if not folder:
       raise ValueError('folder should be specified if no local_path provided')
@@ -82,19 +147,19 @@ def download_file(uri: str,
     if lastModified:
       if not isinstance(lastModified, datetime):
         logging.warning(f'download_file for uri="{uri}", local_path="{local_path}" got invalid timestamp: {lastModified} (type: {type(lastModified)})')
-      headers['if-modified-since'] = _datetime2str(lastModified)
-    elif os.path.exists(local_path) and not invalidate_cache:
+    headers.update(_get_conditional_headers(lastModified, validators))
+    if 'if-modified-since' not in headers and os.path.exists(
+        local_path) and not invalidate_cache:
       headers['if-modified-since'] = _datetime2str(
           get_file_last_modified(local_path))
-    # NOTE: it can be seemed logical to use etag here (and pass it in if-none-match header),
-    # but the thing is that etags in GCS are different that normally from web servers
-    with requests.get(uri, headers=headers) as response:
+    with (session or requests).get(uri, headers=headers) as response:
       if response.status_code == 304:
         logging.debug(f'Reusing local copy of file {uri} (304)')
         return local_path, 304
       if response.status_code == 200:
         with open(local_path, 'wb') as f:
           f.write(response.content)
+        _update_validators(validators, response.headers)
         last_modified = response.headers.get('Last-Modified')
         if last_modified:
           last_modified = _str2datetime(last_modified)
@@ -107,6 +172,359 @@ def download_file(uri: str,
     raise
 
 
+def fetch_file(uri: str,
+               *,
+               lastModified: datetime = None,
+               session: requests.Session = None,
+               validators: Dict[str, str] = None) -> Tuple[bytes, int]:
+  """Download a remote file into memory.
+
+  The same as `download_file` but without local files: returns a tuple of
+  file content (None if it wasn't modified) and http status (200 or 304).
+  """
+  headers = {'User-Agent': CHROME_USER_AGENT}
+  headers.update(_get_conditional_headers(lastModified, validators))
+  try:
+    with (session or requests).get(uri, headers=headers) as response:
+      if response.status_code == 304:
+        logging.debug(f'File {uri} was not modified (304)')
+        return None, 304
+      if response.status_code == 200:
+        _update_validators(validators, response.headers)
+        return response.content, 200
+      raise FileNotFoundError(
+          f"Couldn't download file {uri}: {response.reason}")
+  except BaseException as e:
+    logging.error(f'Error occured during file {uri} download: {e}')
+    raise
+
+
+def _get_conditional_headers(lastModified: datetime,
+                             validators: Dict[str, str]) -> Dict[str, str]:
+  headers = {}
+  if lastModified:
+    headers['if-modified-since'] = _datetime2str(lastModified)
+  elif validators and validators.get('last_modified'):
+    headers['if-modified-since'] = validators['last_modified']
+  # NOTE: it can be seemed logical to use etag here (and pass it in if-none-match header),
+  # but the thing is that etags in GCS are different that normally from web servers,
+  # so we use only etags received from the web server itself
+  if validators and validators.get('etag'):
+    headers['if-none-match'] = validators['etag']
+  return headers
+
+
+def _update_validators(validators: Dict[str, str], headers):
+  if validators is not None:
+    validators['etag'] = headers.get('ETag')
+    validators['last_modified'] = headers.get('Last-Modified')
+
+
+class DownloadScheduler:
+  """Downloads files on a bounded pool of threads shared by all consumers.
+
+  In contrast to creating a thread pool per group of files it allows
+  to pipeline downloads of many groups (e.g. images of many products)
+  while limiting number of simultaneous downloads from the same host.
+  The same local path is downloaded only once even if it's submitted many times.
+  Files can also be downloaded into memory (see `fetch`).
+
+  Typical usage example:
+    >>> with DownloadScheduler(session) as scheduler:
+    >>>   future = scheduler.submit(url, local_path, lastModified=None)
+    >>>   local_path, status = future.result()
+  """
+
+  def __init__(self,
+               session: requests.Session = None,
+               max_workers: int = DOWNLOAD_WORKERS,
+               max_per_host: int = HTTP_POOL_SIZE):
+    """Initialise new instance of DownloadScheduler.
+
+    Args:
+      session: a http session to reuse connections (see `create_http_session`)
+      max_workers: total number of simultaneous downloads
+      max_per_host: number of simultaneous downloads from one host
+    """
+    self._session = session
+    self._max_per_host = max_per_host
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix='download')
+    self._lock = threading.Lock()
+    self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+    self._futures: Dict[str, concurrent.futures.Future] = {}
+    self._fetches: Dict[str, concurrent.futures.Future] = {}
+
+  def _get_host_semaphore(self, uri: str) -> threading.BoundedSemaphore:
+    host = parse.urlparse(uri).hostname or ''
+    with self._lock:
+      semaphore = self._host_semaphores.get(host)
+      if not semaphore:
+        semaphore = threading.BoundedSemaphore(self._max_per_host)
+        self._host_semaphores[host] = semaphore
+      return semaphore
+
+  def _download(self, uri: str, local_path: str, lastModified: datetime,
+                validators: Dict[str, str]):
+    with self._get_host_semaphore(uri):
+      return download_file(uri,
+                           local_path,
+                           lastModified=lastModified,
+                           session=self._session,
+                           validators=validators)
+
+  def submit(self,
+             uri: str,
+             local_path: str,
+             *,
+             dry_run: bool = False,
+             lastModified: datetime,
+             validators: Dict[str, str] = None) -> concurrent.futures.Future:
+    """Schedule a file downloading (see `download_file` for arguments).
+    If the same local path was already submitted, validators are updated
+    only for the first submission.
+
+    Returns:
+      a future with a tuple of local path and http status (200 or 304)
+    """
+    if dry_run:
+      future = concurrent.futures.Future()
+      future.set_result((local_path, 304))
+      return future
+    with self._lock:
+      future = self._futures.get(local_path)
+      if not future:
+        future = self._start(uri, local_path, lastModified, validators)
+        self._futures[local_path] = future
+      return future
+
+  def _start(self, uri: str, local_path: str, lastModified: datetime,
+             validators: Dict[str, str]) -> concurrent.futures.Future:
+    return self._executor.submit(self._download, uri, local_path,
+                                 lastModified, validators)
+
+  def _fetch(self, uri: str, lastModified: datetime,
+             validators: Dict[str, str]):
+    with self._get_host_semaphore(uri):
+      return fetch_file(uri,
+                        lastModified=lastModified,
+                        session=self._session,
+                        validators=validators)
+
+  def fetch(self,
+            uri: str,
+            *,
+            dry_run: bool = False,
+            lastModified: datetime,
+            validators: Dict[str, str] = None) -> concurrent.futures.Future:
+    """Schedule a file downloading into memory (see `fetch_file` for arguments).
+    The same url is downloaded once while it's in flight, but downloaded files
+    aren't kept (so memory is bounded by the number of downloads in flight).
+
+    Returns:
+      a future with a tuple of file content (None if it wasn't modified)
+      and http status (200 or 304)
+    """
+    if dry_run:
+      future = concurrent.futures.Future()
+      future.set_result((None, 304))
+      return future
+    with self._lock:
+      future = self._fetches.get(uri)
+      if future:
+        return future
+      future = self._start_fetch(uri, lastModified, validators)
+      self._fetches[uri] = future
+
+    def on_done(_):
+      with self._lock:
+        if self._fetches.get(uri) is future:
+          del self._fetches[uri]
+
+    future.add_done_callback(on_done)
+    return future
+
+  def _start_fetch(self, uri: str, lastModified: datetime,
+                   validators: Dict[str, str]) -> concurrent.futures.Future:
+    return self._executor.submit(self._fetch, uri, lastModified, validators)
+
+  def shutdown(self, wait: bool = True):
+    self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown(wait=exc_type is None)
+
+
+async def download_file_async(client,
+                              uri: str,
+                              local_path: str,
+                              *,
+                              lastModified: datetime,
+                              validators: Dict[str, str] = None
+                             ) -> Tuple[str, int]:
+  """Download a remote file into a local path asynchronously.
+
+  The same contract as for `download_file`: returns a tuple of local path
+  and http status (200 if file was downloaded or 304 if it wasn't modified).
+
+  Args:
+    client: httpx.AsyncClient instance
+  """
+  headers = _get_conditional_headers(lastModified, validators)
+  try:
+    if 'if-modified-since' not in headers and os.path.exists(local_path):
+      headers['if-modified-since'] = _datetime2str(
+          get_file_last_modified(local_path))
+    response = await client.get(uri, headers=headers)
+    if response.status_code == 304:
+      logging.debug(f'Reusing local copy of file {uri} (304)')
+      return local_path, 304
+    if response.status_code == 200:
+      with open(local_path, 'wb') as f:
+        f.write(response.content)
+      _update_validators(validators, response.headers)
+      last_modified = response.headers.get('Last-Modified')
+      if last_modified:
+        set_file_last_modified(local_path, _str2datetime(last_modified))
+      return local_path, 200
+    raise FileNotFoundError(
+        f"Couldn't download file {uri}: {response.reason_phrase}")
+  except BaseException as e:
+    logging.error(f'Error occured during file {uri} download: {e}')
+    raise
+
+
+async def fetch_file_async(client,
+                           uri: str,
+                           *,
+                           lastModified: datetime = None,
+                           validators: Dict[str, str] = None
+                          ) -> Tuple[bytes, int]:
+  """Download a remote file into memory asynchronously (see `fetch_file`).
+
+  Args:
+    client: httpx.AsyncClient instance
+  """
+  headers = _get_conditional_headers(lastModified, validators)
+  try:
+    response = await client.get(uri, headers=headers)
+    if response.status_code == 304:
+      logging.debug(f'File {uri} was not modified (304)')
+      return None, 304
+    if response.status_code == 200:
+      _update_validators(validators, response.headers)
+      return response.content, 200
+    raise FileNotFoundError(
+        f"Couldn't download file {uri}: {response.reason_phrase}")
+  except BaseException as e:
+    logging.error(f'Error occured during file {uri} download: {e}')
+    raise
+
+
+class AsyncDownloadScheduler(DownloadScheduler):
+  """Downloads files on an event loop (in a background thread) with httpx.
+
+  It can keep hundreds of requests in flight with a few threads,
+  the interface is the same as for DownloadScheduler (so it returns
+  concurrent.futures.Future for each submitted download).
+  """
+
+  def __init__(self,
+               max_in_flight: int = ASYNC_DOWNLOAD_LIMIT,
+               max_per_host: int = HTTP_POOL_SIZE,
+               max_retries: int = HTTP_MAX_RETRIES,
+               transport=None):
+    """Initialise new instance of AsyncDownloadScheduler.
+
+    Args:
+      max_in_flight: total number of simultaneous requests
+      max_per_host: number of simultaneous requests to one host
+      max_retries: number of retries on connection errors
+      transport: httpx transport (by default httpx.AsyncHTTPTransport
+                 with `max_retries`)
+    """
+    try:
+      import httpx
+    except ImportError as e:
+      raise ImportError(
+          'Async downloading requires httpx package (pip install httpx)') from e
+    self._max_per_host = max_per_host
+    self._lock = threading.Lock()
+    self._futures: Dict[str, concurrent.futures.Future] = {}
+    self._fetches: Dict[str, concurrent.futures.Future] = {}
+    self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+    self._loop = asyncio.new_event_loop()
+    self._thread = threading.Thread(target=self._loop.run_forever,
+                                    name='download-loop',
+                                    daemon=True)
+    self._thread.start()
+    self._semaphore = asyncio.Semaphore(max_in_flight)
+    self._client = httpx.AsyncClient(
+        headers={'User-Agent': CHROME_USER_AGENT},
+        follow_redirects=True,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=max_in_flight,
+                            max_keepalive_connections=max_in_flight),
+        transport=transport or httpx.AsyncHTTPTransport(retries=max_retries))
+
+  def _get_host_semaphore(self, uri: str) -> asyncio.Semaphore:
+    # NOTE: semaphores are accessed only from the loop's thread
+    host = parse.urlparse(uri).hostname or ''
+    host_semaphore = self._host_semaphores.get(host)
+    if not host_semaphore:
+      host_semaphore = asyncio.Semaphore(self._max_per_host)
+      self._host_semaphores[host] = host_semaphore
+    return host_semaphore
+
+  async def _download_async(self, uri: str, local_path: str,
+                            lastModified: datetime,
+                            validators: Dict[str, str]):
+    async with self._semaphore, self._get_host_semaphore(uri):
+      return await download_file_async(self._client,
+                                       uri,
+                                       local_path,
+                                       lastModified=lastModified,
+                                       validators=validators)
+
+  async def _fetch_async(self, uri: str, lastModified: datetime,
+                         validators: Dict[str, str]):
+    async with self._semaphore, self._get_host_semaphore(uri):
+      return await fetch_file_async(self._client,
+                                    uri,
+                                    lastModified=lastModified,
+                                    validators=validators)
+
+  def _start(self, uri: str, local_path: str, lastModified: datetime,
+             validators: Dict[str, str]) -> concurrent.futures.Future:
+    return asyncio.run_coroutine_threadsafe(
+        self._download_async(uri, local_path, lastModified, validators),
+        self._loop)
+
+  def _start_fetch(self, uri: str, lastModified: datetime,
+                   validators: Dict[str, str]) -> concurrent.futures.Future:
+    return asyncio.run_coroutine_threadsafe(
+        self._fetch_async(uri, lastModified, validators), self._loop)
+
+  def shutdown(self, wait: bool = True):
+    if not self._loop.is_running():
+      return
+    with self._lock:
+      futures = list(self._futures.values()) + list(self._fetches.values())
+    if wait:
+      concurrent.futures.wait(futures)
+    else:
+      for future in futures:
+        future.cancel()
+    asyncio.run_coroutine_threadsafe(self._client.aclose(),
+                                     self._loop).result()
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join()
+    self._loop.close()
+
+
 def copy_file_from_gcs(uri: str,
                        destination_file_name: str,
                        storage_client: storage.Client = None):
@@ -136,9 +554,9 @@ def get_file_from_gcs(uri: str, storage_client: storage.Client = None) -> str:
   # result.path will be '/path/to/blob', we need to strip the leading '/'.
   bucket_name, path = result.hostname, result.path[1:]
   if not storage_client:
-    client = storage.Client()
+    storage_client = storage.Client()
   try:
-    bucket = client.get_bucket(bucket_name)
+    bucket = storage_client.get_bucket(bucket_name)
     blob = bucket.get_blob(path)
     if blob:
       content = blob.download_as_string().decode('utf-8')
@@ -152,6 +570,17 @@ def get_file_from_gcs(uri: str, storage_client: storage.Client = None) -> str:
     raise
 
 
+def get_file_hash(file_path: str) -> str:
+  """Return a hash of a local file content (hex string)"""
+  with open(file_path, 'rb') as f:
+    return get_content_hash(f.read())
+
+
+def get_content_hash(content: bytes) -> str:
+  """Return a hash of a binary content (hex string)"""
+  return hashlib.sha1(content).hexdigest()
+
+
 def save_file_content(uri: str, content: str):
   """Write content to a file represented by an url"""
   if uri.startswith('gs://'):
@@ -219,6 +648,15 @@ def upload_file_to_gcs(local_file_path: str,
   Return:
     a GCS path of uploaded file
   """
+  bucket_name, blob_path = _get_upload_blob_path(local_file_path, gcs_path)
+  bucket = get_or_create_gcs_bucket(bucket_name, storage_client)
+  return _upload_blob(bucket, blob_path, local_file_path)
+
+
+def _get_upload_blob_path(local_file_path: str,
+                          gcs_path: str) -> Tuple[str, str]:
+  """Return a bucket name and a blob path for uploading a local file
+  (see `upload_file_to_gcs` for arguments)"""
   file_name = os.path.basename(local_file_path)
   blob_path = file_name
   if gcs_path.startswith('gs://'):
@@ -232,17 +670,152 @@ def upload_file_to_gcs(local_file_path: str,
         blob_path = path
   else:
     bucket_name = gcs_path
+  return bucket_name, blob_path
 
-  bucket = get_or_create_gcs_bucket(bucket_name, storage_client)
+
+def _upload_blob(bucket: storage.Bucket, blob_path: str,
+                 local_file_path: str) -> str:
   blob = bucket.blob(blob_path)
   _operation_with_retry(lambda: blob.upload_from_filename(local_file_path),
                         f"blob ({blob.name}) upload")
 
-  gcs_url = f'gs://{bucket_name}/{blob_path}'
+  gcs_url = f'gs://{bucket.name}/{blob_path}'
   logging.debug(f'File {local_file_path} uploaded to {gcs_url}')
   return gcs_url
 
 
+def _upload_blob_content(bucket: storage.Bucket, blob_path: str,
+                         content: bytes) -> str:
+  blob = bucket.blob(blob_path)
+  # NOTE: the client uses a single request for small objects
+  # and switches to resumable uploads for big ones
+  content_type = mimetypes.guess_type(
+      blob_path)[0] or 'application/octet-stream'
+  _operation_with_retry(
+      lambda: blob.upload_from_string(content, content_type=content_type),
+      f"blob ({blob.name}) upload")
+
+  gcs_url = f'gs://{bucket.name}/{blob_path}'
+  logging.debug(f'Content ({len(content)} bytes) uploaded to {gcs_url}')
+  return gcs_url
+
+
+class GcsUploader:
+  """Uploads local files to GCS on a bounded pool of threads.
+
+  Buckets are resolved (and created if needed) once per uploader instead of
+  on each upload, so uploading a file costs a single request. Uploads run in
+  background, the caller is blocked only if there are too many of them
+  pending (that also limits memory used by contents being uploaded,
+  see `submit_content`). Errors of uploads are raised on exit (see `shutdown`).
+
+  Typical usage example:
+    >>> with GcsUploader(storage_client) as uploader:
+    >>>   uploader.submit(local_path, 'gs://bucket/path/to/', remove=True)
+    >>>   uploader.submit_content(content, 'file.jpg', 'gs://bucket/path/to/')
+  """
+
+  def __init__(self,
+               storage_client: storage.Client = None,
+               max_workers: int = GCS_UPLOAD_WORKERS,
+               max_pending: int = None):
+    """Initialise new instance of GcsUploader.
+
+    Args:
+      storage_client: a GCS client (its connections are shared by all workers)
+      max_workers: number of simultaneous uploads
+      max_pending: max number of uploads waiting in the queue
+                   (by default 4 times the number of workers)
+    """
+    self._storage_client = storage_client
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix='upload')
+    self._pending = threading.BoundedSemaphore(max_pending or max_workers * 4)
+    self._lock = threading.Lock()
+    self._buckets: Dict[str, storage.Bucket] = {}
+    self._errors: List[BaseException] = []
+
+  def _get_bucket(self, bucket_name: str) -> storage.Bucket:
+    with self._lock:
+      bucket = self._buckets.get(bucket_name)
+      if not bucket:
+        bucket = get_or_create_gcs_bucket(bucket_name, self._storage_client)
+        self._buckets[bucket_name] = bucket
+      return bucket
+
+  def _upload(self, local_file_path: str, gcs_path: str, remove: bool) -> str:
+    bucket_name, blob_path = _get_upload_blob_path(local_file_path, gcs_path)
+    gcs_url = _upload_blob(self._get_bucket(bucket_name), blob_path,
+                           local_file_path)
+    if remove:
+      os.remove(local_file_path)
+    return gcs_url
+
+  def _upload_content(self, content: bytes, file_name: str,
+                      gcs_path: str) -> str:
+    bucket_name, blob_path = _get_upload_blob_path(file_name, gcs_path)
+    return _upload_blob_content(self._get_bucket(bucket_name), blob_path,
+                                content)
+
+  def _on_done(self, future: concurrent.futures.Future):
+    self._pending.release()
+    if not future.cancelled() and future.exception():
+      with self._lock:
+        self._errors.append(future.exception())
+
+  def submit(self,
+             local_file_path: str,
+             gcs_path: str,
+             *,
+             remove: bool = False) -> concurrent.futures.Future:
+    """Schedule a file uploading (see `upload_file_to_gcs` for arguments).
+
+    Args:
+      remove: True to remove the local file after it's uploaded
+
+    Returns:
+      a future with a GCS path of uploaded file
+    """
+    return self._submit(self._upload, local_file_path, gcs_path, remove)
+
+  def submit_content(self, content: bytes, file_name: str,
+                     gcs_path: str) -> concurrent.futures.Future:
+    """Schedule uploading of a content from memory as a file.
+
+    Args:
+      content: file content
+      file_name: file name (its extension defines the content type)
+      gcs_path: a GCS path of a folder (see `upload_file_to_gcs`)
+
+    Returns:
+      a future with a GCS path of uploaded file
+    """
+    return self._submit(self._upload_content, content, file_name, gcs_path)
+
+  def _submit(self, fn, *args) -> concurrent.futures.Future:
+    self._pending.acquire()
+    try:
+      future = self._executor.submit(fn, *args)
+    except BaseException:
+      self._pending.release()
+      raise
+    future.add_done_callback(self._on_done)
+    return future
+
+  def shutdown(self, wait: bool = True):
+    """Shutdown the uploader, if wait is True then wait for all uploads
+    and raise an error of the first failed one"""
+    self._executor.shutdown(wait=wait, cancel_futures=not wait)
+    if wait and self._errors:
+      raise self._errors[0]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown(wait=exc_type is None)
+
+
 def _operation_with_retry(operation: Callable,
                           op_name: str,
                           max_retry: int = 5,
@@ -499,7 +1072,8 @@ def _str2datetime(str_time: str) -> datetime:
 
 def _datetime2str(dt: datetime) -> str:
   """Convert datetime to string in 'Fri, 17 Sep 2021 09:49:45 GMT' format"""
-  return dt.strftime(_LAST_MODIFIED_DATETIME_FORMAT)
+  # NOTE: naive datetimes have no timezone, strip the trailing space (httpx rejects it)
+  return dt.strftime(_LAST_MODIFIED_DATETIME_FORMAT).strip()
 
 
 def set_file_last_modified(file_path: str, dt: datetime):
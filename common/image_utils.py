@@ -13,41 +13,51 @@
 # limitations under the License.
 
 from PIL import Image
+import io
+import json
 import logging
+import multiprocessing
 import os
-import shutil
-from typing import List
+import threading
+import concurrent.futures
+from urllib import parse
+from typing import Any, BinaryIO, Dict, List, Tuple, Union
+from common import file_utils
 from common.utils import get_rss
 
 # Acceptable landscape ratio for image extensions
 # https://support.google.com/google-ads/editor/answer/57755#zippy=%2Cimage-extensions
 LANDSCAPE_RATIO = 1.91
 MINIMUM_DIMENSION = 300
+# a version of the transformation algorithm (see `transform`),
+# it should be increased on changes that affect output images
+TRANSFORM_VERSION = 1
 
 logging.getLogger('PIL').setLevel(logging.INFO)
 
 
 def _pad_image(image: Image, resize_width: int, resize_height: int,
-               max_dimension: int, output_filepath: str):
+               max_dimension: int) -> Image:
   """Create a new image by inserting the original image into white rectangel of specified size"""
   offset = (round(abs(image.width - resize_width) / 2),
             round(abs(image.height - resize_height) / 2))
-  with Image.new('RGB', (resize_width, resize_height),
-                 (255, 255, 255)) as background:
-    background.paste(image, offset)
-    try:
-      if max_dimension > 0 and (background.width > max_dimension or
-                                background.height > max_dimension):
-        background.thumbnail(size=(max_dimension, max_dimension))
-      if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-        logging.debug(
-            f'Resized image {os.path.basename(output_filepath)}: {background.size}, aspect ration: {background.width/background.height:.2f}'
-        )
-      background.save(output_filepath)
-      return output_filepath
-    except Exception as e:
-      logging.error(f'Failed to resize image {output_filepath}: {e}')
-      return ''
+  background = Image.new('RGB', (resize_width, resize_height), (255, 255, 255))
+  background.paste(image, offset)
+  if max_dimension > 0 and (background.width > max_dimension or
+                            background.height > max_dimension):
+    background.thumbnail(size=(max_dimension, max_dimension))
+  return background
+
+
+def _encode_image(image: Image, format: str) -> bytes:
+  buffer = io.BytesIO()
+  image.save(buffer, format=format)
+  return buffer.getvalue()
+
+
+def _get_image_format(filename: str, default_format: str = None) -> str:
+  ext = os.path.splitext(filename)[1].lower()
+  return Image.registered_extensions().get(ext) or default_format
 
 
 def _construct_file_path(filename, folder, filename_suffix):
@@ -59,52 +69,40 @@ def _construct_file_path(filename, folder, filename_suffix):
   return output_filepath
 
 
-def resize(image_path: str,
-           output_folder: str = None,
-           max_dimension: int = 1200,
-           *,
-           dry_run: bool = False) -> List[str]:
-  """Create two images, one square and another landscape to follow
-     size guidelines of image extensions:
-     * https://support.google.com/google-ads/editor/answer/57755#zippy=%2Cimage-extensions
-     * https://support.google.com/google-ads/answer/9566341
-     Supported image sizes for image extensions:
-      1.91:1, minimum 600 x 314, recommended 1200x628
-      1:1, minimum 300 x 300, recommended 1200x1200
-     If image is square it's only resized to landscape, and on the contrary.
-     When an image resized it's put on white background.
+def transform(image_file: Union[str, BinaryIO],
+              max_dimension: int = 1200,
+              *,
+              format: str = None,
+              name: str = '') -> Tuple[bytes, bytes]:
+  """Create two images, one square and another landscape (see `resize`),
+  in memory. The source image is decoded once (with reduced-size decoding
+  if it's too big) and each output image is encoded once.
 
   Args:
-    image_path: a local image path
+    image_file: a local image path or a binary file-like object
     max_dimension: a max dimension for width/height after which image will be resized
-    (to be with that width/heigh maximum)
+    format: output images format (PIL format name, e.g. 'JPEG'),
+            by default the format of the source image
+    name: image name for logging
 
   Returns:
-    a 2-element array with local image paths,
-    where the first is square and the second is landscape
+    a tuple of encoded square and landscape images
   """
-  image_filename = os.path.basename(image_path)
-  if not output_folder:
-    output_folder = os.path.split(image_path)[0]
-  os.makedirs(output_folder, exist_ok=True)
-  if dry_run:
-    return [
-        _construct_file_path(image_filename, output_folder, "_sq"),
-        _construct_file_path(image_filename, output_folder, "_ls")
-    ]
-  output_image_path = None
-  with Image.open(image_path) as image:
+  with Image.open(image_file) as image:
+    format = format or image.format
     ratio = round(image.width / image.height, 2)
     logging.debug(
-        f'Processing image {image_path}, width: {image.width}, heigh: {image.height}, ratio: {ratio}'
+        f'Processing image {name}, width: {image.width}, heigh: {image.height}, ratio: {ratio}'
     )
+    # None means that an output image is the same as the source one
+    base = None
     if max_dimension > 0 and (image.width > max_dimension or
                               image.height > max_dimension):
-      image.thumbnail(size=(max_dimension, max_dimension))
-      output_image_path = os.path.join(output_folder, image_filename)
-      image.save(output_image_path)
-      image_path = output_image_path
-      logging.debug(f'Image too big, shrinked to {image.size}')
+      # decode image with reduced size (supported by JPEG only) and shrink it
+      image.draft('RGB', (max_dimension, max_dimension))
+      base = image.copy()
+      base.thumbnail(size=(max_dimension, max_dimension))
+      logging.debug(f'Image too big, shrinked to {base.size}')
     elif image.width < MINIMUM_DIMENSION or image.height < MINIMUM_DIMENSION:
       if image.width < MINIMUM_DIMENSION and image.height < MINIMUM_DIMENSION:
         resize_width = resize_height = MINIMUM_DIMENSION
@@ -114,53 +112,341 @@ def resize(image_path: str,
       elif image.height < MINIMUM_DIMENSION:
         resize_height = MINIMUM_DIMENSION
         resize_width = round(MINIMUM_DIMENSION * ratio)
-      output_image_path = os.path.join(output_folder, image_filename)
-      image = Image.open(
-          _pad_image(image, resize_width, resize_height, max_dimension,
-                     output_image_path))
-      image_path = output_image_path
+      base = _pad_image(image, resize_width, resize_height, max_dimension)
       logging.debug(f'Image too small, padded to 300px')
+    source = base or image
+
+    def reuse_or_encode(target: Image) -> bytes:
+      if target is None:
+        if base is not None:
+          return _encode_image(base, format)
+        # the source image can be reused as is, without decoding/encoding
+        if isinstance(image_file, str):
+          with open(image_file, 'rb') as f:
+            return f.read()
+        image_file.seek(0)
+        return image_file.read()
+      return _encode_image(target, format)
 
-    image_paths = []
     # 1 create a square image
-    resize_width = image.width
-    resize_height = image.height
-    sq_image_filepath = _construct_file_path(image_filename, output_folder,
-                                             "_sq")
-    if ratio == 1:
-      shutil.copyfile(image_path, sq_image_filepath)
-      logging.debug(
-          f'Reusing image {os.path.basename(image_path)} as square: {sq_image_filepath}'
-      )
-      image_paths.append(sq_image_filepath)
-    else:
+    square = None
+    if ratio != 1:
       # Will resize to a square image
-      if image.width > image.height:
-        resize_height = image.width
-      else:
-        resize_width = image.height
-      image_paths.append(
-          _pad_image(image, resize_width, resize_height, 0, sq_image_filepath))
-
+      size = max(source.width, source.height)
+      square = _pad_image(source, size, size, 0)
     # 2 create a landscape image
-    resize_width = image.width
-    resize_height = image.height
-    ls_image_filepath = _construct_file_path(image_filename, output_folder,
-                                             "_ls")
-    if ratio == LANDSCAPE_RATIO:
-      shutil.copyfile(image_path, ls_image_filepath)
-      logging.debug(
-          f'Reusing image {os.path.basename(image_path)} as landscape: {ls_image_filepath}'
-      )
-      image_paths.append(ls_image_filepath)
-    else:
+    landscape = None
+    if ratio != LANDSCAPE_RATIO:
       # Will resize to landscape image
+      resize_width = source.width
+      resize_height = source.height
       if ratio <= LANDSCAPE_RATIO:
         resize_width = round(resize_height * LANDSCAPE_RATIO)
       else:
         resize_height = round(resize_width / LANDSCAPE_RATIO)
-      image_paths.append(
-          _pad_image(image, resize_width, resize_height, max_dimension,
-                     ls_image_filepath))
+      landscape = _pad_image(source, resize_width, resize_height,
+                             max_dimension)
+    if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+      for variant in (square, landscape):
+        if variant:
+          logging.debug(
+              f'Resized image {name}: {variant.size}, aspect ration: {variant.width/variant.height:.2f}'
+          )
+    return reuse_or_encode(square), reuse_or_encode(landscape)
+
+
+def get_transform_params(max_dimension: int) -> Dict[str, int]:
+  """Return parameters that output images of `transform` depend on"""
+  return {'max_dimension': max_dimension, 'version': TRANSFORM_VERSION}
+
+
+def resize(image_path: str,
+           output_folder: str = None,
+           max_dimension: int = 1200,
+           *,
+           dry_run: bool = False,
+           output_name: str = None) -> List[str]:
+  """Create two images, one square and another landscape to follow
+     size guidelines of image extensions:
+     * https://support.google.com/google-ads/editor/answer/57755#zippy=%2Cimage-extensions
+     * https://support.google.com/google-ads/answer/9566341
+     Supported image sizes for image extensions:
+      1.91:1, minimum 600 x 314, recommended 1200x628
+      1:1, minimum 300 x 300, recommended 1200x1200
+     If image is square it's only resized to landscape, and on the contrary.
+     When an image resized it's put on white background.
 
+  Args:
+    image_path: a local image path
+    max_dimension: a max dimension for width/height after which image will be resized
+    (to be with that width/heigh maximum)
+    output_name: a file name to generate output file names from
+    (by default the name of the source image)
+
+  Returns:
+    a 2-element array with local image paths,
+    where the first is square and the second is landscape
+  """
+  image_filename = output_name or os.path.basename(image_path)
+  if not output_folder:
+    output_folder = os.path.split(image_path)[0]
+  os.makedirs(output_folder, exist_ok=True)
+  image_paths = [
+      _construct_file_path(image_filename, output_folder, "_sq"),
+      _construct_file_path(image_filename, output_folder, "_ls")
+  ]
+  if dry_run:
+    return image_paths
+  try:
+    images = transform(image_path,
+                       max_dimension,
+                       format=_get_image_format(image_filename),
+                       name=image_filename)
+  except Exception as e:
+    logging.error(f'Failed to resize image {image_path}: {e}')
+    raise
+  for output_filepath, content in zip(image_paths, images):
+    with open(output_filepath, 'wb') as f:
+      f.write(content)
   return image_paths
+
+
+def _transform_content(content: bytes, max_dimension: int,
+                       name: str) -> Tuple[bytes, bytes]:
+  return transform(io.BytesIO(content),
+                   max_dimension,
+                   format=_get_image_format(name),
+                   name=name)
+
+
+class ResizePool:
+  """Runs image resizing (see `resize`) on a pool of processes.
+
+  Resizing is CPU-bound, so running it in the main process limits image
+  processing to one core. The pool allows resizing images in parallel
+  while the main process is downloading and uploading others.
+  The same image (or images with the same output name) is resized only once
+  even if it's submitted many times.
+
+  Typical usage example:
+    >>> with ResizePool() as pool:
+    >>>   future = pool.submit(image_path, output_folder, 1200)
+    >>>   sq_image_path, ls_image_path = future.result()
+  """
+
+  def __init__(self, max_workers: int = None):
+    """Initialise new instance of ResizePool.
+
+    Args:
+      max_workers: number of processes (by default number of CPUs),
+                   0 to resize images in the calling thread
+    """
+    self._executor = None
+    if max_workers != 0:
+      # NOTE: the pool is started while downloading and uploading threads are
+      # running, and forking a multi-threaded process can deadlock on locks
+      # held by other threads, so processes are started by a fork server
+      start_method = 'forkserver' if 'forkserver' in \
+          multiprocessing.get_all_start_methods() else 'spawn'
+      self._executor = concurrent.futures.ProcessPoolExecutor(
+          max_workers, mp_context=multiprocessing.get_context(start_method))
+    self._lock = threading.Lock()
+    self._futures: Dict[Tuple[str, str, int], concurrent.futures.Future] = {}
+
+  def submit(self,
+             image_path: str,
+             output_folder: str = None,
+             max_dimension: int = 1200,
+             *,
+             dry_run: bool = False,
+             output_name: str = None) -> concurrent.futures.Future:
+    """Schedule an image resizing (see `resize` for arguments).
+
+    Returns:
+      a future with a 2-element list of square and landscape image paths
+    """
+    key = (output_name or image_path, output_folder, max_dimension)
+    with self._lock:
+      future = self._futures.get(key)
+      if future:
+        return future
+      if dry_run or not self._executor:
+        future = concurrent.futures.Future()
+        try:
+          future.set_result(
+              resize(image_path,
+                     output_folder,
+                     max_dimension,
+                     dry_run=dry_run,
+                     output_name=output_name))
+        except BaseException as e:
+          future.set_exception(e)
+      else:
+        future = self._executor.submit(resize,
+                                       image_path,
+                                       output_folder,
+                                       max_dimension,
+                                       output_name=output_name)
+      if not dry_run:
+        self._futures[key] = future
+      return future
+
+  def submit_transform(self,
+                       content: bytes,
+                       max_dimension: int = 1200,
+                       *,
+                       name: str) -> concurrent.futures.Future:
+    """Schedule an in-memory transformation of an image (see `transform`).
+    Unlike `submit` results aren't kept (as they're images themselves),
+    so the same image is transformed as many times as it's submitted.
+
+    Args:
+      content: source image content
+      name: a file name of output images (it defines their format)
+
+    Returns:
+      a future with a tuple of encoded square and landscape images
+    """
+    if self._executor:
+      return self._executor.submit(_transform_content, content, max_dimension,
+                                   name)
+    future = concurrent.futures.Future()
+    try:
+      future.set_result(_transform_content(content, max_dimension, name))
+    except BaseException as e:
+      future.set_exception(e)
+    return future
+
+  def shutdown(self, wait: bool = True):
+    if self._executor:
+      self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.shutdown(wait=exc_type is None)
+
+
+class ImageManifest:
+  """A persistent manifest of processed images keyed by image urls.
+
+  For each image it keeps validators of the downloaded copy (ETag and
+  Last-Modified), a hash of its content, parameters of the transformation
+  (see `get_transform_params`) and names of output files. It allows to skip
+  downloading (with conditional requests), resizing and uploading of images
+  that haven't changed since the previous run and to reprocess them when
+  transformation parameters change. It also allows to name images by their
+  content (see `get_image_name`).
+  The manifest is kept as a json file, either local or on GCS (gs://).
+  """
+
+  def __init__(self, path: str, storage_client=None):
+    self.path = path
+    self._storage_client = storage_client
+    self._lock = threading.Lock()
+    self._entries: Dict[str, Dict[str, Any]] = {}
+    self._used = set()
+    self._modified = False
+
+  def load(self):
+    try:
+      if self.path.startswith('gs://'):
+        content = file_utils.get_file_from_gcs(self.path, self._storage_client)
+      else:
+        with open(self.path, 'r') as f:
+          content = f.read()
+      self._entries = json.loads(content)
+      logging.info(
+          f'Loaded image manifest {self.path} ({len(self._entries)} images)')
+    except FileNotFoundError:
+      self._entries = {}
+      logging.info(
+          f'Image manifest {self.path} was not found, starting a new one')
+    return self
+
+  def save(self, prune: bool = False):
+    """Save the manifest if it was modified.
+    Args:
+      prune: True to remove entries of images that weren't used
+             (see `get`, `set_processed`) since the manifest was loaded
+    """
+    with self._lock:
+      if prune:
+        unused = self._entries.keys() - self._used
+        for url in unused:
+          del self._entries[url]
+        self._modified = self._modified or bool(unused)
+      if not self._modified:
+        return
+      content = json.dumps(self._entries)
+      self._modified = False
+    if self.path.startswith('gs://'):
+      file_utils.save_file_to_gcs(self.path, content, self._storage_client)
+    else:
+      with open(self.path, 'w') as f:
+        f.write(content)
+    logging.debug(f'Saved image manifest {self.path}')
+
+  def get(self, url: str) -> Dict[str, Any]:
+    with self._lock:
+      self._used.add(url)
+      return self._entries.get(url) or {}
+
+  def is_processed(self, url: str, params: Dict[str, Any],
+                   outputs: List[str], content_hash: str = None) -> bool:
+    """Check that output files were produced from an image with the same
+    transformation parameters (and from the same content if its hash is passed).
+    """
+    entry = self.get(url)
+    if entry.get('params') != params:
+      return False
+    if content_hash and entry.get('hash') != content_hash:
+      return False
+    return set(outputs).issubset(entry.get('outputs') or [])
+
+  def set_processed(self,
+                    url: str,
+                    content_hash: str,
+                    params: Dict[str, Any],
+                    outputs: List[str],
+                    validators: Dict[str, str] = None):
+    """Record output files produced from an image.
+    Outputs produced earlier from the same content with the same parameters
+    (e.g. for other products sharing the image) are kept.
+
+    Args:
+      validators: ETag and Last-Modified of the downloaded image
+                  (see `file_utils.download_file`), if omitted the previous
+                  ones are kept
+    """
+    with self._lock:
+      self._used.add(url)
+      entry = self._entries.get(url) or {}
+      if entry.get('hash') == content_hash and entry.get('params') == params:
+        outputs = set(entry.get('outputs') or []).union(outputs)
+      updated = {
+          **entry, 'hash': content_hash,
+          'params': params,
+          'outputs': sorted(outputs)
+      }
+      if validators:
+        updated['etag'] = validators.get('etag')
+        updated['last_modified'] = validators.get('last_modified')
+      if updated != entry:
+        self._entries[url] = updated
+        self._modified = True
+
+  def get_image_name(self, url: str, content_hash: str = None) -> str:
+    """Return a content-addressed file name for an image.
+    Args:
+      url: image url
+      content_hash: a hash of the image content if it's known,
+                    otherwise it's taken from the manifest
+    """
+    if not content_hash:
+      # fallback to the url hash for images that were never fetched
+      content_hash = self.get(url).get('hash') or file_utils.get_content_hash(
+          url.encode('utf-8'))
+    ext = os.path.splitext(parse.urlparse(url).path)[1]
+    return content_hash + ext
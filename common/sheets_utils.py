@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+import itertools
+import re
+from typing import Iterable, List
 from googleapiclient.discovery import build
 from googleapiclient import errors
 from google.auth import credentials
@@ -56,6 +59,39 @@ class GoogleSpreadsheetUtils(object):
 # googleapiclient.errors.HttpError: <HttpError 403 when requesting https://sheets.googleapis.com/v4/spreadsheets/1T2nfLxVcjyAhiFcxecm4pIaR1bBzWrPIOWtmoNXvzNg/values/A1%3AAZ:clear?alt=json returned "The caller does not have permission". Details: "The caller does not have permission">"
 
 
+  def update_values_by_batches(self,
+                               docid: str,
+                               range: str,
+                               values: Iterable[List],
+                               batch_size: int = 5000):
+    """Updates a range with values (like `update_values`) writing them
+    by batches of rows, so values can be read lazily (e.g. from a file)
+      Args:
+        docid: spreadsheet id
+        range: range to overwrite in A1 notation (e.g. "A1:AZ"),
+               batches are written one after another from its first row
+        values: rows (iterable of lists of column values)
+        batch_size: number of rows to write at once
+    """
+    match = re.match(r'^((?:.+!)?)([A-Z]+)(\d+):([A-Z]+)$', range)
+    if not match:
+      raise ValueError(f'Unsupported range {range}, expected "A1:Z" format')
+    sheet, start_column, start_row, end_column = match.groups()
+    row = int(start_row)
+    values = iter(values)
+    batch_range = range
+    clear_values = True
+    while True:
+      batch = list(itertools.islice(values, batch_size))
+      if batch or clear_values:
+        self.update_values(docid, batch_range, batch, clear_values)
+      if len(batch) < batch_size:
+        break
+      # the next batch goes right after the previous one
+      row += len(batch)
+      batch_range = f'{sheet}{start_column}{row}:{end_column}'
+      clear_values = False
+
   def get_values(self, docid: str, range):
     """Fetch values (as 2-dimentional array) from a range"""
     try:
@@ -15,6 +15,15 @@
 import enum
 import resource
 import shutil
+from typing import Any, Callable, Dict, Iterable, List
+
+# Number of rows serialized at once in streaming responses (see `iter_json_rows`)
+STREAM_ROWS_PER_CHUNK = 1000
+# Formats of streaming responses with their content types
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json-stream': 'application/json'
+}
 
 def get_rss():
   return resource.getrusage(
@@ -44,3 +53,42 @@ def get_disk_usage(units: DiskUsageUnits = None):
 
   return (total // conv, used // conv, free // conv)
 
+
+
+def iter_json_rows(rows: Iterable,
+                   encode: Callable[[Dict], str],
+                   response_format: str,
+                   chunk_size: int = STREAM_ROWS_PER_CHUNK):
+  """Serialize rows into JSON chunks while rows are being fetched.
+    Args:
+      rows: an iterable of rows (e.g. RowIterator)
+      encode: a function serializing a row (as dict) into JSON
+      response_format: 'ndjson' (a JSON object per line)
+                       or 'json-stream' (a JSON array)
+      chunk_size: number of rows in a chunk
+  """
+  ndjson = response_format == 'ndjson'
+  chunk = []
+  if not ndjson:
+    yield '['
+  for i, row in enumerate(rows):
+    obj = encode(dict(row.items()))
+    chunk.append(obj + '\n' if ndjson else (',' if i else '') + obj)
+    if len(chunk) >= chunk_size:
+      yield ''.join(chunk)
+      chunk = []
+  if chunk:
+    yield ''.join(chunk)
+  if not ndjson:
+    yield ']'
+
+
+def get_page(items: List, total: int, offset: int) -> Dict[str, Any]:
+  """Return a page of items with a total number and an offset of next page"""
+  next_offset = offset + len(items)
+  return {
+      'products': items,
+      'total': total,
+      'offset': offset,
+      'next_offset': next_offset if next_offset < total else None
+  }
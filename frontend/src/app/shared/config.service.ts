@@ -57,6 +57,8 @@ export interface Configuration {
   dt_schedule: string;
   // pub / sub topic id for publishing message on GMC Data Transfer completions
   pubsub_topic_dt_finish: string;
+  // materialise filtered products into tables refreshed on Data Transfer completions
+  materialize_products?: boolean;
   // targets
   targets: ConfigurationTarget[];
 }
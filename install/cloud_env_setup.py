@@ -25,6 +25,7 @@ from datetime import date, datetime, time, timedelta
 import logging
 import argparse
 import os
+import re
 from typing import NamedTuple, Dict, Union, List
 from google.auth import credentials
 from google.cloud.bigquery_datatransfer_v1.types import TransferConfig
@@ -44,12 +45,55 @@ logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 logging.getLogger('google.cloud.pubsub_v1.subscriber').setLevel(logging.WARNING)
 
 
-def create_views(bigquery_util: bigquery_utils.CloudBigQueryUtils,
-                 config: config_utils.Config,
-                 target: config_utils.ConfigTarget):
+# SQL scripts creating combineLabels function (native SQL and JavaScript versions)
+COMBINE_LABELS_SQL_FILE = 'create-combine-labels.sql'
+COMBINE_LABELS_JS_SQL_FILE = 'create-combine-labels-js.sql'
+# Number of products in a synthetic table for `benchmark_combine_labels`
+BENCHMARK_ROWS = 1000000
+# A literal date of the partition in the filtered products view (see `get_latest_date`)
+VIEW_DATE_RE = re.compile(r"_PARTITIONDATE = DATE '(\d{4}-\d{2}-\d{2})'")
+
+
+def get_latest_date(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                    config: config_utils.Config,
+                    latest_date: date = None) -> str:
+  """Return an SQL expression for a date of the latest partition of GMC
+  Data Transfer table (a literal if the table already has data).
+
+  Args:
+    latest_date: a date of the latest partition if it's already known
+  """
+  table_name = f'Products_{config.merchant_id}'
+  if not latest_date:
+    latest_date = bigquery_util.get_latest_partition_date(
+        config.dataset_id, table_name)
+  if latest_date:
+    return f"DATE '{latest_date.isoformat()}'"
+  # there's no data yet, so the view will look for the latest partition itself
+  return ('(SELECT MAX(_PARTITIONDATE) FROM '
+          f'`{bigquery_util.project_id}.{config.dataset_id}.{table_name}`)')
+
+
+def get_views_date(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                   config: config_utils.Config,
+                   target: config_utils.ConfigTarget) -> date:
+  """Return a date of the partition the view of filtered products of a target
+  is pinned to (None if the view doesn't exist or looks up the latest
+  partition itself)"""
+  view_query = bigquery_util.get_view_query(config.dataset_id,
+                                            f'Products_Filtered_{target.name}')
+  match = VIEW_DATE_RE.search(view_query or '')
+  if not match:
+    return None
+  return date.fromisoformat(match.group(1))
+
+
+def _get_views_params(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                      config: config_utils.Config,
+                      target: config_utils.ConfigTarget,
+                      latest_date: date = None) -> Dict:
   if not target.name:
     raise ValueError("Target has no name")
-  sql_files = ['create-filtered-products.sql', 'create-ads-preview.sql']
   SEARCH_CONDITIONS = "SEARCH_CONDITIONS"
   condition = ''
   if target.merchant_id:
@@ -67,9 +111,88 @@ def create_views(bigquery_util: bigquery_utils.CloudBigQueryUtils,
   params = {SEARCH_CONDITIONS: condition}
   params['merchant_id'] = config.merchant_id
   params['target'] = target.name
+  params['combine_labels'] = 'combineLabels'
+  params['LATEST_DATE'] = get_latest_date(bigquery_util, config, latest_date)
+  return params
+
+
+def create_views(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                 config: config_utils.Config,
+                 target: config_utils.ConfigTarget,
+                 js_udf: bool = False):
+  """Create views and tables for a target.
+
+  Args:
+    js_udf: True to use JavaScript version of combineLabels function
+            (by default a native SQL version with the same output is used)
+  """
+  params = _get_views_params(bigquery_util, config, target)
+  sql_files = [
+      COMBINE_LABELS_JS_SQL_FILE if js_udf else COMBINE_LABELS_SQL_FILE,
+      'create-filtered-products.sql', 'create-ads-preview.sql'
+  ]
+  if config.materialize_products:
+    # the table will be refreshed on Data Transfer completions (see /api/update)
+    sql_files.append('create-products-snapshot.sql')
   bigquery_util.execute_scripts(sql_files, config.dataset_id, params)
 
 
+def update_views(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                 config: config_utils.Config,
+                 target: config_utils.ConfigTarget,
+                 only_stale: bool = False) -> bool:
+  """Recreate the view of filtered products of a target for the latest
+  partition of GMC Data Transfer (it should be called after each transfer,
+  so queries scan only one partition).
+
+  Args:
+    only_stale: True to recreate the view only if it's pinned to a partition
+                other than the latest one (e.g. a transfer completion was missed)
+  Returns:
+    True if the view has been recreated
+  """
+  latest_date = bigquery_util.get_latest_partition_date(
+      config.dataset_id, f'Products_{config.merchant_id}')
+  # without data the view looks up the latest partition itself
+  if only_stale and (not latest_date or latest_date == get_views_date(
+      bigquery_util, config, target)):
+    return False
+  params = _get_views_params(bigquery_util, config, target, latest_date)
+  logging.info(
+      f'Updating filtered products view for \'{target.name}\' target (latest date: {params["LATEST_DATE"]})'
+  )
+  bigquery_util.execute_scripts('create-filtered-products.sql',
+                                config.dataset_id, params)
+  return True
+
+
+def benchmark_combine_labels(bigquery_util: bigquery_utils.CloudBigQueryUtils,
+                             config: config_utils.Config,
+                             rows: int = BENCHMARK_ROWS):
+  """Compare native SQL and JavaScript versions of combineLabels function
+  on a synthetic table with products (see benchmark-combine-labels.sql)"""
+  params = {
+      'combine_labels_sql': 'combineLabels_benchmark_sql',
+      'combine_labels_js': 'combineLabels_benchmark_js',
+      'rows': rows
+  }
+  # both versions are created aside of the function used by views
+  bigquery_util.execute_scripts(
+      COMBINE_LABELS_SQL_FILE, config.dataset_id,
+      {'combine_labels': params['combine_labels_sql']})
+  bigquery_util.execute_scripts(
+      COMBINE_LABELS_JS_SQL_FILE, config.dataset_id,
+      {'combine_labels': params['combine_labels_js']})
+  result = bigquery_util.execute_scripts('benchmark-combine-labels.sql',
+                                         config.dataset_id, params)
+  row = next(iter(result))
+  logging.info(f'combineLabels on {row.row_count} products: '
+               f'native SQL - {row.sql_elapsed_ms} ms, '
+               f'JavaScript - {row.js_elapsed_ms} ms, '
+               f'mismatches - {row.mismatches}')
+  return row
+
+
 def set_permission_on_drive(fileId, email, credentials):
   driveAPI = discovery.build('drive', 'v3', credentials=credentials)
   logging.info(f'Adding write permissions to {email} on {fileId}')
@@ -282,6 +405,7 @@ class DeployOptions:
   skip_dt_run: bool
   user_email: str
   skip_spreadsheets: bool
+  js_udf: bool = False
 
 
 def deploy(config: config_utils.Config, credentials: credentials.Credentials,
@@ -331,7 +455,7 @@ def deploy(config: config_utils.Config, credentials: credentials.Credentials,
   for target in config.targets:
     logging.info(
         f'Creating solution specific views for \'{target.name}\' target.')
-    create_views(bigquery_client, config, target)
+    create_views(bigquery_client, config, target, options.js_udf)
 
     # creating spreadsheets for page feed data and adcustomizers
     if not options.skip_spreadsheets:
@@ -361,6 +485,18 @@ def add_args(parser: argparse.ArgumentParser):
   parser.add_argument('--create-spreadsheets',
                       dest='create_spreadsheets',
                       action='store_true')
+  parser.add_argument(
+      '--js-udf',
+      dest='js_udf',
+      action='store_true',
+      help='Use JavaScript version of combineLabels function in views')
+  parser.add_argument(
+      '--benchmark-combine-labels',
+      dest='benchmark_combine_labels',
+      action='store_true',
+      help=
+      'Compare native SQL and JavaScript versions of combineLabels function on a synthetic table'
+  )
 
 
 def main():
@@ -384,9 +520,16 @@ def main():
       create_spreadsheets(config, target, credentials, args.user_email)
     return
 
+  if args.benchmark_combine_labels:
+    benchmark_combine_labels(
+        bigquery_utils.CloudBigQueryUtils(config.project_id, credentials,
+                                          config.dataset_location), config)
+    return
+
   created = deploy(
       config, credentials,
-      DeployOptions(args.skip_dt_run, args.user_email, args.skip_spreadsheets))
+      DeployOptions(args.skip_dt_run, args.user_email, args.skip_spreadsheets,
+                    args.js_udf))
 
   config_file_path = args.config or 'config.json'
   if created:
@@ -29,8 +29,9 @@ from google.cloud.resourcemanager_v3.services.projects import ProjectsClient
 import zipstream
 from smart_open import open
 from app.context import ContextOptions
-from app.main import Context, create_or_update_page_feed, create_or_update_adcustomizers, generate_campaign, validate_config
-from common import config_utils, file_utils, sheets_utils
+from app.data_gateway import DataGateway
+from app.main import Context, create_or_update_page_feed, create_or_update_adcustomizers, generate_campaign, update_products_data, validate_config
+from common import bigquery_utils, config_utils, file_utils, sheets_utils, utils
 from common.config_utils import ApplicationError, ApplicationErrorReason
 from common.auth import get_credentials
 from install import cloud_data_transfer, cloud_env_setup
@@ -55,6 +56,11 @@ OUTPUT_FOLDER = '/tmp' if IS_GAE else os.path.abspath(
     os.path.join(app.root_path, './../output'))
 
 MAX_RESPONSE_SIZE = 32 * 1024 * 1024  #if IS_GAE else XXX
+# an optional folder to keep cached query results on disk (see DataGateway)
+QUERY_CACHE_FOLDER = os.getenv('QUERY_CACHE_FOLDER')
+
+# SQL scripts are parsed once per worker instead of on each query
+bigquery_utils.load_sql_templates()
 
 
 class JsonEncoder(JSONEncoder):
@@ -165,12 +171,43 @@ def _get_req_arg_str(name: str):
   return str(arg)
 
 
+def _stream_rows(rows, response_format: str):
+  """Return a response with rows serialized while they are being fetched
+  (so they aren't kept in memory and the response is sent in chunks).
+    Args:
+      rows: an iterable of rows (e.g. RowIterator)
+      response_format: 'ndjson' (a JSON object per line)
+                       or 'json-stream' (a JSON array)
+  """
+  return Response(utils.iter_json_rows(rows,
+                                       JsonEncoder().encode,
+                                       response_format),
+                  mimetype=utils.STREAM_FORMATS[response_format])
+
+
+def _get_req_arg_format():
+  """Return a format of streaming response ('ndjson' or 'json-stream') if requested"""
+  response_format = _get_req_arg_str('format')
+  if response_format and response_format not in utils.STREAM_FORMATS:
+    raise ValueError(f'Unsupported format {response_format}')
+  return response_format
+
+
+def _get_req_arg_int(name: str, default: int = 0):
+  arg = _get_req_arg_str(name)
+  if arg is None:
+    return default
+  return int(arg)
+
+
 @app.route("/api/update", methods=["POST", "GET"])
 def update_feeds():
   """Endpoint to be call by Pub/Sub message from DT completion to trigger feeds updating"""
+  # NOTE: skipped updates are responded with 503, so Pub/Sub redelivers
+  # the message later (otherwise views would be left on the previous data)
   if g_setup_lock.is_locked():
     logging.info('Skipping feeds update as setup is executing')
-    return 'Update skipped as setup is executing', 200
+    return 'Update skipped as setup is executing', 503
 
   config = _get_config()
   # Verify the Cloud Pub/Sub-generated JWT in the "Authorization" header.
@@ -182,7 +219,7 @@ def update_feeds():
 
   if g_update_lock.is_locked():
     logging.info('Update skipped as another update process is running')
-    return 'Update skipped as another update process is running', 200
+    return 'Update skipped as another update process is running', 503
 
   try:
     g_update_lock.acquire()
@@ -191,6 +228,10 @@ def update_feeds():
     credentials = _get_credentials()
     context = Context(config, None, credentials,
                       ContextOptions(OUTPUT_FOLDER, 'images'))
+    # switch views to the new partition of the data transfer
+    update_products_data(context, config.targets)
+    # a new data transfer has completed, so cached query results are outdated
+    DataGateway.invalidate_cache()
     validation = validate_config(context)
     logging.debug(f'update_feeds: config validated ({validation["valid"]})')
     if not validation['valid']:
@@ -223,8 +264,13 @@ def create_context(target_name: str) -> Context:
   config = _get_config()
   target_name = _get_req_arg_str('target')
   target = next(filter(lambda t: t.name == target_name, config.targets), None)
-  context = Context(config, target, credentials,
-                    ContextOptions(OUTPUT_FOLDER, 'images', images_on_gcs=IS_GAE))
+  context = Context(
+      config, target, credentials,
+      ContextOptions(OUTPUT_FOLDER,
+                     'images',
+                     images_on_gcs=IS_GAE,
+                     query_cache=True,
+                     query_cache_folder=QUERY_CACHE_FOLDER))
   return context
 
 
@@ -411,10 +457,16 @@ def get_labels():
     return jsonify({"error": "Required 'target' parameter is missing"}), 400
   category_only = _get_req_arg_bool('category-only')
   product_only = _get_req_arg_bool('product-only')
+  try:
+    response_format = _get_req_arg_format()
+  except ValueError as e:
+    return jsonify({"error": str(e)}), 400
   context = create_context(target_name)
   labels = context.data_gateway.load_labels(target_name,
                                             category_only=category_only,
                                             product_only=product_only)
+  if response_format:
+    return _stream_rows(labels, response_format)
   result = []
   for row in labels:
     obj = {}
@@ -433,24 +485,73 @@ def get_products():
   target_name = _get_req_arg_str('target')
   if not target_name:
     return jsonify({"error": "Required 'target' parameter is missing"}), 400
-  in_stock_only = _get_req_arg_bool('in-stock')
-  long_description = _get_req_arg_bool('long-description')
-  category_only = _get_req_arg_bool('category-only')
-  product_only = _get_req_arg_bool('product-only')
+  filters = {
+      'in_stock_only': _get_req_arg_bool('in-stock'),
+      'long_description': _get_req_arg_bool('long-description'),
+      'category_only': _get_req_arg_bool('category-only'),
+      'product_only': _get_req_arg_bool('product-only'),
+      'search': _get_req_arg_str('search')
+  }
+  # optional paging (by offset), projection and sorting (e.g. "sort=-title")
+  try:
+    page_size = _get_req_arg_int('page-size')
+    offset = _get_req_arg_int('offset')
+  except ValueError:
+    return jsonify(
+        {"error": "Parameters 'page-size' and 'offset' should be integers"}), 400
+  try:
+    response_format = _get_req_arg_format()
+  except ValueError as e:
+    return jsonify({"error": str(e)}), 400
+  columns = _get_req_arg_str('columns')
+  columns = columns.split(',') if columns else None
+  sort = _get_req_arg_str('sort')
+  descending = bool(sort) and sort.startswith('-')
+  order_by = sort[1:] if descending else sort
   context = create_context(target_name)
-  products = context.data_gateway.load_products(
+  try:
+    products = context.data_gateway.load_products(target_name,
+                                                  maxrows=page_size,
+                                                  offset=offset,
+                                                  columns=columns,
+                                                  order_by=order_by,
+                                                  descending=descending,
+                                                  use_cache=not response_format,
+                                                  **filters)
+  except ValueError as e:
+    return jsonify({"error": str(e)}), 400
+  if response_format:
+    # NOTE: streamed products aren't wrapped into a page (with total)
+    return _stream_rows(products, response_format)
+  result = [dict(row.items()) for row in products]
+  if not page_size:
+    return jsonify(result)
+  total = context.data_gateway.count_products(target_name, **filters)
+  return jsonify(utils.get_page(result, total, offset))
+
+
+@app.route("/api/products", methods=["POST"])
+def update_products():
+  """Update many products at once, expects a list of objects with
+  product_id and custom_description fields"""
+  if g_setup_lock.is_locked():
+    return jsonify({"error": "Operation is forbidden as setup is executing"
+                   }), 403
+
+  target_name = _get_req_arg_str('target')
+  if not target_name:
+    return jsonify({"error": "Required 'target' parameter is missing"}), 400
+  data = request.json
+  if not isinstance(data, list) or not all(
+      isinstance(item, dict) and item.get('product_id') for item in data):
+    return jsonify({
+        "error": "Expected a list of objects with product_id and custom_description"
+    }), 400
+  context = create_context(target_name)
+  context.data_gateway.update_products(
       target_name,
-      in_stock_only=in_stock_only,
-      long_description=long_description,
-      category_only=category_only,
-      product_only=product_only)
-  result = []
-  for row in products:
-    obj = {}
-    for col, val in row.items():
-      obj[col] = val
-    result.append(obj)
-  return jsonify(result)
+      [(item['product_id'], item.get('custom_description')) for item in data])
+  return 'Updated', 200
 
 
 @app.route("/api/products/<product_id>", methods=["POST"])
@@ -0,0 +1,72 @@
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+/*
+  Compares native SQL and JavaScript implementations of combineLabels function
+  on a synthetic table of products with random custom labels.
+  Returns elapsed time of computing labels with each function and a number of
+  products for which the functions returned different labels (should be 0).
+
+  Parameters:
+  - project_id
+  - dataset
+  - rows - number of products in the synthetic table
+  - combine_labels_sql - a function name of native SQL version
+  - combine_labels_js - a function name of JavaScript version
+*/
+
+DECLARE started TIMESTAMP;
+DECLARE sql_elapsed_ms, js_elapsed_ms INT64;
+
+-- NOTE: recreating the table also prevents using cached results of queries
+CREATE OR REPLACE TABLE `{project_id}.{dataset}.Combine_Labels_Benchmark`
+AS (
+  WITH Samples AS (
+    SELECT [
+      CAST(NULL AS STRING), '', 'sale', 'PDSA_PRODUCT', 'pdsa_product_top',
+      'PDSA_CATEGORY_Shoes', 'pdsa_category_Bags > Leather', 'PDSA_CATEGORY_',
+      'PDSA_OTHER', 'Pdsa_Category_Ünïcödé'
+    ] AS labels
+  )
+  SELECT
+    id,
+    IF(MOD(id, 997) = 0, NULL, CAST(id AS STRING)) AS offer_id,
+    IF(MOD(id, 101) = 0, NULL, STRUCT(
+      labels[OFFSET(MOD(ABS(FARM_FINGERPRINT(FORMAT('%d-0', id))), ARRAY_LENGTH(labels)))] AS label_0,
+      labels[OFFSET(MOD(ABS(FARM_FINGERPRINT(FORMAT('%d-1', id))), ARRAY_LENGTH(labels)))] AS label_1,
+      labels[OFFSET(MOD(ABS(FARM_FINGERPRINT(FORMAT('%d-2', id))), ARRAY_LENGTH(labels)))] AS label_2,
+      labels[OFFSET(MOD(ABS(FARM_FINGERPRINT(FORMAT('%d-3', id))), ARRAY_LENGTH(labels)))] AS label_3,
+      labels[OFFSET(MOD(ABS(FARM_FINGERPRINT(FORMAT('%d-4', id))), ARRAY_LENGTH(labels)))] AS label_4
+    )) AS custom_labels
+  FROM UNNEST(GENERATE_ARRAY(1, {rows})) AS id, Samples
+);
+
+SET started = CURRENT_TIMESTAMP();
+CREATE TEMP TABLE Labels_Sql AS
+  SELECT id, {dataset}.{combine_labels_sql}(custom_labels, offer_id) AS pdsa_custom_labels
+  FROM `{project_id}.{dataset}.Combine_Labels_Benchmark`;
+SET sql_elapsed_ms = TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), started, MILLISECOND);
+
+SET started = CURRENT_TIMESTAMP();
+CREATE TEMP TABLE Labels_Js AS
+  SELECT id, {dataset}.{combine_labels_js}(custom_labels, offer_id) AS pdsa_custom_labels
+  FROM `{project_id}.{dataset}.Combine_Labels_Benchmark`;
+SET js_elapsed_ms = TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), started, MILLISECOND);
+
+SELECT
+  {rows} AS row_count,
+  sql_elapsed_ms,
+  js_elapsed_ms,
+  COUNTIF(s.pdsa_custom_labels IS DISTINCT FROM j.pdsa_custom_labels) AS mismatches
+FROM Labels_Sql s
+  FULL JOIN Labels_Js j USING (id);
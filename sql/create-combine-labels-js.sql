@@ -0,0 +1,48 @@
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+/*
+  Creates a function combining Product DSA's custom labels (JavaScript version,
+  see create-combine-labels.sql for a faster native SQL version with the same output)
+
+  Parameters:
+  - dataset
+  - combine_labels - a function name
+*/
+
+-- Creates a command sepearated list of Product DSA's custom labels from custom_label GMC field
+CREATE OR REPLACE FUNCTION {dataset}.{combine_labels}(custom_labels STRUCT<label0 STRING, label1 STRING, label2 STRING, label3 STRING, label4 STRING>, offer_id STRING)
+RETURNS STRING
+LANGUAGE js
+AS r"""
+  function getLabelValue(label, offer_id) {{
+    if (!label) return null;
+    if (label.toUpperCase().indexOf('PDSA_PRODUCT') === 0) {{
+      return 'product_' + offer_id;
+    }}
+    let prefix = 'PDSA_CATEGORY_';
+    if (label.toUpperCase().indexOf(prefix) === 0) {{
+      return label.slice(prefix.length);
+    }}
+  }}
+  let result = '';
+  if (!custom_labels) return result;
+  for (label of Object.values(custom_labels)) {{
+    let norm_label = getLabelValue(label, offer_id);
+    if (norm_label) {{
+      if (result) result += '; '
+      result += norm_label;
+    }}
+  }}
+  return result;
+""";
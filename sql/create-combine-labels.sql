@@ -0,0 +1,51 @@
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+/*
+  Creates a function combining Product DSA's custom labels (native SQL version,
+  it produces the same output as the JavaScript version in
+  create-combine-labels-js.sql but doesn't need a JavaScript sandbox per query)
+
+  Parameters:
+  - dataset
+  - combine_labels - a function name
+*/
+
+-- Creates a command sepearated list of Product DSA's custom labels from custom_label GMC field:
+--   PDSA_PRODUCT* labels are replaced with 'product_{{offer_id}}',
+--   PDSA_CATEGORY_{{category}} labels are replaced with '{{category}}',
+--   other labels are skipped
+CREATE OR REPLACE FUNCTION {dataset}.{combine_labels}(custom_labels STRUCT<label0 STRING, label1 STRING, label2 STRING, label3 STRING, label4 STRING>, offer_id STRING)
+RETURNS STRING
+AS (
+  IFNULL((
+    SELECT STRING_AGG(norm_label, '; ' ORDER BY idx)
+    FROM (
+      SELECT
+        idx,
+        CASE
+          -- NOTE: JavaScript version converts a missing offer_id to 'null'
+          WHEN STARTS_WITH(UPPER(label), 'PDSA_PRODUCT') THEN CONCAT('product_', IFNULL(offer_id, 'null'))
+          WHEN STARTS_WITH(UPPER(label), 'PDSA_CATEGORY_') THEN SUBSTR(label, LENGTH('PDSA_CATEGORY_') + 1)
+        END AS norm_label
+      FROM UNNEST([
+        custom_labels.label0,
+        custom_labels.label1,
+        custom_labels.label2,
+        custom_labels.label3,
+        custom_labels.label4
+      ]) AS label WITH OFFSET idx
+    )
+    WHERE LENGTH(norm_label) > 0
+  ), '')
+);
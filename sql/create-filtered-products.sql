@@ -22,47 +22,19 @@
   - dataset
   - merchant_id
   - target
-*/
+  - LATEST_DATE - a date of the latest partition of the Data Transfer table,
+    either a literal (then only that partition is scanned) or a subquery
+  - SEARCH_CONDITIONS - additional filters for products of the target
 
--- Creates a command sepearated list of Product DSA's custom labels from custom_label GMC field
-CREATE OR REPLACE FUNCTION {dataset}.combineLabels(custom_labels STRUCT<label0 STRING, label1 STRING, label2 STRING, label3 STRING, label4 STRING>, offer_id STRING)
-RETURNS STRING
-LANGUAGE js
-AS r"""
-  function getLabelValue(label, offer_id) {{
-    if (!label) return null;
-    if (label.toUpperCase().indexOf('PDSA_PRODUCT') === 0) {{
-      return 'product_' + offer_id;
-    }}
-    let prefix = 'PDSA_CATEGORY_';
-    if (label.toUpperCase().indexOf(prefix) === 0) {{
-      return label.slice(prefix.length);
-    }}
-  }}
-  let result = '';
-  if (!custom_labels) return result;
-  for (label of Object.values(custom_labels)) {{
-    let norm_label = getLabelValue(label, offer_id);
-    if (norm_label) {{
-      if (result) result += '; '
-      result += norm_label;
-    }}
-  }}
-  return result;
-""";
+  Requires combineLabels function (see create-combine-labels.sql and
+  create-combine-labels-js.sql)
+*/
 
 CREATE OR REPLACE VIEW `{project_id}.{dataset}.Products_Filtered_{target}`
 AS (
-  WITH
-    LatestDate AS (
-      SELECT
-        MAX(_PARTITIONDATE) AS latest_date
-      FROM
-        `{project_id}.{dataset}.Products_{merchant_id}`
-    )
   SELECT
     _PARTITIONDATE as data_date,
-    LatestDate.latest_date,
+    {LATEST_DATE} AS latest_date,
     product_id,
     merchant_id,
     offer_id,
@@ -107,10 +79,9 @@ AS (
     ROUND ((price.value - sale_price.value)* 100/price.value, 1) AS discount,
     {dataset}.combineLabels(custom_labels, offer_id) AS pdsa_custom_labels
   FROM
-    `{project_id}.{dataset}.Products_{merchant_id}` AS Products,
-    LatestDate
+    `{project_id}.{dataset}.Products_{merchant_id}` AS Products
   WHERE
-    _PARTITIONDATE = LatestDate.latest_date
+    _PARTITIONDATE = {LATEST_DATE}
     AND (custom_labels.label_0 like 'PDSA_%'
       OR custom_labels.label_1 like 'PDSA_%'
       OR custom_labels.label_2 like 'PDSA_%'
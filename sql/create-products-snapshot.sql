@@ -0,0 +1,29 @@
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+/*
+  Materialises the filtered products view of a target into a table,
+  so queries don't recompute the view (the latest partition of the
+  GMC Data Transfer, splitting of categories, custom labels) each time.
+  The table should be recreated after each data transfer.
+
+  Parameters:
+  - project_id
+  - dataset
+  - target
+*/
+
+CREATE OR REPLACE TABLE `{project_id}.{dataset}.Products_Snapshot_{target}`
+CLUSTER BY pdsa_custom_labels, offer_id
+AS
+SELECT * FROM `{project_id}.{dataset}.Products_Filtered_{target}`;
@@ -21,11 +21,12 @@
   - project_id
   - dataset
   - target
+  - products_table - a view or a table of filtered products of the target
 */
 
 WITH labels AS (
   SELECT split(pdsa_custom_labels,';') as label
-  FROM `{project_id}.{dataset}.Products_Filtered_{target}`
+  FROM `{project_id}.{dataset}.{products_table}`
   WHERE
     LENGTH(IFNULL(link,'')) > 0  AND
     LENGTH(IFNULL(pdsa_custom_labels,'')) > 0
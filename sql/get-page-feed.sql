@@ -22,12 +22,13 @@
   - project_id
   - dataset
   - target
+  - products_table - a view or a table of filtered products of the target
 */
 
 SELECT DISTINCT
   link AS Page_URL,
   pdsa_custom_labels AS Custom_label
-FROM `{project_id}.{dataset}.Products_Filtered_{target}`
+FROM `{project_id}.{dataset}.{products_table}`
 WHERE
   LENGTH(IFNULL(link,'')) > 0  AND
   LENGTH(IFNULL(pdsa_custom_labels,'')) > 0 AND
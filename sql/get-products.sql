@@ -21,9 +21,12 @@
   - project_id
   - dataset
   - target
+  - products_table - a view or a table of filtered products of the target
+  - COLUMNS - a list of columns to select
+  - WHERE_CLAUSE - filters, ordering and limits
 */
 
-SELECT ad.ad_description1 as custom_description, p.*
-FROM `{project_id}.{dataset}.Products_Filtered_{target}` p
+SELECT {COLUMNS}
+FROM `{project_id}.{dataset}.{products_table}` p
   LEFT JOIN `{project_id}.{dataset}.Ads_Preview_Products_{target}` ad ON ad.product_id = p.offer_id
 {WHERE_CLAUSE}
\ No newline at end of file
@@ -0,0 +1,95 @@
+# coding=utf-8
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import decimal
+import pytest
+from google.cloud import bigquery
+from common import bigquery_utils
+from common.bigquery_utils import ArrowRowIterator, SqlTemplate
+
+
+class RowIteratorStub:
+
+  def __init__(self, schema, batches):
+    self.schema = schema
+    self.total_rows = sum(batch.num_rows for batch in batches)
+    self._batches = batches
+
+  def to_arrow_iterable(self, bqstorage_client=None):
+    return iter(self._batches)
+
+
+def test_arrow_row_iterator():
+  pa = pytest.importorskip('pyarrow')
+  schema = [
+      bigquery.SchemaField('offer_id', 'STRING'),
+      bigquery.SchemaField('price', 'RECORD', fields=[
+          bigquery.SchemaField('value', 'NUMERIC'),
+          bigquery.SchemaField('currency', 'STRING')
+      ]),
+      bigquery.SchemaField('additional_image_links', 'STRING', mode='REPEATED')
+  ]
+  batches = [
+      pa.RecordBatch.from_pydict({
+          'offer_id': ['1', '2'],
+          'price': [{
+              'value': decimal.Decimal('10.5'),
+              'currency': 'USD'
+          }, None],
+          'additional_image_links': [['a', 'b'], []]
+      }),
+      pa.RecordBatch.from_pydict({
+          'offer_id': ['3'],
+          'price': [None],
+          'additional_image_links': [None]
+      })
+  ]
+  rows = ArrowRowIterator(RowIteratorStub(schema, batches), None)
+  assert rows.total_rows == 3
+  assert rows.schema == schema
+  rows = list(rows)
+  assert [row.offer_id for row in rows] == ['1', '2', '3']
+  assert rows[0]['price'] == {
+      'value': decimal.Decimal('10.5'),
+      'currency': 'USD'
+  }
+  assert rows[0][2] == ['a', 'b']
+  assert rows[1].price is None
+
+
+def test_sql_template():
+  text = ('SELECT {COLUMNS} FROM `{project_id}.{dataset}.Products_{target}`\n'
+          'WHERE labels = {{labels}} {WHERE_CLAUSE!s:>4}')
+  template = SqlTemplate(text)
+  assert template.fields == {
+      'COLUMNS', 'project_id', 'dataset', 'target', 'WHERE_CLAUSE'
+  }
+  params = {
+      'COLUMNS': '*',
+      'project_id': 'project1',
+      'dataset': 'ds',
+      'target': 't1',
+      'WHERE_CLAUSE': 'AND'
+  }
+  # templates are rendered in the same way as with str.format
+  assert template.render(params) == text.format(**params)
+  with pytest.raises(KeyError):
+    template.render({})
+
+
+def test_get_sql_template():
+  template = bigquery_utils.get_sql_template('get-products.sql')
+  # templates are loaded once
+  assert bigquery_utils.get_sql_template('get-products.sql') is template
+  assert 'WHERE_CLAUSE' in template.fields
@@ -0,0 +1,160 @@
+# coding=utf-8
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+from datetime import date
+from types import SimpleNamespace
+from common import bigquery_utils
+from common.bigquery_utils import CloudBigQueryUtils
+from common.config_utils import Config, ConfigTarget
+from install import cloud_env_setup
+
+SQL_STATEMENT_RE = re.compile(r'^(CREATE|DECLARE|MERGE|SELECT|WITH)\b',
+                              re.IGNORECASE)
+
+
+def get_sql_statements_text(query):
+  """Return SQL text without comments"""
+  # NOTE: a block comment can't be opened inside a line comment
+  query = '\n'.join(
+      line for line in query.splitlines()
+      if not line.lstrip().startswith(('#', '--')))
+  query = re.sub(r'/\*.*?\*/', '', query, flags=re.DOTALL)
+  return query.strip()
+
+
+class BigQueryUtilsStub(CloudBigQueryUtils):
+
+  def __init__(self):
+    self.project_id = 'project1'
+    self.queries = []
+    self.rows = []
+    self.latest_date = None
+    self.view_query = None
+
+  def get_latest_partition_date(self, dataset_id, table_name):
+    return self.latest_date
+
+  def get_view_query(self, dataset_id, view_name):
+    return self.view_query
+
+  def execute_scripts(self, sql_files, dataset_id, params, *args, **kwargs):
+    if isinstance(sql_files, str):
+      sql_files = [sql_files]
+    query_params = self._get_query_params(dataset_id, params)
+    for sql_file in sql_files:
+      self.queries.append(
+          (sql_file,
+           self._configure_sql(bigquery_utils.get_sql_template(sql_file),
+                               query_params)))
+    return self.rows
+
+
+def test_create_views():
+  config = Config()
+  config.merchant_id = 1
+  target = ConfigTarget()
+  target.name = 'target1'
+  bigquery_util = BigQueryUtilsStub()
+  cloud_env_setup.create_views(bigquery_util, config, target)
+  sql_file, query = bigquery_util.queries[0]
+  assert sql_file == cloud_env_setup.COMBINE_LABELS_SQL_FILE
+  assert 'FUNCTION gmcdsa.combineLabels(' in query
+  assert 'LANGUAGE js' not in query
+  assert [sql_file for sql_file, _ in bigquery_util.queries[1:]] == [
+      'create-filtered-products.sql', 'create-ads-preview.sql'
+  ]
+  _, query = bigquery_util.queries[1]
+  assert 'gmcdsa.combineLabels(custom_labels, offer_id)' in query
+  # there's no data yet, so the latest partition is looked up in the view
+  assert ('_PARTITIONDATE = (SELECT MAX(_PARTITIONDATE) FROM '
+          '`project1.gmcdsa.Products_1`)') in query
+  bigquery_util.queries.clear()
+  cloud_env_setup.create_views(bigquery_util, config, target, js_udf=True)
+  sql_file, query = bigquery_util.queries[0]
+  assert sql_file == cloud_env_setup.COMBINE_LABELS_JS_SQL_FILE
+  assert 'FUNCTION gmcdsa.combineLabels(' in query
+  assert 'LANGUAGE js' in query
+
+
+def test_update_views():
+  config = Config()
+  config.merchant_id = 1
+  target = ConfigTarget()
+  target.name = 'target1'
+  bigquery_util = BigQueryUtilsStub()
+  bigquery_util.latest_date = date(2022, 10, 1)
+  cloud_env_setup.update_views(bigquery_util, config, target)
+  # only the view is recreated with a literal date of the latest partition
+  assert len(bigquery_util.queries) == 1
+  sql_file, query = bigquery_util.queries[0]
+  assert sql_file == 'create-filtered-products.sql'
+  assert "_PARTITIONDATE = DATE '2022-10-01'" in query
+  assert 'MAX(_PARTITIONDATE)' not in query
+
+
+def test_update_stale_views():
+  config = Config()
+  config.merchant_id = 1
+  target = ConfigTarget()
+  target.name = 'target1'
+  bigquery_util = BigQueryUtilsStub()
+  bigquery_util.latest_date = date(2022, 10, 1)
+  assert cloud_env_setup.update_views(bigquery_util, config, target,
+                                      only_stale=True)
+  _, bigquery_util.view_query = bigquery_util.queries[-1]
+  assert cloud_env_setup.get_views_date(bigquery_util, config,
+                                        target) == date(2022, 10, 1)
+  # the view is up to date till a new partition is added
+  assert not cloud_env_setup.update_views(
+      bigquery_util, config, target, only_stale=True)
+  bigquery_util.latest_date = date(2022, 10, 2)
+  assert cloud_env_setup.update_views(bigquery_util, config, target,
+                                      only_stale=True)
+  _, query = bigquery_util.queries[-1]
+  assert "_PARTITIONDATE = DATE '2022-10-02'" in query
+  assert len(bigquery_util.queries) == 2
+
+
+def test_benchmark_combine_labels():
+  config = Config()
+  bigquery_util = BigQueryUtilsStub()
+  bigquery_util.rows = [
+      SimpleNamespace(row_count=100,
+                      sql_elapsed_ms=1,
+                      js_elapsed_ms=10,
+                      mismatches=0)
+  ]
+  result = cloud_env_setup.benchmark_combine_labels(bigquery_util,
+                                                    config,
+                                                    rows=100)
+  assert result.mismatches == 0
+  queries = dict(bigquery_util.queries)
+  query = queries['benchmark-combine-labels.sql']
+  assert 'GENERATE_ARRAY(1, 100)' in query
+  assert 'gmcdsa.combineLabels_benchmark_js(custom_labels, offer_id)' in query
+  assert 'FUNCTION gmcdsa.combineLabels_benchmark_sql(' in queries[
+      cloud_env_setup.COMBINE_LABELS_SQL_FILE]
+
+
+def test_sql_scripts_have_no_stray_text():
+  for sql_file in sorted(os.listdir(bigquery_utils.SQL_FOLDER)):
+    if not sql_file.endswith('.sql'):
+      continue
+    template = bigquery_utils.get_sql_template(sql_file)
+    query = template.render({field: 'x' for field in template.fields})
+    # a comment opened at the end of a line comment is never closed
+    assert '*/' not in get_sql_statements_text(query), sql_file
+    assert SQL_STATEMENT_RE.match(get_sql_statements_text(query)), sql_file
@@ -12,13 +12,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import concurrent.futures
 import csv
+import os
 from dataclasses import dataclass
 from typing import Any, Dict, List, Union
+import pytest
 from app.context import ContextOptions
 from common.config_utils import Config, ConfigTarget
 from app.main import Context
-from app.campaign_mgr import CampaignMgr, AdCustomizerGenerator
+from app.campaign_mgr import CampaignMgr, AdCustomizerGenerator, GoogleAdsEditorMgr, ProductInfo
+from app import campaign_mgr
 
 def get_products_data():
   return [{
@@ -119,6 +123,9 @@ class ProductItem:
       self._data[name] = value
 
   def __getitem__(self, key):
+    if isinstance(key, int):
+      # like bigquery.Row fields can be accessed by indexes as well
+      return list(self._data.values())[key]
     return self._data.get(key)
 
   def __setitem__(self, key, item):
@@ -172,6 +179,228 @@ def test_generate_csv(tmpdir):
     for row in reader:
       print(row)
 
+def test_generate_csv_streaming(tmpdir):
+  config = Config()
+  target = ConfigTarget()
+  products = get_products()
+  mgrs = []
+  output_csv_paths = []
+  for streaming in (False, True):
+    context = Context(
+        config, target, None,
+        ContextOptions(str(tmpdir.join(str(streaming))),
+                       "images",
+                       images_dry_run=True,
+                       streaming=streaming))
+    context.gcs_bucket = None
+    mgrs.append(CampaignMgr(context, products))
+    output_csv_paths.append(mgrs[-1].generate_csv())
+
+  # streaming mode generates the same data without keeping it in memory
+  with open(output_csv_paths[0], 'r', encoding='utf-16') as expected, \
+       open(output_csv_paths[1], 'r', encoding='utf-16') as actual:
+    assert actual.read() == expected.read()
+  with open(mgrs[1]._adcustomizer_csv_path, 'r') as csv_file:
+    assert list(csv.reader(csv_file)) == mgrs[0]._adcustomizer_gen.get_values()
+
+
+def test_generate_csv_streaming_failure(tmpdir, monkeypatch):
+  config = Config()
+  target = ConfigTarget()
+  context = Context(
+      config, target, None,
+      ContextOptions(str(tmpdir), "images", images_dry_run=True,
+                     streaming=True))
+  context.gcs_bucket = None
+  output_csv_path = CampaignMgr(context, get_products()).generate_csv()
+  with open(output_csv_path, 'r', encoding='utf-16') as csv_file:
+    expected = csv_file.read()
+
+  def add_adgroup(*args):
+    raise ConnectionError()
+
+  monkeypatch.setattr(campaign_mgr.GoogleAdsEditorMgr, 'add_adgroup',
+                      add_adgroup)
+  with pytest.raises(ConnectionError):
+    CampaignMgr(context, get_products()).generate_csv()
+  # the file of the previous run is kept and the incomplete one is removed
+  with open(output_csv_path, 'r', encoding='utf-16') as csv_file:
+    assert csv_file.read() == expected
+  assert not os.path.exists(output_csv_path + '.tmp')
+
+
+def test_generate_csv_delta(tmpdir, monkeypatch):
+  config = Config()
+  target = ConfigTarget()
+  products = []
+  for i in range(3):
+    product = get_products_data()[0]
+    product['offer_id'] = str(i)
+    product['pdsa_custom_labels'] = f'product_{i}'
+    product['image_link'] = None
+    product['additional_image_links'] = []
+    products.append(product)
+
+  def generate(products, campaign_delta_full=False, gcs_bucket=None):
+    context = Context(
+        config, target, None,
+        ContextOptions(str(tmpdir),
+                       "images",
+                       images_dry_run=True,
+                       images_on_gcs=False,
+                       campaign_delta=True,
+                       campaign_delta_full=campaign_delta_full))
+    context.gcs_bucket = gcs_bucket
+    context.images_on_gcs = False
+    output_csv_path = CampaignMgr(context, get_products(products)).generate_csv()
+    with open(output_csv_path, 'r', encoding='utf-16') as csv_file:
+      return [(row['Ad Group'], row['Ad Group Status'])
+              for row in csv.DictReader(csv_file)
+              if row['Ad Group']]
+
+  # all ad groups are new on the first run
+  assert {adgroup for adgroup, _ in generate(products)} == {
+      'Ad group 0', 'Ad group 1', 'Ad group 2'
+  }
+  # then only changed, added and removed ad groups are generated
+  products[1]['title'] = 'Wi-Fi router'
+  products[2]['offer_id'] = '3'
+  products[2]['pdsa_custom_labels'] = 'product_3'
+  rows = generate(products, campaign_delta_full=True)
+  assert set(rows) == {('Ad group 1', ''), ('Ad group 3', ''),
+                       ('Ad group 2', 'Removed')}
+  assert generate(products) == []
+  # the full file is written as well
+  with open(str(tmpdir.join(target.campaign_output_file)), 'r',
+            encoding='utf-16') as csv_file:
+    assert {row['Ad Group'] for row in csv.DictReader(csv_file)} == {
+        '', 'Ad group 0', 'Ad group 1', 'Ad group 3'
+    }
+
+  # fingerprints aren't updated if the delta file couldn't be uploaded
+  fingerprints_path = str(
+      tmpdir.join(campaign_mgr.ADGROUP_FINGERPRINTS_FILE_NAME))
+  with open(fingerprints_path, 'r') as f:
+    fingerprints = f.read()
+
+  def upload_file_to_gcs(*args, **kwargs):
+    raise ConnectionError('upload failed')
+
+  monkeypatch.setattr(campaign_mgr.file_utils, 'get_gcs_bucket',
+                      lambda *args, **kwargs: None)
+  monkeypatch.setattr(campaign_mgr.file_utils, 'upload_file_to_gcs',
+                      upload_file_to_gcs)
+  products[0]['title'] = 'Wi-Fi router'
+  with pytest.raises(ConnectionError):
+    generate(products, gcs_bucket='bucket')
+  with open(fingerprints_path, 'r') as f:
+    assert f.read() == fingerprints
+  # so the changed ad group is generated by the next run
+  monkeypatch.undo()
+  assert set(generate(products)) == {('Ad group 0', '')}
+
+
+def test_adcustomizers():
+  products_data = get_products_data()
+  products_data[0]['title'] = 'Wi-Fi  router | Keenetic ' + 'x' * 80
+  products = get_products(products_data)
+  gen = AdCustomizerGenerator(products)
+  for product in products:
+    gen.add_product(product, 'PDSA Products', 'Ad group 145155873')
+  values = dict(zip(*gen.get_values()))
+  assert values['title (text)'] == ('WiFi router Keenetic ' + 'x' * 80)[:80]
+  assert values['price_value (text)'] == '2890'
+  assert values['custom_labels_label_1 (text)'] == 'mskspb'
+  assert values['Target ad group'] == 'Ad group 145155873'
+  assert 'offer_id (text)' not in values
+  price = {'value': 10, 'currency': 'USD'}
+  assert gen._get_price_with_currency(price) == '10 USD'
+  assert gen._get_price_with_currency(price, use_symbol=True) == '$10'
+  price = {'value': 10, 'currency': 'EUR'}
+  assert gen._get_price_with_currency(price, use_symbol=True) == '€10'
+  # symbols of letters only are removed
+  price = {'value': 10, 'currency': 'DKK'}
+  assert gen._get_price_with_currency(price, use_symbol=True) == '10'
+  # unknown currency falls back to its code
+  price = {'value': 10, 'currency': 'XXX'}
+  assert gen._get_price_with_currency(price, use_symbol=True) == '10 XXX'
+
+
+def test_get_currency_symbol_fallback(monkeypatch):
+
+  def get_data(package, resource):
+    raise FileNotFoundError(resource)
+
+  monkeypatch.setattr(campaign_mgr.pkgutil, 'get_data', get_data)
+  monkeypatch.setattr(campaign_mgr, '_currency_symbols', None)
+  # symbols are looked up via CurrencyCodes if the data file can't be read
+  assert campaign_mgr._get_currency_symbol('USD') == '$'
+  assert campaign_mgr._get_currency_symbol('DKK') == ''
+  assert campaign_mgr._get_currency_symbol('XXX') is None
+
+
+def test_get_ad_descriptions(tmpdir):
+  config = Config()
+  target = ConfigTarget()
+  target.product_description = 'Static description'
+  target.product_description_as_fallback_only = True
+  context = Context(config, target, None, ContextOptions(tmpdir, "images"))
+  long_text = 'x' * 100
+  sentence = 'This is a sentence of a suitable length for ads'
+  products = [
+      ProductInfo('1', 'Title', 'Description', 'Custom', None, None),
+      ProductInfo('2', 'Title', 'Description', '', None, None),
+      ProductInfo('3', 'Title', long_text, None, None, None),
+      ProductInfo('4', long_text, long_text, None, None, None),
+  ]
+  gae = GoogleAdsEditorMgr(context)
+  assert gae.get_ad_descriptions(products) == [
+      'Custom', 'Description', 'Title', 'Static description'
+  ]
+  target.product_description = None
+  products = [
+      ProductInfo('1', long_text, long_text + '. ' + sentence, None, None,
+                  None),
+      ProductInfo('2', long_text, long_text + ', ' + sentence + '!', None,
+                  None, None),
+      ProductInfo('3', long_text, None, None, None, None),
+  ]
+  assert gae.get_ad_descriptions(products) == [
+      ' ' + sentence, ' ' + sentence, ''
+  ]
+
+
+@pytest.mark.parametrize('static_description', [None, 'Static description'])
+def test_get_ad_descriptions_arrow(tmpdir, static_description):
+  pytest.importorskip('pyarrow')
+  config = Config()
+  target = ConfigTarget()
+  target.product_description = static_description
+  target.product_description_as_fallback_only = True
+  context = Context(config, target, None, ContextOptions(tmpdir, "images"))
+  long_text = 'x' * 100
+  sentence = 'This is a sentence of a suitable length for ads'
+  texts = [
+      None, '', 'Short', 'x' * 90, 'x' * 91, long_text,
+      long_text + '. ' + sentence, long_text + ', ' + sentence + '!',
+      long_text + '|' + 'ä' * 40 + '\n' + long_text, sentence + '; ' + long_text,
+      'Ünïcödé ' + 'ß' * 82, '. , ; ! ?'
+  ]
+  products = [
+      ProductInfo(str(i), title, description, custom, None, None)
+      for i, (title, description, custom) in enumerate(
+          (title, description, custom) for title in texts
+          for description in texts for custom in (None, '', 'Custom', long_text))
+  ]
+  gae = GoogleAdsEditorMgr(context)
+  # both engines select the same descriptions
+  expected = [
+      gae._GoogleAdsEditorMgr__get_ad_description(product)
+      for product in products
+  ]
+  assert gae.get_ad_descriptions(products) == expected
+
+
 def test_filter_images(tmpdir):
   config = Config()
   target = ConfigTarget()
@@ -204,3 +433,54 @@ def test_filter_images(tmpdir):
   # and nothing more
   assert len(files_md) == 6
 
+
+
+def _done_future(result):
+  future = concurrent.futures.Future()
+  future.set_result(result)
+  return future
+
+
+def test_schedule_transform_refetch(tmpdir):
+  context = Context(
+      Config(), ConfigTarget(), None,
+      ContextOptions(str(tmpdir), "images", images_in_memory=True))
+  compaign_mgr = CampaignMgr(context, get_products([]))
+  fetches = []
+
+  class SchedulerStub:
+
+    def fetch(self, uri, *, dry_run=False, lastModified, validators=None):
+      fetches.append(validators)
+      # the image wasn't modified since the previous run (304)
+      if len(fetches) == 1:
+        return _done_future((None, 304))
+      return _done_future((b'image', 200))
+
+  class ResizePoolStub:
+
+    def submit_transform(self, content, max_image_dimension, name=None):
+      return _done_future([content + b'_sq', content + b'_ls'])
+
+  uploads = []
+
+  class UploaderStub:
+
+    def submit_content(self, content, name, gcs_path):
+      uploads.append((content, name))
+
+  validators = {'etag': '"1"', 'last_modified': None}
+  # resized images are missing on GCS, so they have to be created again
+  future = compaign_mgr._schedule_transform(
+      'http://customer.shop/products/product1.jpg',
+      str(tmpdir.join('1_product1.jpg')), SchedulerStub(), None, validators,
+      ResizePoolStub(), UploaderStub(), 1200, {})
+  local_path, status, image_paths = future.result(timeout=5)
+  # the image is downloaded again without conditional headers
+  assert fetches == [validators, None]
+  assert status == 200
+  assert [os.path.basename(path) for path in image_paths
+         ] == ['1_product1_sq.jpg', '1_product1_ls.jpg']
+  assert uploads == [(b'image', '1_product1.jpg'),
+                     (b'image_sq', '1_product1_sq.jpg'),
+                     (b'image_ls', '1_product1_ls.jpg')]
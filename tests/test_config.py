@@ -120,4 +120,50 @@ def test_validate_target_name():
   target.name = "#name"
   assert target.validate()[0]['field'] == 'name'
   target.name = "ABC-abc_01234567890"
-  assert len(target.validate()) == 0
\ No newline at end of file
+  assert len(target.validate()) == 0
+
+def test_ad_description_template():
+  target = config_utils.ConfigTarget()
+  assert target.get_ad_description_template() is None
+  target.ad_description_template = '{product_description} for {price_value}'
+  target.product_description = 'Best price'
+  template = target.get_ad_description_template()
+  assert template.render() == 'Best price for {=pdsa-adcustomizers.price_value}'
+  assert template.validate(['price_value', 'title']) == []
+  assert template.validate(['title']) == ['price_value']
+  # the template is compiled once but recompiled on changes
+  assert target.get_ad_description_template() is template
+  target.product_description = 'Low price'
+  assert target.get_ad_description_template().render(
+  ) == 'Low price for {=pdsa-adcustomizers.price_value}'
+
+
+def test_validate_ad_description_template():
+  target = config_utils.ConfigTarget()
+  target.name = 'target1'
+  target.page_feed_spreadsheetid = 'sheet1'
+  target.dsa_website = 'example.com'
+  target.ad_description_template = '{title} for {price_value}'
+  # fields are validated only if they're known
+  assert target.validate(generation=True) == []
+  assert target.validate(generation=True,
+                         adcustomizer_fields=['price_value', 'title']) == []
+  errors = target.validate(generation=True, adcustomizer_fields=['title'])
+  assert [error['field'] for error in errors] == ['ad_description_template']
+  assert errors[0]['error'].endswith(': price_value')
+
+
+def test_ad_description_template_cache_is_private():
+  target = config_utils.ConfigTarget()
+  target.update({'ad_description_template_compiled': 'x'})
+  assert not hasattr(target, 'ad_description_template_compiled')
+  target.ad_description_template = '{title}'
+  template = target.get_ad_description_template()
+  config = config_utils.Config()
+  config.targets.append(target)
+  target_json = config.to_dict()['targets'][0]
+  assert not any('compiled' in k or k.startswith('_') for k in target_json)
+  target.ad_description_template = '{title}!'
+  assert target.get_ad_description_template() is not template
+  assert target.get_ad_description_template().render(
+  ) == '{=pdsa-adcustomizers.title}!'
@@ -0,0 +1,177 @@
+# coding=utf-8
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime
+import pytest
+from common.config_utils import Config, ConfigTarget
+from app.data_gateway import DataGateway
+
+
+class Rows(list):
+  schema = []
+
+  @property
+  def total_rows(self):
+    return len(self)
+
+
+class BigQueryUtilsStub:
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.calls = []
+    self.modified = None
+
+  def execute_scripts(self, script_name, dataset_id, params, sql_params=None,
+                      **kwargs):
+    self.calls.append((script_name, params, sql_params))
+    return Rows(self.rows)
+
+  def get_table_modified(self, dataset_id, table_name):
+    return self.modified
+
+
+def create_data_gateway(rows, **kwargs):
+  config = Config()
+  target = ConfigTarget()
+  target.name = 'target1'
+  config.targets = [target]
+  data_gateway = DataGateway(config, None, **kwargs)
+  data_gateway.bq_client = BigQueryUtilsStub(rows)
+  return data_gateway
+
+
+def test_load_products_page():
+  data_gateway = create_data_gateway([])
+  data_gateway.load_products('target1',
+                             in_stock_only=True,
+                             columns=['offer_id', 'custom_description'],
+                             search='Router',
+                             order_by='title',
+                             descending=True,
+                             maxrows=10,
+                             offset=20)
+  _, params, sql_params = data_gateway.bq_client.calls[-1]
+  assert params['COLUMNS'] == (
+      'p.`offer_id`, ad.ad_description1 as custom_description')
+  where_clause = params['WHERE_CLAUSE']
+  assert where_clause.startswith('WHERE p.in_stock = 1 AND (')
+  assert 'strpos(lower(p.title), @search) > 0' in where_clause
+  assert where_clause.endswith(
+      'ORDER BY p.`title` DESC, p.product_id\nLIMIT @maxrows\nOFFSET @offset')
+  assert [(p.name, p.value) for p in sql_params] == [('search', 'router'),
+                                                     ('maxrows', 10),
+                                                     ('offset', 20)]
+  # unsorted pages are ordered by product id to be stable
+  data_gateway.load_products('target1', maxrows=10, offset=10)
+  _, params, _ = data_gateway.bq_client.calls[-1]
+  assert params['WHERE_CLAUSE'] == (
+      '\nORDER BY p.product_id\nLIMIT @maxrows\nOFFSET @offset')
+  data_gateway.load_products('target1', order_by='title')
+  _, params, _ = data_gateway.bq_client.calls[-1]
+  assert params['WHERE_CLAUSE'] == '\nORDER BY p.`title`'
+  with pytest.raises(ValueError):
+    data_gateway.load_products('target1', columns=['title; DROP TABLE'])
+
+
+def test_count_products():
+  data_gateway = create_data_gateway([(42,)])
+  assert data_gateway.count_products('target1', product_only=True) == 42
+  _, params, _ = data_gateway.bq_client.calls[-1]
+  assert params['COLUMNS'] == 'count(*) as count'
+  assert params['WHERE_CLAUSE'] == "WHERE pdsa_custom_labels like 'product_%'"
+
+
+def test_update_products():
+  data_gateway = create_data_gateway([])
+  calls = []
+  data_gateway.bq_client.execute_query = lambda sql, dataset_id, params, \
+      sql_params: calls.append((sql, sql_params))
+  data_gateway.update_products('target1', [('1', 'desc 1'), ('2', ''),
+                                           ('1', 'desc 2')])
+  data_gateway.update_products('target1', [])
+  # all products are updated with one query (and the last update wins)
+  assert len(calls) == 1
+  sql, sql_params = calls[0]
+  assert 'UNNEST(@updates)' in sql
+  assert [(struct.struct_values['product_id'],
+           struct.struct_values['custom_description'])
+          for struct in sql_params[0].values] == [('1', 'desc 2'), ('2', '')]
+
+
+def test_query_cache(tmpdir, monkeypatch):
+  DataGateway.invalidate_cache()
+  data_gateway = create_data_gateway([(1, 'product_1')], cache=True)
+  bq_client = data_gateway.bq_client
+  assert list(data_gateway.load_labels('target1')) == [(1, 'product_1')]
+  # results are reused by all instances till data is changed
+  data_gateway = create_data_gateway([], cache=True)
+  data_gateway.bq_client = bq_client
+  assert list(data_gateway.load_labels('target1')) == [(1, 'product_1')]
+  assert list(data_gateway.load_labels('target1')) == [(1, 'product_1')]
+  assert len(bq_client.calls) == 1
+  data_gateway.load_labels('target1', product_only=True)
+  assert len(bq_client.calls) == 2
+  DataGateway.invalidate_cache('target1')
+  data_gateway.load_labels('target1')
+  assert len(bq_client.calls) == 3
+  # a new version of data is checked periodically
+  monkeypatch.setattr('app.data_gateway.DATA_VERSION_TTL', 0)
+  bq_client.modified = '2022-01-01'
+  data_gateway.load_labels('target1')
+  data_gateway.load_labels('target1')
+  assert len(bq_client.calls) == 4
+  # products for generation are always queried (and not kept in memory)
+  data_gateway.load_products('target1', use_cache=False)
+  data_gateway.load_products('target1', use_cache=False)
+  assert len(bq_client.calls) == 6
+  # big results aren't cached
+  monkeypatch.setattr(data_gateway._cache, '_max_rows', 0)
+  data_gateway.load_products('target1')
+  data_gateway.load_products('target1')
+  assert len(bq_client.calls) == 8
+  DataGateway.invalidate_cache()
+
+
+def test_products_snapshot():
+  data_gateway = create_data_gateway([])
+  data_gateway.load_page_feed('target1')
+  _, params, _ = data_gateway.bq_client.calls[-1]
+  assert params['products_table'] == 'Products_Filtered_target1'
+  data_gateway.config.materialize_products = True
+  data_gateway.refresh_products_snapshot('target1')
+  script_name, params, _ = data_gateway.bq_client.calls[-1]
+  assert script_name == 'create-products-snapshot.sql'
+  data_gateway.load_products('target1')
+  _, params, _ = data_gateway.bq_client.calls[-1]
+  assert params['products_table'] == 'Products_Snapshot_target1'
+
+
+def test_refresh_stale_products_snapshot():
+  data_gateway = create_data_gateway([])
+  data_gateway.config.materialize_products = True
+  bq_client = data_gateway.bq_client
+  modified = {}
+  bq_client.get_table_modified = lambda dataset_id, table_name: modified.get(
+      table_name)
+  # the snapshot doesn't exist yet
+  modified['Products_Filtered_target1'] = datetime(2022, 10, 1)
+  assert data_gateway.refresh_products_snapshot('target1', only_stale=True)
+  modified['Products_Snapshot_target1'] = datetime(2022, 10, 1, 1)
+  assert not data_gateway.refresh_products_snapshot('target1',
+                                                    only_stale=True)
+  # the view has been switched to a new partition after the snapshot
+  modified['Products_Filtered_target1'] = datetime(2022, 10, 2)
+  assert data_gateway.refresh_products_snapshot('target1', only_stale=True)
+  assert len(bq_client.calls) == 2
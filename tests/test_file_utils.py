@@ -0,0 +1,323 @@
+# coding=utf-8
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+from urllib import parse
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+from common import file_utils
+
+
+def create_response(request, status_code, headers=None, content=b''):
+  response = requests.Response()
+  response.status_code = status_code
+  response.headers.update(headers or {})
+  response._content = content
+  response.request = request
+  response.url = request.url
+  response.reason = requests.status_codes._codes[status_code][0]
+  return response
+
+
+class MockAdapter(BaseAdapter):
+  """Http adapter returning prepared responses (status, headers, content)"""
+
+  def __init__(self, responses):
+    super().__init__()
+    self.responses = list(responses)
+    self.requests = []
+
+  def send(self, request, **kwargs):
+    self.requests.append(request)
+    return create_response(request, *self.responses.pop(0))
+
+  def close(self):
+    pass
+
+
+def test_create_http_session():
+  session = file_utils.create_http_session(pool_size=5, max_retries=2)
+  for url in ('http://host/a.jpg', 'https://host/a.jpg'):
+    adapter = session.get_adapter(url)
+    assert adapter._pool_connections == 5
+    assert adapter._pool_maxsize == 5
+    assert adapter.max_retries.total == 2
+    assert adapter.max_retries.backoff_factor == file_utils.HTTP_BACKOFF_FACTOR
+    assert 503 in adapter.max_retries.status_forcelist
+  assert session.headers['User-Agent'] == file_utils.CHROME_USER_AGENT
+
+
+def test_download_file_conditional(tmpdir):
+  session = file_utils.create_http_session()
+  adapter = MockAdapter([
+      (200, {
+          'ETag': '"v1"',
+          'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'
+      }, b'image'),
+      (304, {}, b''),
+  ])
+  session.mount('http://', adapter)
+  local_path = str(tmpdir.join('a.jpg'))
+  validators = {}
+  # act
+  assert file_utils.download_file('http://host/a.jpg',
+                                  local_path,
+                                  lastModified=None,
+                                  session=session,
+                                  validators=validators) == (local_path, 200)
+  assert file_utils.download_file('http://host/a.jpg',
+                                  local_path,
+                                  lastModified=None,
+                                  session=session,
+                                  validators=validators) == (local_path, 304)
+  # assert: both requests are sent via the session's adapter
+  assert len(adapter.requests) == 2
+  assert 'if-none-match' not in adapter.requests[0].headers
+  assert adapter.requests[1].headers['if-none-match'] == '"v1"'
+  assert adapter.requests[1].headers[
+      'if-modified-since'] == 'Wed, 21 Oct 2015 07:28:00 GMT'
+  assert validators['etag'] == '"v1"'
+  with open(local_path, 'rb') as f:
+    assert f.read() == b'image'
+
+
+def test_fetch_file_conditional():
+  session = file_utils.create_http_session()
+  adapter = MockAdapter([(304, {}, b''), (404, {}, b'')])
+  session.mount('http://', adapter)
+  assert file_utils.fetch_file('http://host/a.jpg',
+                               session=session,
+                               validators={'etag': '"v1"'}) == (None, 304)
+  assert adapter.requests[0].headers['if-none-match'] == '"v1"'
+  with pytest.raises(FileNotFoundError):
+    file_utils.fetch_file('http://host/a.jpg', session=session)
+
+
+class SessionStub:
+  """Http session returning 200 for all requests after `release` is set"""
+
+  def __init__(self, error: Exception = None):
+    self.release = threading.Event()
+    self.error = error
+    self._lock = threading.Lock()
+    self.requests = []
+    self.in_flight = collections.Counter()
+    self.max_in_flight = collections.Counter()
+
+  def get(self, uri, headers=None):
+    host = parse.urlparse(uri).hostname
+    with self._lock:
+      self.requests.append(uri)
+      self.in_flight[host] += 1
+      self.max_in_flight[host] = max(self.max_in_flight[host],
+                                     self.in_flight[host])
+    try:
+      assert self.release.wait(timeout=10)
+      if self.error:
+        raise self.error
+      request = requests.Request('GET', uri).prepare()
+      return create_response(request, 200, {}, uri.encode())
+    finally:
+      with self._lock:
+        self.in_flight[host] -= 1
+
+
+def test_download_scheduler_dedupe(tmpdir):
+  session = SessionStub()
+  with file_utils.DownloadScheduler(session) as scheduler:
+    local_path = str(tmpdir.join('a.jpg'))
+    download = scheduler.submit('http://host/a.jpg',
+                                local_path,
+                                lastModified=None)
+    fetch = scheduler.fetch('http://host/b.jpg', lastModified=None)
+    # the same local path and the same url (while in flight) are downloaded once
+    assert scheduler.submit('http://host/a.jpg', local_path,
+                            lastModified=None) is download
+    assert scheduler.fetch('http://host/b.jpg', lastModified=None) is fetch
+    session.release.set()
+    assert download.result(timeout=10) == (local_path, 200)
+    assert fetch.result(timeout=10) == (b'http://host/b.jpg', 200)
+    assert sorted(session.requests) == ['http://host/a.jpg', 'http://host/b.jpg']
+    # fetched content isn't kept after downloading
+    assert scheduler.fetch('http://host/b.jpg',
+                           lastModified=None).result(timeout=10)
+    assert len(session.requests) == 3
+
+
+def test_download_scheduler_per_host_limit():
+  session = SessionStub()
+  with file_utils.DownloadScheduler(session, max_workers=8,
+                                    max_per_host=2) as scheduler:
+    futures = [
+        scheduler.fetch(f'http://{host}/{i}.jpg', lastModified=None)
+        for host in ('host1', 'host2') for i in range(4)
+    ]
+    # wait till all allowed requests have been started
+    deadline = time.time() + 10
+    while len(session.requests) < 4 and time.time() < deadline:
+      time.sleep(0.01)
+    time.sleep(0.1)
+    # other requests are waiting for their hosts
+    assert len(session.requests) == 4
+    session.release.set()
+    concurrent.futures.wait(futures, timeout=10)
+    assert all(future.result()[1] == 200 for future in futures)
+  assert session.max_in_flight == {'host1': 2, 'host2': 2}
+
+
+def test_download_scheduler_error():
+  session = SessionStub(ConnectionError('connection reset'))
+  session.release.set()
+  with file_utils.DownloadScheduler(session) as scheduler:
+    future = scheduler.fetch('http://host/a.jpg', lastModified=None)
+    with pytest.raises(ConnectionError):
+      future.result(timeout=10)
+
+
+def test_async_download_scheduler(tmpdir):
+  httpx = pytest.importorskip('httpx')
+  requested = []
+
+  def handler(request):
+    requested.append(request)
+    if request.headers.get('if-none-match') == '"v1"':
+      return httpx.Response(304)
+    if request.url.path == '/missing.jpg':
+      return httpx.Response(404)
+    return httpx.Response(200,
+                          headers={'ETag': '"v1"'},
+                          content=request.url.path.encode())
+
+  scheduler = file_utils.AsyncDownloadScheduler(
+      transport=httpx.MockTransport(handler))
+  with scheduler:
+    local_path = str(tmpdir.join('a.jpg'))
+    validators = {}
+    # the same contract as for DownloadScheduler
+    download = scheduler.submit('http://host/a.jpg',
+                                local_path,
+                                lastModified=None,
+                                validators=validators)
+    assert scheduler.submit('http://host/a.jpg', local_path,
+                            lastModified=None) is download
+    assert download.result(timeout=10) == (local_path, 200)
+    assert validators['etag'] == '"v1"'
+    with open(local_path, 'rb') as f:
+      assert f.read() == b'/a.jpg'
+    assert scheduler.fetch('http://host/b.jpg', lastModified=None).result(
+        timeout=10) == (b'/b.jpg', 200)
+    assert scheduler.fetch('http://host/c.jpg',
+                           lastModified=None,
+                           validators={
+                               'etag': '"v1"'
+                           }).result(timeout=10) == (None, 304)
+    with pytest.raises(FileNotFoundError):
+      scheduler.fetch('http://host/missing.jpg',
+                      lastModified=None).result(timeout=10)
+  assert len(requested) == 4
+  # the loop thread is stopped on exit
+  assert not scheduler._thread.is_alive()
+  assert scheduler._loop.is_closed()
+  scheduler.shutdown()
+
+
+class BucketStub:
+  """GCS bucket with blobs uploaded after `release` is set"""
+
+  def __init__(self, name='bucket'):
+    self.name = name
+    self.release = threading.Event()
+    self.uploaded = {}
+
+  def blob(self, blob_path):
+    bucket = self
+
+    class BlobStub:
+      name = blob_path
+
+      def upload_from_filename(self, file_name):
+        assert bucket.release.wait(timeout=10)
+        with open(file_name, 'rb') as f:
+          bucket.uploaded[blob_path] = f.read()
+
+      def upload_from_string(self, content, content_type=None):
+        assert bucket.release.wait(timeout=10)
+        if content is None:
+          raise ValueError(f'No content for {blob_path}')
+        bucket.uploaded[blob_path] = content
+
+    return BlobStub()
+
+
+def create_uploader(bucket, **kwargs):
+  uploader = file_utils.GcsUploader(None, **kwargs)
+  # buckets are resolved once per uploader
+  uploader._buckets[bucket.name] = bucket
+  return uploader
+
+
+def test_gcs_uploader_error(tmpdir):
+  bucket = BucketStub()
+  bucket.release.set()
+  local_path = str(tmpdir.join('a.jpg'))
+  with open(local_path, 'wb') as f:
+    f.write(b'image')
+  with pytest.raises(FileNotFoundError):
+    with create_uploader(bucket) as uploader:
+      uploader.submit(local_path, 'gs://bucket/images/', remove=True)
+      uploader.submit(str(tmpdir.join('b.jpg')), 'gs://bucket/images/')
+  # other uploads are completed (and their files are removed)
+  assert bucket.uploaded == {'images/a.jpg': b'image'}
+  assert not os.path.exists(local_path)
+
+
+def test_gcs_uploader_content():
+  bucket = BucketStub()
+  bucket.release.set()
+  with pytest.raises(ValueError):
+    with create_uploader(bucket) as uploader:
+      uploader.submit_content(b'image', 'a.jpg', 'gs://bucket/images/')
+      uploader.submit_content(None, 'b.jpg', 'gs://bucket/images/')
+  assert bucket.uploaded == {'images/a.jpg': b'image'}
+
+
+def test_gcs_uploader_pending_limit(tmpdir):
+  bucket = BucketStub()
+  submitted = []
+  paths = []
+  for i in range(4):
+    paths.append(str(tmpdir.join(f'{i}.jpg')))
+    with open(paths[-1], 'wb') as f:
+      f.write(b'image')
+  with create_uploader(bucket, max_workers=1, max_pending=2) as uploader:
+
+    def submit():
+      for i, path in enumerate(paths):
+        uploader.submit(path, 'gs://bucket/images/')
+        submitted.append(i)
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    time.sleep(0.2)
+    # the caller is blocked while there are too many pending uploads
+    assert submitted == [0, 1]
+    bucket.release.set()
+    thread.join(timeout=10)
+    assert submitted == [0, 1, 2, 3]
+  assert sorted(bucket.uploaded) == [f'images/{i}.jpg' for i in range(4)]
@@ -12,10 +12,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
 import os
 import pytest
 from PIL import Image
-from common.image_utils import resize
+from common.image_utils import ImageManifest, ResizePool, get_transform_params, resize, transform
 
 def test_resize(tmpdir):
 
@@ -52,3 +53,106 @@ def test_resize(tmpdir):
       print('\t', image.size)
       assert image.width >= 300 and image.width >= 300
       assert round(image.width / image.height, 2) == 1.91
+
+
+def test_transform_in_memory():
+  # arrange
+  source = io.BytesIO()
+  with Image.new('RGB', size=(2400, 2400), color=(0, 0, 0)) as image:
+    image.save(source, format='JPEG')
+  # act
+  square, landscape = transform(source, 1200)
+  # assert
+  with Image.open(io.BytesIO(square)) as image:
+    assert image.format == 'JPEG'
+    assert image.size == (1200, 1200)
+  with Image.open(io.BytesIO(landscape)) as image:
+    assert image.width <= 1200 and image.height <= 1200
+    assert round(image.width / image.height, 2) == 1.91
+
+
+def test_transform_reuses_source():
+  # arrange
+  source = io.BytesIO()
+  with Image.new('RGB', size=(500, 500), color=(0, 0, 0)) as image:
+    image.save(source, format='PNG')
+  # act
+  square, landscape = transform(source, 1200)
+  # assert: square image is already square, so it's not reencoded
+  assert square == source.getvalue()
+  with Image.open(io.BytesIO(landscape)) as image:
+    assert image.format == 'PNG'
+    assert round(image.width / image.height, 2) == 1.91
+
+
+def test_manifest(tmpdir):
+  # arrange
+  path = os.path.join(tmpdir, 'manifest.json')
+  params = get_transform_params(1200)
+  manifest = ImageManifest(path).load()
+  manifest.set_processed('http://host/a.jpg', 'hash1', params,
+                         ['1_a_sq.jpg', '1_a_ls.jpg'], {'etag': '"v1"'})
+  manifest.set_processed('http://host/a.jpg', 'hash1', params,
+                         ['2_a_sq.jpg', '2_a_ls.jpg'])
+  manifest.set_processed('http://host/b.jpg', 'hash2', params,
+                         ['1_b_sq.jpg', '1_b_ls.jpg'])
+  manifest.save()
+  # act
+  manifest = ImageManifest(path).load()
+  # assert
+  assert manifest.get('http://host/a.jpg')['etag'] == '"v1"'
+  # outputs for other products sharing the image are kept
+  assert manifest.is_processed('http://host/a.jpg', params, ['1_a_sq.jpg'])
+  assert manifest.is_processed('http://host/a.jpg', params, ['2_a_sq.jpg'],
+                               'hash1')
+  # changed content or parameters require reprocessing
+  assert not manifest.is_processed('http://host/a.jpg', params,
+                                   ['1_a_sq.jpg'], 'hash3')
+  assert not manifest.is_processed('http://host/a.jpg',
+                                   get_transform_params(800), ['1_a_sq.jpg'])
+  # entries of images that weren't used are removed
+  manifest.save(prune=True)
+  assert not ImageManifest(path).load().get('http://host/b.jpg')
+
+
+def _create_image(folder, name, size=(400, 100)):
+  image_path = os.path.join(folder, name)
+  with Image.new('RGB', size=size, color=(0, 0, 0)) as image:
+    image.save(image_path)
+  return image_path
+
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_resize_pool(tmpdir, workers):
+  # arrange
+  input_folder = os.path.join(tmpdir, 'input')
+  output_folder = os.path.join(tmpdir, 'output')
+  os.makedirs(input_folder)
+  os.makedirs(output_folder)
+  image1 = _create_image(input_folder, '1_image.jpg')
+  image2 = _create_image(input_folder, '2_image.jpg')
+  with ResizePool(workers) as pool:
+    # act
+    future = pool.submit(image1, output_folder, 1200)
+    # assert: the same image is resized once
+    assert pool.submit(image1, output_folder, 1200) is future
+    assert pool.submit(image2, output_folder, 1200) is not future
+    # as well as images with the same output name (e.g. content-addressed)
+    shared = pool.submit(image1, output_folder, 1200, output_name='shared.jpg')
+    assert pool.submit(image2, output_folder, 1200,
+                       output_name='shared.jpg') is shared
+    assert os.path.basename(shared.result(timeout=60)[0]) == 'shared_sq.jpg'
+    assert pool.submit(image1, output_folder, 800) is not future
+    square_path, landscape_path = future.result(timeout=60)
+    assert os.path.basename(square_path) == '1_image_sq.jpg'
+    with Image.open(square_path) as image:
+      assert image.width == image.height
+    with Image.open(landscape_path) as image:
+      assert round(image.width / image.height, 2) == 1.91
+    with open(image1, 'rb') as f:
+      square, landscape = pool.submit_transform(f.read(),
+                                                1200,
+                                                name='1_image.jpg').result(
+                                                    timeout=60)
+    with Image.open(io.BytesIO(square)) as image:
+      assert image.width == image.height
@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright 2022 Google LLC..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from common import utils
+
+
+# rows are serialized via their items() as RowIterator's rows
+ROWS = [{'offer_id': '1', 'title': 'Router'}, {'offer_id': '2', 'title': ''}]
+
+
+def test_iter_json_rows_ndjson():
+  chunks = list(
+      utils.iter_json_rows(ROWS, json.dumps, 'ndjson', chunk_size=1))
+  # a chunk per row (with the chunk size 1), an object per line
+  assert chunks == [
+      '{"offer_id": "1", "title": "Router"}\n',
+      '{"offer_id": "2", "title": ""}\n'
+  ]
+  assert [json.loads(line) for line in ''.join(chunks).splitlines()] == ROWS
+  assert utils.STREAM_FORMATS['ndjson'] == 'application/x-ndjson'
+
+
+def test_iter_json_rows_json_stream():
+  chunks = list(utils.iter_json_rows(ROWS, json.dumps, 'json-stream'))
+  assert chunks == [
+      '[', '{"offer_id": "1", "title": "Router"},'
+      '{"offer_id": "2", "title": ""}', ']'
+  ]
+  assert json.loads(''.join(chunks)) == ROWS
+  assert utils.STREAM_FORMATS['json-stream'] == 'application/json'
+
+
+def test_iter_json_rows_empty():
+  assert ''.join(utils.iter_json_rows([], json.dumps, 'ndjson')) == ''
+  assert json.loads(''.join(utils.iter_json_rows([], json.dumps,
+                                                 'json-stream'))) == []
+
+
+def test_iter_json_rows_lazy():
+  fetched = []
+
+  def fetch_rows():
+    for row in ROWS:
+      fetched.append(row)
+      yield row
+
+  chunks = utils.iter_json_rows(fetch_rows(),
+                                json.dumps,
+                                'ndjson',
+                                chunk_size=1)
+  next(chunks)
+  # rows are serialized while they're being fetched
+  assert len(fetched) == 1
+
+
+def test_get_page():
+  assert utils.get_page(['a', 'b'], total=5, offset=2) == {
+      'products': ['a', 'b'],
+      'total': 5,
+      'offset': 2,
+      'next_offset': 4
+  }
+  assert utils.get_page(['a'], total=5, offset=4)['next_offset'] is None
+  assert utils.get_page([], total=0, offset=0)['next_offset'] is None